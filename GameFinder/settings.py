@@ -11,8 +11,11 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 import os
 
+from datetime import timedelta
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -49,6 +52,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'core.instrumentation.InstrumentationMiddleware',
+    'core.db.ReplicaPinMiddleware',
 ]
 
 ROOT_URLCONF = 'GameFinder.urls'
@@ -82,8 +87,40 @@ DATABASES = {
         'PASSWORD': 'pwd',
         'HOST': '127.0.0.1',
         'PORT': '5432',
+        # Keep connections open between requests instead of connecting for every request.
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 60)),
     }
 }
+# Persistent connections are checked at the start of each request and replaced if the server
+# dropped them (core.db.check_connections).
+DB_HEALTH_CHECKS = True
+
+# Optional read replica for the read-only views (core.db.ReplicaRouter). For local testing it
+# can be a second database on the same server: GAMEFINDER_REPLICA_NAME=gamefinder_replica.
+# Tests mirror it to the default database.
+if os.getenv('GAMEFINDER_REPLICA_HOST') or os.getenv('GAMEFINDER_REPLICA_NAME'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'HOST': os.getenv('GAMEFINDER_REPLICA_HOST', DATABASES['default']['HOST']),
+        'PORT': os.getenv('GAMEFINDER_REPLICA_PORT', DATABASES['default']['PORT']),
+        'NAME': os.getenv('GAMEFINDER_REPLICA_NAME', DATABASES['default']['NAME']),
+        'TEST': {'MIRROR': 'default'},
+    }
+DATABASE_ROUTERS = ['core.db.ReplicaRouter']
+# After a write, a client's reads stay on the primary this long (seconds) so it sees its own
+# changes despite replication lag.
+REPLICA_PIN_SECONDS = 10
+
+# SpatiaLite stand-in so the test suite can run without a PostGIS server (needs the
+# mod_spatialite library): GAMEFINDER_DATABASE=spatialite python manage.py test
+# PostGIS-only features (PostGISMatchingEngine, advisory locks) are skipped or unused there.
+if os.getenv('GAMEFINDER_DATABASE') == 'spatialite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.contrib.gis.db.backends.spatialite',
+            'NAME': BASE_DIR / 'gamefinder.sqlite3',
+        }
+    }
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -132,4 +169,106 @@ LOGOUT_REDIRECT_URL = "/"
 USE_GEOPY_API = os.getenv('USE_GEOPY_API', False) == 'True'
 USE_FAKE_COORDINATES = True
 
+# Map API client. Nominatim's usage policy allows 1 request per second.
+GEOCODER_RATE = 1.0
+GEOCODER_BURST = 1
+GEOCODER_POOL_SIZE = 2
+GEOCODER_TIMEOUT = 10
+# Lookups in flight at once from the async views (core.geocoding.AsyncNominatimGeocoder).
+GEOCODER_ASYNC_CONCURRENCY = 8
+# Fill in approximate coordinates from the bundled ZIP code table until the precise lookup finishes.
+# The bundled core/data/zip_centroids.csv only lists about 100 ZIP codes (one or two per major
+# city), so most lookups fall back to the average of the known ZIPs sharing the first three
+# digits, or find nothing. Replace it with a full ZIP centroid table (same columns) for real use.
+USE_ZIP_CENTROIDS = True
+
+# Use the async details/submit/delete views. Only enable when served over ASGI (GameFinder.asgi),
+# since submits finish their matching in background tasks on the server's event loop. Those tasks
+# die with the process, so it also requires USE_JOB_QUEUE: the run_jobs worker finishes the jobs
+# of submits whose task was lost in a restart.
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', False) == 'True'
+
+# Shared geocode cache (core.models.GeocodeCache). Failed lookups are cached for a shorter time.
+GEOCODE_CACHE_TTL = timedelta(days=180)
+GEOCODE_NEGATIVE_TTL = timedelta(days=1)
+GEOCODE_CACHE_MAX_ENTRIES = 200000
+
+# Geocoding and matching run in the run_jobs worker instead of inside the submit request.
+USE_JOB_QUEUE = os.getenv('USE_JOB_QUEUE', False) == 'True'
+if ASYNC_VIEWS and not USE_JOB_QUEUE:
+    raise ImproperlyConfigured('ASYNC_VIEWS requires USE_JOB_QUEUE (and a run_jobs worker).')
+JOB_LEASE = timedelta(minutes=5)
+JOB_MAX_ATTEMPTS = 8
+JOB_RETRY_DELAY = timedelta(seconds=30)
+JOB_MAX_RETRY_DELAY = timedelta(hours=1)
+
+# Engine used to find DMs/players within travel range of each other.
+# 'core.matching.PostGISMatchingEngine' runs distance queries in the database.
+# 'core.matching.InMemoryMatchingEngine' keeps a per-process spatial index (requires NumPy).
+# 'core.matching.SnapshotMatchingEngine' maps a columnar snapshot shared by all processes on the
+# machine (requires NumPy; rebuild it periodically with the build_match_snapshot command).
+# Until build_match_snapshot has run once, lookups fall back to the PostGIS engine. The snapshot
+# locks its files with fcntl.flock, so this engine only works on Unix.
+MATCHING_ENGINE = os.getenv('MATCHING_ENGINE', 'core.matching.PostGISMatchingEngine')
+MATCH_SNAPSHOT_DIR = os.getenv('MATCH_SNAPSHOT_DIR', BASE_DIR / 'var' / 'match_snapshot')
+# Snapshot log records written this many seconds before a rebuild reads the database are carried
+# into the new snapshot, in case their transaction hadn't committed yet. Keep it above the
+# longest transaction that saves a request.
+MATCH_SNAPSHOT_LOG_OVERLAP = 300
+
+# Per-user request lists for the home page are cached (core.models.user_request_list) and
+# cleared on save/delete. Set MEMCACHED_LOCATION when running more than one worker process so
+# every process sees the invalidation; the local memory cache is per process.
+if os.getenv('MEMCACHED_LOCATION'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+            'LOCATION': os.getenv('MEMCACHED_LOCATION'),
+        }
+    }
+REQUEST_LIST_CACHE_TIMEOUT = 60 * 60
+
+# Zoom levels of the map tiles the demand counts are kept for (core.models.DemandTile).
+# Zoom 4 tiles are roughly 1500 miles across at the equator and each level halves that.
+DEMAND_TILE_ZOOMS = (4, 6, 8, 10)
+DEMAND_DEFAULT_ZOOM = 8
+
+# Page size limits for the JSON match API (core.views.api_requests).
+API_PAGE_SIZE = 20
+API_MAX_PAGE_SIZE = 100
+
+# Rows fetched per round trip (and written per output chunk) by the data export (core.export).
+EXPORT_CHUNK_SIZE = 2000
+
+# Admin changelists of unfiltered tables above this many rows show PostgreSQL's row estimate
+# instead of an exact count (core.admin.EstimatedCountPaginator).
+ADMIN_COUNT_ESTIMATE_THRESHOLD = 100000
+# Available DM links shown on the GameRequest admin change form.
+ADMIN_LINK_PREVIEW = 50
+
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+# Group emails wait this long in the outbox (core.models.GroupNotification) so further changes
+# to the group are sent as one digest. Without the job queue they are sent immediately.
+NOTIFICATION_DIGEST_DELAY = timedelta(minutes=10) if USE_JOB_QUEUE else timedelta(0)
+
+# Group solver (core.groups). Neighbourhoods larger than the limit are solved in part, and the
+# solver settles for a quicker answer once the time budget (seconds) is spent.
+GROUP_COMPONENT_LIMIT = 5000
+GROUP_SOLVER_TIME_BUDGET = 2.0
+MAX_TABLE_PLAYERS = 5
+# Links followed out from a saved request, or a deleted request's group members, when
+# re-solving groups. Keeps each save's solve (and the rows it locks) to its neighbourhood.
+REGROUP_DEPTH = 2
+
+# Size in degrees of the per-system tiles locked while a request is matched (core.locking).
+# Bigger tiles mean fewer locks per DM save but more unrelated submits waiting on each other.
+MATCH_LOCK_TILE_SIZE = 5.0
+
+# Requests slower than this (seconds) are logged with their timing span breakdown.
+SLOW_REQUEST_THRESHOLD = 1.0
+# /metrics is readable by staff users, by clients sending "Authorization: Bearer <METRICS_TOKEN>"
+# (set it for the Prometheus server's bearer_token), and by the addresses in METRICS_ALLOWED_IPS.
+# Behind a reverse proxy every client arrives from the proxy's address, so only list addresses
+# that reach the app server directly.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+METRICS_ALLOWED_IPS = []
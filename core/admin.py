@@ -1,4 +1,127 @@
+from django.conf import settings
 from django.contrib import admin
-from .models import GameRequest
+from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils.functional import cached_property
 
-admin.site.register(GameRequest)
+from .models import DemandTile, GameGroup, GameRequest, GroupNotification, MatchJob
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator for large tables. An unfiltered changelist on PostgreSQL takes its count from the
+    planner's row estimate (pg_class.reltuples) once that is above ADMIN_COUNT_ESTIMATE_THRESHOLD,
+    instead of running COUNT(*) over the whole table on every page. Filtered or small lists are
+    counted exactly.
+    """
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if connection.vendor == 'postgresql' and query is not None and not query.where:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                               [query.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] > settings.ADMIN_COUNT_ESTIMATE_THRESHOLD:
+                return row[0]
+        return super().count
+
+
+def count_subquery(queryset, column):
+    """
+    Correlated COUNT(*) of queryset grouped by column, for annotating a list without joining
+    (and multiplying) its rows. NULL when there are no rows.
+    """
+    counts = queryset.order_by().values(column).annotate(count=Count('*')).values('count')
+    return Subquery(counts, output_field=IntegerField())
+
+
+@admin.register(GameRequest)
+class GameRequestAdmin(admin.ModelAdmin):
+    """
+    Changelist and change form that stay fast with hundreds of thousands of requests:
+    * users are joined into the list query, and the candidate DM and group size columns are
+        counted by correlated subqueries in the same query;
+    * the filters use the (system, can_dm) index and search only uses exact lookups on indexed
+        columns (username, zip);
+    * the count comes from EstimatedCountPaginator, and the filtered/total count pair is skipped;
+    * available_dms is kept by the matching code, so the form shows the first
+        ADMIN_LINK_PREVIEW links read-only instead of a widget listing every request.
+    user and group are read-only too: GameRequest.save() only writes the tracked fields, and
+    groups are kept by the matching code.
+    """
+    list_display = ('request_name', 'user', 'system', 'can_dm', 'travel_range', 'zip',
+                    'candidate_dm_count', 'group_size')
+    list_select_related = ('user',)
+    list_filter = ('system', 'can_dm')
+    search_fields = ('user__username__exact', 'zip__exact')
+    show_full_result_count = False
+    paginator = EstimatedCountPaginator
+    exclude = ('available_dms',)
+    readonly_fields = ('user', 'group', 'available_dm_preview')
+
+    def get_queryset(self, request):
+        through = GameRequest.available_dms.through
+        return super().get_queryset(request).annotate(
+            candidate_dm_count=Coalesce(count_subquery(
+                through.objects.filter(from_gamerequest=OuterRef('pk')), 'from_gamerequest'), 0),
+            # Players at the table this request plays at, or hosts.
+            group_size=Coalesce(
+                count_subquery(GameRequest.objects.filter(group=OuterRef('group')), 'group'),
+                count_subquery(GameRequest.objects.filter(group__host=OuterRef('pk')), 'group'),
+                0,
+            ),
+        )
+
+    @admin.display(description='Candidate DMs', ordering='candidate_dm_count')
+    def candidate_dm_count(self, obj):
+        return obj.candidate_dm_count
+
+    @admin.display(description='Group size', ordering='group_size')
+    def group_size(self, obj):
+        return obj.group_size
+
+    @admin.display(description='Available DMs')
+    def available_dm_preview(self, obj):
+        if obj.pk is None:
+            return '-'
+        limit = settings.ADMIN_LINK_PREVIEW
+        dms = list(obj.available_dms.select_related('user').order_by('pk')[:limit + 1])
+        preview = ', '.join(f"{dm.request_name} ({dm.user.username}, #{dm.pk})" for dm in dms[:limit])
+        if len(dms) > limit:
+            preview += f" and {obj.candidate_dm_count - limit} more"
+        return preview or '-'
+
+
+@admin.register(GameGroup)
+class GameGroupAdmin(admin.ModelAdmin):
+    list_display = ('host', 'created')
+    list_select_related = ('host',)
+    raw_id_fields = ('host',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(MatchJob)
+class MatchJobAdmin(admin.ModelAdmin):
+    list_display = ('game_request', 'geocode', 'attempts', 'run_after')
+    list_select_related = ('game_request',)
+    raw_id_fields = ('game_request',)
+
+
+@admin.register(GroupNotification)
+class GroupNotificationAdmin(admin.ModelAdmin):
+    list_display = ('host', 'recipient', 'pending', 'attempts', 'run_after')
+    list_select_related = ('host',)
+    list_filter = ('pending',)
+    raw_id_fields = ('host',)
+
+
+@admin.register(DemandTile)
+class DemandTileAdmin(admin.ModelAdmin):
+    list_display = ('system', 'zoom', 'tile_x', 'tile_y', 'players', 'dms')
+    list_filter = ('system', 'zoom')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
@@ -1,6 +1,23 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate
 
 
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        from core.instrumentation import install_query_counter
+        connection_created.connect(install_query_counter, dispatch_uid='core.instrumentation.install_query_counter')
+        # Connections of this thread that another app opened before this receiver was connected.
+        for connection in connections.all():
+            install_query_counter(connection)
+        from core.matching import ensure_system_indexes
+        post_migrate.connect(ensure_system_indexes, sender=self, dispatch_uid='core.matching.ensure_system_indexes')
+        if settings.DB_HEALTH_CHECKS:
+            from core.db import check_connections
+            request_started.connect(check_connections, dispatch_uid='core.db.check_connections')
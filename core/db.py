@@ -0,0 +1,127 @@
+import asyncio
+import time
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+REPLICA = 'replica'
+# Cookie holding the time (epoch seconds) until which a client's reads stay on the primary.
+PIN_COOKIE = 'gamefinder_primary_until'
+
+# Set while a view marked with replica_reads runs.
+use_replica = ContextVar('use_replica', default=False)
+# {'wrote': bool} for the request being handled (see ReplicaPinMiddleware). None outside one.
+request_writes = ContextVar('request_writes', default=None)
+
+
+class ReplicaRouter:
+    """
+    Sends reads of this app's models to the 'replica' database while a replica_reads view runs,
+    and everything else to the primary:
+    * writes always go to the primary, including saves of instances loaded from the replica;
+    * sessions and users are read from the primary, so a fresh login is never missing;
+    * matching runs on save, outside the read-only views, so its candidate DM queries and
+        locks use the primary.
+    Without a 'replica' entry in DATABASES every query uses the primary.
+    """
+    def db_for_read(self, model, **hints):
+        if use_replica.get() and model._meta.app_label == 'core' and REPLICA in settings.DATABASES:
+            return REPLICA
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        writes = request_writes.get()
+        if writes is not None:
+            writes['wrote'] = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both databases hold the same data.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replica is kept up to date by replication, not migrations.
+        return db != REPLICA
+
+
+def pinned_to_primary(request):
+    try:
+        return float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def replica_reads(view):
+    """
+    Marks a read-only view whose model reads can be served by the replica. Clients that made
+    a change in the last REPLICA_PIN_SECONDS (see ReplicaPinMiddleware) keep reading from the
+    primary, so they always see their own writes.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        token = use_replica.set(not pinned_to_primary(request))
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            use_replica.reset(token)
+    return wrapper
+
+
+class ReplicaPinMiddleware:
+    """
+    After a request that wrote to the database, pins the client's reads to the primary for
+    REPLICA_PIN_SECONDS, which should cover the replica's lag. Writes are noticed by
+    ReplicaRouter.db_for_write, which every ORM save, delete and update goes through, whatever
+    the request method (the delete link, for one, is a GET). Works in both sync (WSGI) and
+    async (ASGI) middleware chains.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Marks the instance as a coroutine function, so the handler awaits it.
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        writes = {'wrote': False}
+        token = request_writes.set(writes)
+        try:
+            response = self.get_response(request)
+        finally:
+            request_writes.reset(token)
+        return self.pin(response, writes)
+
+    async def __acall__(self, request):
+        # The views' sync_to_async threads run in a copy of this context, so they share the dict.
+        writes = {'wrote': False}
+        token = request_writes.set(writes)
+        try:
+            response = await self.get_response(request)
+        finally:
+            request_writes.reset(token)
+        return self.pin(response, writes)
+
+    def pin(self, response, writes):
+        if writes['wrote'] and REPLICA in settings.DATABASES:
+            response.set_cookie(PIN_COOKIE, str(time.time() + settings.REPLICA_PIN_SECONDS),
+                                max_age=settings.REPLICA_PIN_SECONDS, httponly=True, samesite='Lax')
+        return response
+
+
+def check_connections(**kwargs):
+    """
+    request_started receiver that closes persistent connections the server dropped while they
+    sat idle (restart, failover, idle timeout), so the request gets a new one instead of
+    failing on its first query. Only connections kept open by CONN_MAX_AGE are checked; the
+    check is a SELECT 1 on the raw connection.
+    """
+    for connection in connections.all():
+        if (connection.connection is not None and not connection.in_atomic_block
+                and not connection.is_usable()):
+            connection.close()
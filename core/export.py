@@ -0,0 +1,138 @@
+import csv
+import io
+import json
+
+from django.conf import settings
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from core.models import GameRequest
+
+FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson', 'parquet': 'application/vnd.apache.parquet'}
+
+
+def request_rows(chunk_size):
+    for row in GameRequest.objects.order_by('pk').values_list(
+            'pk', 'user_id', 'user__username', 'request_name', 'system', 'can_dm', 'travel_range',
+            'city', 'state', 'zip', 'gis_point', 'group_id').iterator(chunk_size=chunk_size):
+        point = row[10]
+        located = point is not None and point.coords != ()
+        yield row[:10] + (point.x if located else None, point.y if located else None, row[11])
+
+
+def edge_rows(chunk_size):
+    through = GameRequest.available_dms.through
+    return through.objects.order_by('from_gamerequest_id').values_list(
+        'from_gamerequest_id', 'to_gamerequest_id').iterator(chunk_size=chunk_size)
+
+
+def group_rows(chunk_size):
+    return GameRequest.objects.filter(group__isnull=False).order_by('group_id', 'pk').values_list(
+        'group_id', 'group__host_id', 'pk').iterator(chunk_size=chunk_size)
+
+
+# table -> (columns as (name, type), row generator taking the chunk size).
+TABLES = {
+    'requests': ([('id', 'int'), ('user_id', 'int'), ('username', 'str'), ('request_name', 'str'),
+                  ('system', 'str'), ('can_dm', 'bool'), ('travel_range', 'int'), ('city', 'str'),
+                  ('state', 'str'), ('zip', 'str'), ('longitude', 'float'), ('latitude', 'float'),
+                  ('group_id', 'int')], request_rows),
+    'edges': ([('player_id', 'int'), ('dm_id', 'int')], edge_rows),
+    'groups': ([('group_id', 'int'), ('host_id', 'int'), ('player_id', 'int')], group_rows),
+}
+
+
+def batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def csv_chunks(columns, rows, chunk_size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([name for name, kind in columns])
+    for batch in batches(rows, chunk_size):
+        writer.writerows(batch)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def jsonl_chunks(columns, rows, chunk_size):
+    names = [name for name, kind in columns]
+    for batch in batches(rows, chunk_size):
+        yield ''.join(json.dumps(dict(zip(names, row))) + '\n' for row in batch).encode()
+
+
+class ChunkSink(io.RawIOBase):
+    """
+    Write-only file that keeps what was written until it is drained, so the Parquet writer's
+    output can be streamed out one row group at a time.
+    """
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def parquet_chunks(columns, rows, chunk_size):
+    types = {'int': pyarrow.int64(), 'str': pyarrow.string(), 'bool': pyarrow.bool_(), 'float': pyarrow.float64()}
+    schema = pyarrow.schema([(name, types[kind]) for name, kind in columns])
+    sink = ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    for batch in batches(rows, chunk_size):
+        # One row group per batch.
+        writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(values, type=schema.field(i).type) for i, values in enumerate(zip(*batch))],
+            schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+WRITERS = {'csv': csv_chunks, 'jsonl': jsonl_chunks, 'parquet': parquet_chunks}
+
+
+def export_chunks(table, file_format, chunk_size=None):
+    """
+    Streams one table of the match data as encoded chunks of a CSV, JSONL or Parquet file:
+    requests: one row per request, with its coordinates and group;
+    edges: (player_id, dm_id) for every candidate DM link;
+    groups: (group_id, host_id, player_id) for every seated player.
+    Rows are read with iterator(chunk_size), which uses a server-side cursor on PostgreSQL, and
+    written out one chunk at a time, so memory use doesn't grow with the table.
+    Parquet needs pyarrow; each chunk becomes one row group.
+    """
+    if file_format == 'parquet' and pyarrow is None:
+        raise ImportError('The parquet export needs pyarrow installed.')
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    columns, rows = TABLES[table]
+    return WRITERS[file_format](columns, rows(chunk_size), chunk_size)
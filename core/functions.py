@@ -1,60 +1,210 @@
-from django.contrib.gis.geos import Point
-from functools import lru_cache
-from geopy.geocoders import Nominatim
-from django.core.mail import send_mail
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+from core.geocoding import get_async_geocoder, get_geocoder, get_zip_centroids
+from core.instrumentation import span, timed
+import math
 import random
+import re
 
+# Common spellings reduced to a single form so that equivalent addresses share a cache entry.
+ADDRESS_ABBREVIATIONS = {
+    'street': 'st', 'avenue': 'ave', 'av': 'ave', 'road': 'rd', 'boulevard': 'blvd',
+    'drive': 'dr', 'lane': 'ln', 'court': 'ct', 'place': 'pl', 'terrace': 'ter',
+    'highway': 'hwy', 'parkway': 'pkwy', 'circle': 'cir', 'square': 'sq', 'trail': 'trl',
+    'north': 'n', 'south': 's', 'east': 'e', 'west': 'w',
+    'northeast': 'ne', 'northwest': 'nw', 'southeast': 'se', 'southwest': 'sw',
+    # Only spellings of the same designator are merged: unit 5 and suite 5 can be different places.
+    'apartment': 'apt', 'suite': 'ste', 'saint': 'st', 'mount': 'mt',
+}
 
-@lru_cache(maxsize=512)
-def coordinates_from_api(street, city, state, zip_code):
+US_STATES = {
+    'alabama': 'al', 'alaska': 'ak', 'arizona': 'az', 'arkansas': 'ar', 'california': 'ca',
+    'colorado': 'co', 'connecticut': 'ct', 'delaware': 'de', 'district of columbia': 'dc',
+    'florida': 'fl', 'georgia': 'ga', 'hawaii': 'hi', 'idaho': 'id', 'illinois': 'il',
+    'indiana': 'in', 'iowa': 'ia', 'kansas': 'ks', 'kentucky': 'ky', 'louisiana': 'la',
+    'maine': 'me', 'maryland': 'md', 'massachusetts': 'ma', 'michigan': 'mi', 'minnesota': 'mn',
+    'mississippi': 'ms', 'missouri': 'mo', 'montana': 'mt', 'nebraska': 'ne', 'nevada': 'nv',
+    'new hampshire': 'nh', 'new jersey': 'nj', 'new mexico': 'nm', 'new york': 'ny',
+    'north carolina': 'nc', 'north dakota': 'nd', 'ohio': 'oh', 'oklahoma': 'ok', 'oregon': 'or',
+    'pennsylvania': 'pa', 'rhode island': 'ri', 'south carolina': 'sc', 'south dakota': 'sd',
+    'tennessee': 'tn', 'texas': 'tx', 'utah': 'ut', 'vermont': 'vt', 'virginia': 'va',
+    'washington': 'wa', 'west virginia': 'wv', 'wisconsin': 'wi', 'wyoming': 'wy',
+}
+
+# Per-process lookup counters for the shared geocode cache.
+geocode_cache_stats = {'hits': 0, 'misses': 0}
+
+
+def _normalize_words(text):
+    words = re.sub(r'[^a-z0-9 ]', ' ', text.lower()).split()
+    return ' '.join(ADDRESS_ABBREVIATIONS.get(word, word) for word in words)
+
+
+def normalize_address(street, city, state, zip_code):
     """
-    Get latitude/longitude coordinates for an address (for distance search).
+    Builds the geocode cache key for an address.
+    Lowercases, strips punctuation, collapses whitespace, shortens common street words
+    (Street -> st, North -> n), converts state names to their postal code and keeps only
+    the 5 digit ZIP. "123 Main Street" and "123 main st." produce the same key.
+    """
+    state = ' '.join(re.sub(r'[^a-z ]', ' ', state.lower()).split())
+    zip_digits = re.sub(r'[^0-9]', '', zip_code)[:5]
+    return '|'.join([
+        _normalize_words(street),
+        ' '.join(re.sub(r'[^a-z0-9 ]', ' ', city.lower()).split()),
+        US_STATES.get(state, state),
+        zip_digits,
+    ])
+
+
+def _address_string(street, city, state, zip_code):
+    return street + ' ' + city + ' ' + state + ' ' + zip_code
+
+
+def geocode_address(street, city, state, zip_code):
+    """
+    Get latitude/longitude coordinates for an address directly from the map API.
     Uses geopy library: https://geopy.readthedocs.io/en/stable/
     Currently uses the Nominatim API. This is a free service with
-    significant rate limitations. Making GameFinder a real product
+    significant rate limitations, so lookups go through a shared client pool
+    and a rate limiter (see core.geocoding). Making GameFinder a real product
     will require replacing Nominatim with a paid service that can
     accommodate sufficient requests per minute.
+    Returns None if the address could not be found.
     Note: Python Point object is in format (longitude, latitude) contrary to
     usual map formatting.
     """
-    geolocator = Nominatim(user_agent="GameFinder")
-    address_string = street + ' ' + city + ' ' + state + ' ' + zip_code
-    location = geolocator.geocode(address_string)
-    return Point(location.longitude, location.latitude)
+    return get_geocoder().geocode(_address_string(street, city, state, zip_code))
+
+
+@timed('coordinates_from_api')
+def coordinates_from_api(street, city, state, zip_code):
+    """
+    Get latitude/longitude coordinates for an address (for distance search).
+    Lookups go through the GeocodeCache table first, keyed on the normalized address, so the
+    result is shared by every worker process and survives restarts. Misses call the map API
+    and store the result for GEOCODE_CACHE_TTL. Addresses the API can't find are stored as
+    negative entries (no point) for GEOCODE_NEGATIVE_TTL so they aren't retried on every save.
+    Returns None if the address could not be geocoded.
+    """
+    return coordinates_for_addresses([(street, city, state, zip_code)])[(street, city, state, zip_code)]
+
+
+def read_geocode_cache(keys, now):
+    """
+    Unexpired GeocodeCache entries for the given address keys as {key: entry}, in one query.
+    Hits are only counted in this process (geocode_cache_stats, exported by the metrics view),
+    so a cache hit never writes to the shared table.
+    """
+    from core.models import GeocodeCache
+    cached = {
+        entry.address_key: entry for entry in
+        GeocodeCache.objects.filter(address_key__in=set(keys), expires__gt=now)
+    }
+    geocode_cache_stats['hits'] += len(cached)
+    return cached
+
+
+def write_geocode_cache(points, now):
+    """
+    Stores {key: Point or None} lookup results. Expired entries for these keys are replaced
+    rather than updated one by one.
+    """
+    from core.models import GeocodeCache
+    geocode_cache_stats['misses'] += len(points)
+    GeocodeCache.objects.filter(address_key__in=points.keys()).delete()
+    GeocodeCache.objects.bulk_create([
+        GeocodeCache(
+            address_key=key,
+            gis_point=point,
+            expires=now + (settings.GEOCODE_CACHE_TTL if point is not None else settings.GEOCODE_NEGATIVE_TTL)
+        ) for key, point in points.items()
+    ], ignore_conflicts=True)
+
+
+def coordinates_for_addresses(addresses):
+    """
+    Batch version of coordinates_from_api.
+    addresses: iterable of (street, city, state, zip_code) tuples.
+    Returns a dict of each address tuple to a Point or None. All cache entries are read in one
+    query, the misses are geocoded as one rate-limited batch and written back in bulk.
+    """
+    now = timezone.now()
+    keys = {address: normalize_address(*address) for address in addresses}
+    cached = read_geocode_cache(keys.values(), now)
+
+    results = {}
+    missing = {}
+    for address, key in keys.items():
+        if key in cached:
+            results[address] = cached[key].gis_point
+        else:
+            missing.setdefault(key, address)
+    if not missing:
+        return results
 
+    with span('geocode_api'):
+        found = get_geocoder().geocode_batch([_address_string(*address) for address in missing.values()])
+    points = {key: found[_address_string(*address)] for key, address in missing.items()}
+    write_geocode_cache(points, now)
+    for address, key in keys.items():
+        if key in points:
+            results[address] = points[key]
+    return results
 
-def fake_coordinates():
+
+async def coordinates_from_api_async(street, city, state, zip_code):
+    """
+    coordinates_from_api for async code. The cache is read and written on the thread pool and
+    the map API is called through the async geocoder, so the event loop is never blocked.
+    """
+    now = timezone.now()
+    key = normalize_address(street, city, state, zip_code)
+    cached = await sync_to_async(read_geocode_cache)([key], now)
+    if key in cached:
+        return cached[key].gis_point
+    with span('geocode_api'):
+        point = await get_async_geocoder().geocode(_address_string(street, city, state, zip_code))
+    await sync_to_async(write_geocode_cache)({key: point}, now)
+    return point
+
+
+def approximate_coordinates(zip_code):
+    """
+    Instant approximate coordinates for an address from the bundled ZIP code table.
+    Returns None if the ZIP code (or its 3 digit area) is unknown.
+    """
+    return get_zip_centroids().lookup(zip_code)
+
+
+def map_tile(lon, lat, zoom):
+    """
+    (x, y) of the Web Mercator ("slippy map") tile containing a point at a zoom level.
+    Latitudes beyond the Mercator limit are clamped to the edge tiles.
+    """
+    n = 2 ** zoom
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def fake_coordinates(zip_code=None):
     """
     Creates fake coordinates for testing purposes to avoid exceeding
     rate limits on the (free but limited) map API.
-    Starting point is in Port Angeles, WA. A small random shift
+    Starting point is the centroid of the given ZIP code if it is in the bundled table,
+    otherwise a random ZIP centroid, so load tests get realistic geography
+    (dense metro areas, empty areas in between). A small random shift
     is applied to both latitude and longitude and the result is returned
     as a Point object to be saved in the GameRequest.
     Note: Python Point object is in format (longitude, latitude) contrary to
     usual map formatting.
     """
-    location = Point(-123.42273912049563, 48.10649195214683)
-    lat_shift = random.uniform(-0.02, 0.02)
-    lon_shift = random.uniform(-0.02, 0.02)
-    location.y += lat_shift
-    location.x += lon_shift
+    location = approximate_coordinates(zip_code) if zip_code else None
+    if location is None:
+        return get_zip_centroids().random_point(spread=0.02)
+    location.y += random.uniform(-0.02, 0.02)
+    location.x += random.uniform(-0.02, 0.02)
     return location
-
-
-def send_email(dm, player_group):
-    """
-    Composes and sends the notification email for a DM and player group.
-    Note: uses a placeholder outgoing email address since email is configured
-    to print to console.
-    """
-    dm_email = dm.user.email
-    subject = f"Players found for {dm.request_name}!"
-    message = "Some players are available for your game!\n"
-    for players in player_group:
-        message += f"{players.user.username}      {players.user.email}\n"
-
-    send_mail(subject,
-              message,
-              'notifications@gamefinder.com',
-              [dm_email],
-              fail_silently=True)
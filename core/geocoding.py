@@ -0,0 +1,229 @@
+import asyncio
+import csv
+import queue
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from geopy.geocoders import Nominatim
+
+try:
+    from geopy.adapters import AioHTTPAdapter
+    import aiohttp  # noqa: F401 (required by AioHTTPAdapter)
+except ImportError:
+    AioHTTPAdapter = None
+
+ZIP_CENTROIDS_FILE = Path(__file__).resolve().parent / 'data' / 'zip_centroids.csv'
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter.
+    rate: tokens added per second.
+    capacity: largest burst allowed after an idle period.
+    acquire() blocks until a token is available (or returns False after timeout seconds).
+    Note: limits a single process. With several workers set GEOCODER_RATE to the
+    provider limit divided by the number of worker processes.
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """
+        acquire() for async code: waits without blocking the event loop.
+        """
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            await asyncio.sleep(wait)
+
+
+class ClientPool:
+    """
+    Fixed-size pool of reusable geocoder clients. Each client keeps its HTTP session
+    (and connections) open between lookups instead of building a new one per address.
+    """
+    def __init__(self, factory, size):
+        self._factory = factory
+        self._clients = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self.size = size
+
+    @contextmanager
+    def client(self):
+        try:
+            client = self._clients.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            client = self._factory() if create else self._clients.get()
+        try:
+            yield client
+        finally:
+            self._clients.put(client)
+
+
+class NominatimGeocoder:
+    """
+    Rate-limited geocoder backed by a pool of Nominatim clients.
+    geocode() looks up one address; geocode_batch() looks up many, skipping duplicates
+    and sharing one client for the whole batch. Results are Point objects, or None
+    for addresses the API could not find.
+    """
+    def __init__(self, rate, burst, pool_size, timeout):
+        self.limiter = TokenBucket(rate, burst)
+        self.pool = ClientPool(
+            lambda: Nominatim(user_agent="GameFinder", timeout=timeout), pool_size)
+
+    def _lookup(self, client, address_string):
+        self.limiter.acquire()
+        location = client.geocode(address_string)
+        if location is None:
+            return None
+        return Point(location.longitude, location.latitude)
+
+    def geocode(self, address_string):
+        with self.pool.client() as client:
+            return self._lookup(client, address_string)
+
+    def geocode_batch(self, address_strings):
+        results = {}
+        with self.pool.client() as client:
+            for address_string in address_strings:
+                if address_string not in results:
+                    results[address_string] = self._lookup(client, address_string)
+        return results
+
+
+@lru_cache(maxsize=None)
+def get_geocoder():
+    """
+    Shared NominatimGeocoder for this process, configured from the GEOCODER_* settings.
+    """
+    return NominatimGeocoder(
+        rate=settings.GEOCODER_RATE,
+        burst=settings.GEOCODER_BURST,
+        pool_size=settings.GEOCODER_POOL_SIZE,
+        timeout=settings.GEOCODER_TIMEOUT,
+    )
+
+
+class AsyncNominatimGeocoder:
+    """
+    Non-blocking geocoder for async views.
+    Uses a single Nominatim client on geopy's aiohttp adapter when aiohttp is installed.
+    Otherwise lookups run on the thread pool of the blocking NominatimGeocoder, so they still
+    don't hold up the event loop. Either way at most `concurrency` lookups are in flight and they
+    share the rate limit of the process's blocking geocoder.
+    """
+    def __init__(self, geocoder, concurrency, timeout):
+        self.geocoder = geocoder
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._semaphore = None
+        self._client = None
+
+    async def _aio_client(self):
+        if self._client is None:
+            client = Nominatim(user_agent="GameFinder", timeout=self.timeout, adapter_factory=AioHTTPAdapter)
+            await client.__aenter__()
+            self._client = client
+        return self._client
+
+    async def geocode(self, address_string):
+        # Created on first use so it belongs to the server's event loop.
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            if AioHTTPAdapter is None:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(None, self.geocoder.geocode, address_string)
+            client = await self._aio_client()
+            await self.geocoder.limiter.acquire_async()
+            location = await client.geocode(address_string)
+            if location is None:
+                return None
+            return Point(location.longitude, location.latitude)
+
+
+@lru_cache(maxsize=None)
+def get_async_geocoder():
+    """
+    Shared AsyncNominatimGeocoder for this process (GEOCODER_ASYNC_CONCURRENCY lookups at a time).
+    """
+    return AsyncNominatimGeocoder(get_geocoder(), settings.GEOCODER_ASYNC_CONCURRENCY, settings.GEOCODER_TIMEOUT)
+
+
+class ZipCentroids:
+    """
+    Offline ZIP code to approximate coordinates lookup from the bundled zip_centroids.csv.
+    Exact 5 digit matches return that ZIP's centroid. Otherwise the average of the known ZIPs
+    sharing the first three digits (the sectional center) is used. Unknown areas return None.
+    """
+    def __init__(self, path=ZIP_CENTROIDS_FILE):
+        self.centroids = {}
+        prefixes = {}
+        with open(path, newline='') as f:
+            for row in csv.DictReader(f):
+                point = (float(row['longitude']), float(row['latitude']))
+                self.centroids[row['zip']] = point
+                prefixes.setdefault(row['zip'][:3], []).append(point)
+        self.prefixes = {
+            prefix: (sum(p[0] for p in points) / len(points), sum(p[1] for p in points) / len(points))
+            for prefix, points in prefixes.items()
+        }
+
+    def lookup(self, zip_code):
+        zip_code = re.sub(r'[^0-9]', '', zip_code or '')[:5]
+        coords = self.centroids.get(zip_code) or self.prefixes.get(zip_code[:3])
+        if coords is None:
+            return None
+        return Point(*coords)
+
+    def random_point(self, spread=0.05):
+        """
+        Random point near a random known ZIP centroid, for load testing with realistic geography.
+        spread: maximum shift in degrees applied to both latitude and longitude.
+        """
+        lon, lat = random.choice(list(self.centroids.values()))
+        return Point(lon + random.uniform(-spread, spread), lat + random.uniform(-spread, spread))
+
+
+@lru_cache(maxsize=None)
+def get_zip_centroids():
+    return ZipCentroids()
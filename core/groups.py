@@ -0,0 +1,333 @@
+import time
+from collections import deque
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from core.models import GROUP_SIZE, GameGroup, GameRequest
+from core.notifications import queue_notifications, send_due_notifications
+
+
+# Components with at most this many possible hosts are searched exhaustively for the largest
+# set of tables. Above it the matching heuristic's answer is used as is.
+EXACT_SEARCH_HOSTS = 16
+
+
+def solve_groups(edges, table_size, max_table=None, current=None, deadline=None):
+    """
+    Assigns players to DMs/hosts without overlap, trying to maximize the number of complete tables.
+    edges: iterable of (player_id, dm_id) links. Self links are ignored.
+    table_size: players (not counting the host) a table needs to run.
+    max_table: players a table can take once complete (default table_size). Leftover players
+        are added to adjacent complete tables up to this size.
+    current: optional {player_id: host_id} from the previous solve. Still-valid assignments are
+        kept as the starting point so groups don't churn between runs.
+    deadline: time.monotonic() value after which the search settles for the quickest answer.
+    Every request is used at most once, either as a host or as a player.
+
+    Packing tables this way is NP-hard in general, so the answer is exact only for small graphs:
+    the heuristic (see seat_players) runs first, and if there are at most EXACT_SEARCH_HOSTS
+    possible hosts, best_hosts then looks for a larger set of tables. Larger graphs get the
+    heuristic's answer, which can be a table or two short of the best.
+    Returns {host_id: [player ids]} for the complete tables.
+    """
+    max_table = max(max_table or table_size, table_size)
+    neighbours = {}  # player -> set of hosts
+    players_of = {}  # host -> set of players
+    for player, host in edges:
+        if player == host:
+            continue
+        neighbours.setdefault(player, set()).add(host)
+        players_of.setdefault(host, set()).add(player)
+
+    candidates = {host for host, players in players_of.items() if len(players) >= table_size}
+    assigned = seat_players(neighbours, players_of, candidates, table_size, current, deadline)
+    if len(candidates) <= EXACT_SEARCH_HOSTS and (deadline is None or time.monotonic() < deadline):
+        hosts = best_hosts(neighbours, players_of, candidates, table_size, len(assigned), deadline)
+        if hosts is not None:
+            assigned = seat_players(neighbours, players_of, hosts, table_size, current, deadline)
+
+    # Seat leftover players at complete tables that still have room.
+    owner = {player: host for host, players in assigned.items() for player in players}
+    for player, hosts in neighbours.items():
+        if player in assigned or player in owner:
+            continue
+        for host in sorted(hosts & assigned.keys(), key=lambda h: len(assigned[h])):
+            if len(assigned[host]) < max_table:
+                assigned[host].add(player)
+                owner[player] = host
+                break
+
+    return {host: sorted(players) for host, players in assigned.items()}
+
+
+def seat_players(neighbours, players_of, hosts, table_size, current=None, deadline=None):
+    """
+    Heuristic part of solve_groups. Runs a capacitated bipartite matching (augmenting paths,
+    capacity table_size per host) with all the given hosts active. Hosts that can't be filled
+    are dropped one at a time, fewest players first, and become available as players for the
+    remaining hosts. The matching is then re-augmented from its previous state. Past the
+    deadline all unfilled hosts are dropped at once.
+    For a fixed set of hosts the matching is maximum, so a set of hosts that can all be filled
+    at once keeps every one of them.
+    Returns {host_id: set of players} with every table at table_size.
+    """
+    active = set(hosts)
+    assigned = {host: set() for host in active}
+    owner = {}
+
+    for player, host in (current or {}).items():
+        if (host in active and player not in active and host in neighbours.get(player, ())
+                and len(assigned[host]) < table_size):
+            assigned[host].add(player)
+            owner[player] = host
+
+    # Hosts explored by searches that failed since the matching last changed. Every seat
+    # reachable from them is taken, so later searches can skip them until something moves.
+    dead = set()
+
+    def augment(start):
+        """
+        Breadth-first search for a chain of moves that frees a seat for `start`.
+        """
+        parent = {}  # host -> player that would take its seat
+        seen_players = {start}
+        queue = deque([start])
+        while queue:
+            player = queue.popleft()
+            for host in neighbours.get(player, ()):
+                if host not in active or host in parent or host in dead or host == owner.get(player):
+                    continue
+                parent[host] = player
+                if len(assigned[host]) < table_size:
+                    # Walk back along the chain, moving each player to the next host.
+                    while True:
+                        mover = parent[host]
+                        previous = owner.get(mover)
+                        if previous is not None:
+                            assigned[previous].discard(mover)
+                        assigned[host].add(mover)
+                        owner[mover] = host
+                        if mover == start:
+                            dead.clear()
+                            return True
+                        host = previous
+                for other in assigned[host]:
+                    if other not in seen_players:
+                        seen_players.add(other)
+                        queue.append(other)
+        dead.update(parent)
+        return False
+
+    # A player with no augmenting path keeps having none: dropping a host only removes seats.
+    # Only players freed by a drop (and the dropped host itself) need another search.
+    pending = [player for player in neighbours if player not in active and player not in owner]
+    while True:
+        # Cheap direct seating first; the searches only handle what is left.
+        for player in pending:
+            for host in neighbours[player]:
+                if host in active and len(assigned[host]) < table_size:
+                    assigned[host].add(player)
+                    owner[player] = host
+                    break
+        for player in pending:
+            if deadline is not None and time.monotonic() > deadline:
+                break
+            if player not in owner:
+                augment(player)
+        pending = []
+        unfilled = [host for host in active if len(assigned[host]) < table_size]
+        if not unfilled:
+            break
+        if deadline is not None and time.monotonic() > deadline:
+            dropped = unfilled
+        else:
+            dropped = [min(unfilled, key=lambda h: (len(assigned[h]), len(players_of[h]), h))]
+        for host in dropped:
+            for player in assigned.pop(host):
+                del owner[player]
+                pending.append(player)
+            active.discard(host)
+            if host in neighbours:
+                pending.append(host)
+    return assigned
+
+
+def can_fill(neighbours, hosts, table_size):
+    """
+    Whether every one of the hosts can get table_size players at once, none of them a host.
+    """
+    seats = {host: [] for host in hosts}
+    players = [player for player, options in neighbours.items() if player not in seats and options & seats.keys()]
+    if len(players) < len(seats) * table_size:
+        return False
+
+    def augment(player, seen):
+        for host in neighbours[player] & seats.keys():
+            if host in seen:
+                continue
+            seen.add(host)
+            if len(seats[host]) < table_size:
+                seats[host].append(player)
+                return True
+            for other in seats[host]:
+                # Move a seated player elsewhere to make room.
+                if augment(other, seen):
+                    seats[host].remove(other)
+                    seats[host].append(player)
+                    return True
+        return False
+
+    for player in players:
+        augment(player, set())
+    return all(len(seated) == table_size for seated in seats.values())
+
+
+def best_hosts(neighbours, players_of, candidates, table_size, at_least, deadline=None):
+    """
+    Exhaustive search for the largest set of candidate hosts that can all be filled at once.
+    A fillable set stays fillable when a host is removed (its players keep their seats and it
+    is free to play), so a branch is cut as soon as adding a host makes the set unfillable, or
+    once it can no longer beat the best set found. A table needs table_size + 1 requests, which
+    caps the number of tables.
+    Returns a set of more than at_least hosts, or None if there is none or the deadline passes
+    before one is found.
+    """
+    order = sorted(candidates, key=lambda h: (-len(players_of[h]), h))
+    cap = len(neighbours.keys() | players_of.keys()) // (table_size + 1)
+    best = {'hosts': None, 'size': at_least}
+
+    def search(start, chosen):
+        if len(chosen) > best['size']:
+            best['hosts'], best['size'] = set(chosen), len(chosen)
+        if len(chosen) >= cap or (deadline is not None and time.monotonic() > deadline):
+            return
+        for i in range(start, len(order)):
+            if len(chosen) + len(order) - i <= best['size']:
+                return
+            chosen.append(order[i])
+            if can_fill(neighbours, chosen, table_size):
+                search(i + 1, chosen)
+            chosen.pop()
+
+    search(0, [])
+    return best['hosts']
+
+
+def load_component(seed_ids, limit, depth=None):
+    """
+    Breadth-first walk of the player/DM graph from the seed requests, following both
+    available_dms links and current group memberships, until the whole connected component
+    is loaded, it reaches `limit` requests or the walk is `depth` steps from the seeds.
+    Returns (nodes, edges, unexpanded): the request ids, the (player_id, dm_id) links between
+    them, and the requests found in the last step of a walk that was cut short (empty if the
+    component was loaded in full). The links and group members of unexpanded requests haven't
+    been read, so only their links to expanded requests are known.
+    """
+    through = GameRequest.available_dms.through
+    nodes = set(seed_ids)
+    frontier = set(seed_ids)
+    edges = set()
+    steps = 0
+    while frontier:
+        if len(nodes) >= limit or (depth is not None and steps >= depth):
+            return nodes, edges, frontier
+        found = set()
+        for player, dm in through.objects.filter(
+                Q(from_gamerequest_id__in=frontier) | Q(to_gamerequest_id__in=frontier)
+        ).values_list('from_gamerequest_id', 'to_gamerequest_id'):
+            edges.add((player, dm))
+            found.update((player, dm))
+        for player, host in GameRequest.objects.filter(
+                Q(pk__in=frontier) | Q(group__host_id__in=frontier), group__isnull=False
+        ).values_list('pk', 'group__host_id'):
+            found.update((player, host))
+        frontier = found - nodes
+        nodes |= frontier
+        steps += 1
+    return nodes, edges, set()
+
+
+def update_groups(seed_ids, notify=True, depth=None):
+    """
+    Re-solves the groups of the graph around the seed requests and stores the result: new
+    tables get a GameGroup, dissolved ones are deleted and moved players are updated in one
+    bulk update. Groups that reach outside a truncated component are left as they are.
+    depth: only load the graph this many links out from the seeds (see load_component).
+    If notify is set, the changes are passed to notify_groups.
+    Runs in a transaction with the component's request rows locked.
+    Returns {host_id: [player ids]} for the tables that changed (empty list = dissolved).
+    """
+    with transaction.atomic():
+        return _update_groups(seed_ids, notify, depth)
+
+
+def _update_groups(seed_ids, notify, depth):
+    nodes, edges, unexpanded = load_component(seed_ids, settings.GROUP_COMPONENT_LIMIT, depth)
+    # Lock the component's requests (in id order, so concurrent solves can't deadlock) before
+    # reading their groups. Solves of overlapping components run one after the other, so no
+    # request is ever seated at two tables.
+    current = {
+        pk: host for pk, host in GameRequest.objects.select_for_update(of=('self',)).filter(
+            Q(pk__in=nodes) | Q(group__host_id__in=nodes)
+        ).order_by('pk').values_list('pk', 'group__host_id') if host is not None
+    }
+    hosting = set(GameGroup.objects.filter(host_id__in=nodes).values_list('host_id', flat=True))
+
+    solving = set(nodes)
+    if unexpanded:
+        # Freeze any group with a member outside the loaded part of the graph, or whose host
+        # wasn't expanded: its players' links to the host may not have been loaded, so the
+        # table would look broken.
+        members = {}
+        for player, host in current.items():
+            members.setdefault(host, set()).add(player)
+        for host, players in members.items():
+            if host not in nodes or host in unexpanded or not players <= nodes:
+                solving -= players | {host}
+    current = {player: host for player, host in current.items() if player in solving and host in solving}
+    edges = [(p, d) for p, d in edges if p in solving and d in solving]
+
+    deadline = time.monotonic() + settings.GROUP_SOLVER_TIME_BUDGET
+    tables = solve_groups(edges, GROUP_SIZE - 1, settings.MAX_TABLE_PLAYERS, current, deadline)
+
+    old_tables = {}
+    for player, host in current.items():
+        old_tables.setdefault(host, set()).add(player)
+    changed = {
+        host: players for host, players in tables.items() if set(players) != old_tables.get(host, set())
+    }
+    dissolved = [host for host in (hosting & solving) if host not in tables]
+    changed.update({host: [] for host in dissolved})
+    if not changed:
+        return changed
+
+    if dissolved:
+        GameGroup.objects.filter(host_id__in=dissolved).delete()
+    GameGroup.objects.bulk_create(
+        [GameGroup(host_id=host) for host in tables if host not in hosting], ignore_conflicts=True)
+    group_ids = dict(GameGroup.objects.filter(host_id__in=tables.keys()).values_list('host_id', 'pk'))
+    new_owner = {player: host for host, players in tables.items() for player in players}
+    moved = [
+        GameRequest(pk=player, group_id=group_ids[new_owner[player]] if player in new_owner else None)
+        for player in solving
+        if new_owner.get(player) != current.get(player) and (player in new_owner or player in current)
+    ]
+    if moved:
+        GameRequest.objects.bulk_update(moved, ['group'], batch_size=1000)
+
+    if notify:
+        notify_groups(changed)
+    return changed
+
+
+def notify_groups(tables):
+    """
+    Queues the group email for each host in {host_id: [player ids]} (see core.notifications).
+    Without the job queue the due emails are sent as soon as the transaction commits; otherwise
+    the run_jobs worker sends them as digests.
+    """
+    if queue_notifications(tables) and not settings.USE_JOB_QUEUE:
+        # Sent once the transaction commits, so no locks are held while talking to the mail server.
+        transaction.on_commit(send_due_notifications)
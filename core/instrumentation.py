@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the latency histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Spans recorded during the current request, as (name, seconds) tuples. None outside a request.
+current_spans = ContextVar('current_spans', default=None)
+# QueryCounter of the current request. None outside a request.
+current_queries = ContextVar('current_queries', default=None)
+
+
+class Histogram:
+    """
+    Prometheus-style histogram. buckets[i] counts observations <= BUCKETS[i] (cumulative).
+    """
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+
+
+class Metrics:
+    """
+    Process-wide metrics store. Each worker process keeps its own numbers, so a Prometheus
+    scrape sees the worker that served it. Label it by instance (or run one worker per
+    scrape target) when aggregating.
+    histograms: {(metric name, label value): Histogram}
+    totals: {(metric name, label value): float}, monotonically increasing sums.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.totals = {}
+
+    def observe(self, name, label, value):
+        with self._lock:
+            self.histograms.setdefault((name, label), Histogram()).observe(value)
+
+    def add(self, name, label, value):
+        with self._lock:
+            self.totals[(name, label)] = self.totals.get((name, label), 0) + value
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.totals = {}
+
+
+metrics = Metrics()
+
+# Metric name: (label name, type, help text)
+METRIC_INFO = {
+    'gamefinder_request_duration_seconds': ('view', 'histogram', 'Total request latency by view.'),
+    'gamefinder_span_duration_seconds': ('span', 'histogram', 'Duration of named code sections.'),
+    'gamefinder_request_queries_total': ('view', 'counter', 'Database queries run by view.'),
+    'gamefinder_request_db_seconds_total': ('view', 'counter', 'Time spent in database queries by view.'),
+    'gamefinder_geocode_cache_lookups_total': ('result', 'counter', 'Geocode cache lookups in this process.'),
+}
+
+
+@contextmanager
+def span(name):
+    """
+    Times a named section of code. The duration is added to the span histogram and, inside a
+    request, to the request's span list for the slow-request log.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe('gamefinder_span_duration_seconds', name, elapsed)
+        spans = current_spans.get()
+        if spans is not None:
+            spans.append((name, elapsed))
+
+
+def timed(name):
+    """
+    Decorator version of span().
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class QueryCounter:
+    """
+    Database execute wrapper counting queries and the time spent in them.
+    """
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - start
+
+
+def count_queries(execute, sql, params, many, context):
+    """
+    Execute wrapper installed on every connection (see install_query_counter). Passes the query
+    to the current request's QueryCounter, if any. Going through a context variable rather than
+    wrapping a connection for the length of the request means the queries are counted in
+    whatever thread runs them, including the sync_to_async threads of async requests.
+    """
+    counter = current_queries.get()
+    if counter is None:
+        return execute(sql, params, many, context)
+    return counter(execute, sql, params, many, context)
+
+
+def install_query_counter(connection, **kwargs):
+    """
+    connection_created receiver adding count_queries to the new connection's execute wrappers.
+    """
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_queries)
+
+
+class InstrumentationMiddleware:
+    """
+    Records total latency, query count and database time (over every database alias) for every
+    request, labelled by the resolved view name. Requests slower than settings.SLOW_REQUEST_THRESHOLD (seconds) are logged
+    with the breakdown of the named spans (geocoding, DM queries, fan-out, emails) they ran.
+    Works in both sync (WSGI) and async (ASGI) middleware chains.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Marks the instance as a coroutine function, so the handler awaits it.
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        counter, tokens, start = self.start()
+        try:
+            return self.get_response(request)
+        finally:
+            self.finish(request, counter, tokens, start)
+
+    async def __acall__(self, request):
+        counter, tokens, start = self.start()
+        try:
+            return await self.get_response(request)
+        finally:
+            self.finish(request, counter, tokens, start)
+
+    def start(self):
+        counter = QueryCounter()
+        tokens = current_queries.set(counter), current_spans.set([])
+        return counter, tokens, time.perf_counter()
+
+    def finish(self, request, counter, tokens, start):
+        elapsed = time.perf_counter() - start
+        spans = current_spans.get()
+        current_queries.reset(tokens[0])
+        current_spans.reset(tokens[1])
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unresolved'
+        metrics.observe('gamefinder_request_duration_seconds', view, elapsed)
+        metrics.add('gamefinder_request_queries_total', view, counter.count)
+        metrics.add('gamefinder_request_db_seconds_total', view, counter.seconds)
+        if elapsed >= settings.SLOW_REQUEST_THRESHOLD:
+            breakdown = ', '.join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in spans)
+            logger.warning(
+                "Slow request %s %s (%s): %.1fms, %s queries, %.1fms in database. Spans: %s",
+                request.method, request.path, view, elapsed * 1000, counter.count,
+                counter.seconds * 1000, breakdown or 'none')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus():
+    """
+    Current metrics in the Prometheus text exposition format (version 0.0.4).
+    """
+    from core.functions import geocode_cache_stats
+    lines = []
+    with metrics._lock:
+        metrics.totals[('gamefinder_geocode_cache_lookups_total', 'hit')] = geocode_cache_stats['hits']
+        metrics.totals[('gamefinder_geocode_cache_lookups_total', 'miss')] = geocode_cache_stats['misses']
+        for name, (label, kind, help_text) in METRIC_INFO.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'histogram':
+                for (metric, value), histogram in sorted(metrics.histograms.items()):
+                    if metric != name:
+                        continue
+                    labels = f'{label}="{_escape(value)}"'
+                    # Bucket counts are already cumulative (see Histogram.observe).
+                    for bound, count in zip(BUCKETS, histogram.buckets):
+                        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+                    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                    lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+                    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+            else:
+                for (metric, value), total in sorted(metrics.totals.items()):
+                    if metric == name:
+                        lines.append(f'{name}{{{label}="{_escape(value)}"}} {total}')
+    return '\n'.join(lines) + '\n'
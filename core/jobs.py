@@ -0,0 +1,131 @@
+import logging
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from core.functions import coordinates_for_addresses
+from core.matching import get_matching_engine
+from core.models import GameRequest, MatchJob, locate_request, match_request, record_demand
+
+logger = logging.getLogger(__name__)
+
+
+def retry_delay(attempts):
+    """
+    Exponential backoff for a job that has failed `attempts` times, capped at JOB_MAX_RETRY_DELAY.
+    """
+    delay = settings.JOB_RETRY_DELAY * (2 ** (attempts - 1))
+    return min(delay, settings.JOB_MAX_RETRY_DELAY)
+
+
+def claim_jobs(batch_size):
+    """
+    Claims up to batch_size due jobs for this worker.
+    Rows are locked with SKIP LOCKED so concurrent workers never claim the same job, then leased
+    by pushing run_after forward by JOB_LEASE. If the worker dies the lease runs out and
+    another worker picks the job up again.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        jobs = list(MatchJob.objects.select_for_update(skip_locked=True).filter(
+            run_after__lte=now).order_by('run_after')[:batch_size])
+        MatchJob.objects.filter(pk__in=[job.pk for job in jobs]).update(
+            run_after=now + settings.JOB_LEASE, attempts=F('attempts') + 1)
+    for job in jobs:
+        job.attempts += 1
+    return jobs
+
+
+def claim_request_job(game_request_id):
+    """
+    Claims the job of one request, if it exists and no worker holds it. Used to run a request's
+    job right away (see views.submit_async) without waiting for the next worker poll.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        job = MatchJob.objects.select_for_update(skip_locked=True).filter(
+            game_request_id=game_request_id, run_after__lte=now).first()
+        if job is None:
+            return None
+        MatchJob.objects.filter(pk=job.pk).update(
+            run_after=now + settings.JOB_LEASE, attempts=F('attempts') + 1)
+    job.attempts += 1
+    return job
+
+
+def run_job(job):
+    """
+    Does the work for one job: geocode the address if needed, then match.
+    Coordinates are written with update() so no post_save fires and no new job is queued; the
+    demand counts are moved by hand.
+    """
+    try:
+        instance = GameRequest.objects.get(pk=job.game_request_id)
+    except GameRequest.DoesNotExist:
+        return
+    old_point = instance.gis_point
+    if job.geocode and locate_request(instance):
+        GameRequest.objects.filter(pk=instance.pk).update(gis_point=instance.gis_point)
+        record_demand(instance)
+        get_matching_engine().request_saved(instance)
+    match_request(instance, old_point=old_point)
+
+
+def process_job(job):
+    """
+    Runs a claimed job. On success the job is deleted unless it was re-queued while running, in
+    which case its lease is ended so the next poll runs it again. On failure it is rescheduled
+    with backoff, or dropped after JOB_MAX_ATTEMPTS unless it was re-queued.
+    Returns True on success.
+    """
+    current = MatchJob.objects.filter(pk=job.pk, version=job.version)
+    # The job's row whatever its version.
+    row = MatchJob.objects.filter(pk=job.pk)
+    try:
+        run_job(job)
+    except Exception:
+        error = traceback.format_exc()
+        if job.attempts >= settings.JOB_MAX_ATTEMPTS and current.delete()[0]:
+            logger.error("Dropping %s after %s attempts:\n%s", job, job.attempts, error)
+        else:
+            logger.warning("Job %s failed (attempt %s), retrying:\n%s", job, job.attempts, error)
+            row.update(run_after=timezone.now() + retry_delay(job.attempts), last_error=error)
+        return False
+    if not current.delete()[0]:
+        row.update(run_after=timezone.now())
+    return True
+
+
+def process_due_jobs(batch_size=50):
+    """
+    Claims and runs one batch of due jobs. Returns the number of jobs claimed.
+    When the map API is enabled, the addresses of every geocode job in the batch are looked up
+    together first so the individual jobs are served from the geocode cache.
+    """
+    jobs = claim_jobs(batch_size)
+    geocode_ids = [job.game_request_id for job in jobs if job.geocode]
+    if settings.USE_GEOPY_API and geocode_ids:
+        addresses = GameRequest.objects.filter(pk__in=geocode_ids).values_list('address', 'city', 'state', 'zip')
+        try:
+            coordinates_for_addresses(list(addresses))
+        except Exception:
+            # Individual jobs retry on their own with backoff.
+            logger.exception("Batch geocode failed")
+    for job in jobs:
+        process_job(job)
+    return len(jobs)
+
+
+def process_request_job(game_request_id):
+    """
+    Claims and runs the job of one request. Returns False if there was no job to claim.
+    """
+    job = claim_request_job(game_request_id)
+    if job is None:
+        return False
+    process_job(job)
+    return True
@@ -0,0 +1,66 @@
+import math
+import zlib
+
+from django.conf import settings
+from django.db import connection
+
+from core.matching import FANOUT_RANGE, search_box
+
+
+def tile_key(system, tile_x, tile_y):
+    """
+    64 bit advisory lock key for one (system, tile): a hash of the system in the high half and the
+    tile coordinates in the low half.
+    """
+    key = (zlib.crc32(system.encode()) << 32) | ((tile_x & 0xffff) << 16) | (tile_y & 0xffff)
+    # PostgreSQL advisory lock keys are signed bigints.
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+
+def region_tiles(lon, lat, radius, tile_size):
+    """
+    (tile_x, tile_y) of every tile overlapping the bounding box of a radius (miles) around a point.
+    """
+    lon0, lat0, lon1, lat1 = search_box(lon, lat, radius)
+    x0, x1 = math.floor(lon0 / tile_size), math.floor(lon1 / tile_size)
+    y0, y1 = math.floor(lat0 / tile_size), math.floor(lat1 / tile_size)
+    return {(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)}
+
+
+def lock_match_region(request, old_point=None):
+    """
+    Takes the transaction-level advisory locks that make matching a request safe to run next to
+    other submits. Must be called inside a transaction; the locks are held until it ends.
+    Tiles are MATCH_LOCK_TILE_SIZE degrees square, per system:
+    * exclusive locks on the tiles of the request's current and previous point, which are
+        what other requests' searches read;
+    * shared locks on the rest of the tiles its own search covers (its travel range, or
+        FANOUT_RANGE for a DM).
+    Any two requests that could link to each other (one inside the other's search) conflict on
+    a tile and run one after the other, so neither misses the other's committed point. Requests
+    far apart, or in different systems, don't wait for each other. Locks are taken in key order
+    in a single statement, so they can't deadlock among themselves.
+    No-op on databases without advisory locks.
+    """
+    if connection.vendor != 'postgresql':
+        return
+    tile_size = settings.MATCH_LOCK_TILE_SIZE
+    exclusive = set()
+    shared = set()
+    for point in (old_point, request.gis_point):
+        if point is not None and point.coords != ():
+            exclusive.add((math.floor(point.x / tile_size), math.floor(point.y / tile_size)))
+            radius = FANOUT_RANGE if request.can_dm else min(request.travel_range, FANOUT_RANGE)
+            shared |= region_tiles(point.x, point.y, radius, tile_size)
+    locks = {tile_key(request.system, *tile): True for tile in exclusive}
+    for tile in shared - exclusive:
+        locks.setdefault(tile_key(request.system, *tile), False)
+    if not locks:
+        return
+    keys = sorted(locks)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT CASE WHEN x THEN pg_advisory_xact_lock(k) ELSE pg_advisory_xact_lock_shared(k) END "
+            "FROM unnest(%s::bigint[], %s::boolean[]) AS t(k, x)",
+            [keys, [locks[key] for key in keys]]
+        )
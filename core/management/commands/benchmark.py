@@ -0,0 +1,171 @@
+import json
+import statistics
+import subprocess
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from core.matching import get_matching_engine
+from core.models import GameRequest, link_pairs
+from core.rematch import find_partitions, rematch_partition
+from core.synthetic import create_population
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=settings.BASE_DIR).stdout.strip() or None
+    except OSError:
+        return None
+
+
+class Command(BaseCommand):
+    """
+    Benchmarks the save/match hot path against synthetic populations.
+    For each population size a population clustered around real city centres is created with
+    bulk_create and linked, then each scenario is timed with wall time and query count:
+    * player_submit: a new player request in the densest area.
+    * dm_submit: a new DM request in the densest area (DM fan-out).
+    * update: an existing request changes its travel range.
+    * delete: the DM with the most linked players is deleted.
+    * rematch: a full serial rebuild of all links (see the rematch command).
+    Geocoding uses fake coordinates so no network access is needed, emails go to the locmem
+    backend, and the matching engine defaults to the in-memory stand-in. Everything runs in a
+    transaction that is rolled back, so the database is left unchanged.
+    Results are written as JSON so runs can be compared across commits.
+    """
+    help = 'Benchmark GameRequest save/match performance on synthetic populations.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,5000', help='Comma separated population sizes.')
+        parser.add_argument('--dm-ratio', type=float, default=0.2)
+        parser.add_argument('--cities', type=int, default=10)
+        parser.add_argument('--spread', type=float, default=15.0,
+                            help='Standard deviation of distance from city centres in miles.')
+        parser.add_argument('--min-range', type=int, default=5)
+        parser.add_argument('--max-range', type=int, default=50)
+        parser.add_argument('--system', action='append', default=None,
+                            help='Limit the population to this system (may be repeated).')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs per scenario (median is reported).')
+        parser.add_argument('--engine', default='core.matching.InMemoryMatchingEngine',
+                            help='Matching engine path.')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--output', default='benchmark.json')
+
+    def handle(self, *args, **options):
+        overrides = {
+            'USE_GEOPY_API': False,
+            'USE_FAKE_COORDINATES': True,
+            'USE_JOB_QUEUE': False,
+            'USE_ZIP_CENTROIDS': True,
+            'EMAIL_BACKEND': 'django.core.mail.backends.locmem.EmailBackend',
+            'MATCHING_ENGINE': options['engine'],
+        }
+        results = []
+        with override_settings(**overrides):
+            get_matching_engine.cache_clear()
+            try:
+                for size in [int(size) for size in options['sizes'].split(',')]:
+                    results.extend(self.run_size(size, options))
+            finally:
+                get_matching_engine.cache_clear()
+
+        report = {
+            'commit': git_commit(),
+            'timestamp': timezone.now().isoformat(),
+            'engine': options['engine'],
+            'options': {key: options[key] for key in (
+                'dm_ratio', 'cities', 'spread', 'min_range', 'max_range', 'system', 'repeat', 'seed')},
+            'results': results,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {len(results)} results to {options['output']}."))
+
+    def run_size(self, size, options):
+        results = []
+        with transaction.atomic():
+            setup_start = time.perf_counter()
+            population = create_population(
+                size, dm_ratio=options['dm_ratio'], systems=options['system'],
+                travel_ranges=(options['min_range'], options['max_range']),
+                cities=options['cities'], spread=options['spread'], seed=options['seed'],
+                prefix=f"bench{size}")
+            engine = get_matching_engine()
+            engine.reset()
+            link_pairs(engine.match_pairs(population))
+            self.stdout.write(f"Population of {size} created in {time.perf_counter() - setup_start:.1f}s.")
+
+            # The densest area is the ZIP code with the most requests in the most common system.
+            system, _ = Counter(r.system for r in population).most_common(1)[0]
+            dense_zip, _ = Counter(r.zip for r in population if r.system == system).most_common(1)[0]
+            through = GameRequest.available_dms.through
+            busiest_dm = Counter(through.objects.filter(
+                to_gamerequest__system=system).values_list('to_gamerequest_id', flat=True)).most_common(1)
+            existing = population[0]
+            user = existing.user
+
+            def submit(can_dm):
+                def run():
+                    GameRequest(user=user, request_name='benchmark', system=system, can_dm=can_dm,
+                                travel_range=options['max_range'], address='1 Main St', city='',
+                                state='', zip=dense_zip).save()
+                # Each user has at most one request per system.
+                GameRequest.objects.filter(user=user, system=system).delete()
+                return run
+
+            def update():
+                request = GameRequest.objects.get(pk=existing.pk)
+                request.travel_range += 1
+                return request.save
+
+            def delete():
+                request = GameRequest.objects.get(pk=busiest_dm[0][0]) if busiest_dm else existing
+                return request.delete
+
+            def rematch():
+                partitions = find_partitions(5.0, options['system'])
+                return lambda: [rematch_partition(*partition[:3], 5.0, partition[3], False)
+                                for partition in partitions]
+
+            scenarios = [('player_submit', lambda: submit(False)), ('dm_submit', lambda: submit(True)),
+                         ('update', update), ('delete', delete), ('rematch', rematch)]
+            for name, prepare in scenarios:
+                results.append(self.measure(size, name, prepare, options['repeat']))
+            transaction.set_rollback(True)
+        get_matching_engine().reset()
+        return results
+
+    def measure(self, size, name, prepare, repeat):
+        """
+        Runs a scenario `repeat` times, each inside a rolled back savepoint so every run starts from
+        the same population. prepare() does any setup and returns the callable that is timed.
+        """
+        timings, queries = [], []
+        engine = get_matching_engine()
+        for _ in range(repeat):
+            with transaction.atomic():
+                run = prepare()
+                # Reload the engine's index outside the timed section.
+                engine.reset()
+                engine.candidate_dms(GameRequest.objects.exclude(gis_point=None).first())
+                with CaptureQueriesContext(connection) as context:
+                    start = time.perf_counter()
+                    run()
+                    timings.append(time.perf_counter() - start)
+                queries.append(len(context.captured_queries))
+                transaction.set_rollback(True)
+        result = {
+            'size': size,
+            'scenario': name,
+            'seconds': statistics.median(timings),
+            'min_seconds': min(timings),
+            'queries': int(statistics.median(queries)),
+        }
+        self.stdout.write(f"{size:>8} {name:<14} {result['seconds'] * 1000:9.1f} ms {result['queries']:6} queries")
+        return result
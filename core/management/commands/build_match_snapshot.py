@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.snapshot import MatchSnapshot
+
+
+class Command(BaseCommand):
+    """
+    Writes a fresh columnar match snapshot (core.snapshot) from the database and folds the
+    changes logged since the last one into it. Processes using SnapshotMatchingEngine switch to
+    it on their next lookup. Intended to be run periodically (e.g. hourly from cron).
+    """
+    help = 'Rebuild the shared match snapshot used by SnapshotMatchingEngine.'
+
+    def handle(self, *args, **options):
+        rows = MatchSnapshot(settings.MATCH_SNAPSHOT_DIR).rebuild()
+        self.stdout.write(f"Wrote a match snapshot of {rows} requests to {settings.MATCH_SNAPSHOT_DIR}.")
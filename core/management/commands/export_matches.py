@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.export import FORMATS, TABLES, export_chunks
+
+
+class Command(BaseCommand):
+    """
+    Dumps requests, candidate DM links or groups for offline analysis (see core.export).
+    Rows are streamed from the database and written as they arrive, so the table size doesn't
+    affect memory use. The same exports are available to staff at /export/<table>.
+    """
+    help = 'Export requests, DM candidate edges or groups as CSV, JSONL or Parquet.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('table', choices=sorted(TABLES))
+        parser.add_argument('--format', choices=sorted(FORMATS), default='csv')
+        parser.add_argument('--output', default=None,
+                            help='File to write. Defaults to standard output (not for parquet).')
+        parser.add_argument('--chunk-size', type=int, default=None)
+
+    def handle(self, *args, **options):
+        try:
+            chunks = export_chunks(options['table'], options['format'], options['chunk_size'])
+        except ImportError as e:
+            raise CommandError(str(e))
+        if options['output'] is None:
+            if options['format'] == 'parquet':
+                raise CommandError('Parquet exports need --output.')
+            for chunk in chunks:
+                self.stdout.write(chunk.decode(), ending='')
+            return
+        size = 0
+        with open(options['output'], 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        self.stderr.write(f"Wrote {size} bytes to {options['output']}.")
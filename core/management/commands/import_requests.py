@@ -0,0 +1,241 @@
+import csv
+import itertools
+import json
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import Point
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from core.functions import approximate_coordinates, coordinates_for_addresses, fake_coordinates
+from core.matching import get_matching_engine
+from core.models import SYSTEMCHOICES, GameRequest, demand_state, link_pairs, update_demand
+from core.rematch import regroup
+
+TEXT_FIELDS = ['request_name', 'system', 'address', 'city', 'state', 'zip']
+SYSTEMS = {code for code, name in SYSTEMCHOICES}
+
+
+def read_rows(path, file_format):
+    """
+    Streams rows from a CSV (with a header line) or JSONL file as dicts.
+    """
+    with open(path, newline='') as f:
+        if file_format == 'csv':
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def parse_coordinates(row):
+    """
+    (longitude, latitude) from the row's optional columns, None if they are absent.
+    Raises ValueError if they are present but not a valid position.
+    """
+    lon, lat = row.get('longitude'), row.get('latitude')
+    if lon in (None, '') and lat in (None, ''):
+        return None
+    lon, lat = float(lon), float(lat)
+    if not (-180 <= lon <= 180 and -90 <= lat <= 90):
+        raise ValueError(f"Position out of range: {lon}, {lat}")
+    return lon, lat
+
+
+def is_inserted(row, sent):
+    """
+    True if a row read back after the insert is the request that was sent, rather than one another
+    writer inserted for the same user and system first.
+    """
+    return sent is not None and all(
+        getattr(row, field) == getattr(sent, field) for field in TEXT_FIELDS + ['can_dm', 'travel_range'])
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y')
+
+
+class Command(BaseCommand):
+    """
+    Bulk loader for GameRequests from partner communities.
+    Each row needs username, email and the GameRequest form fields (request_name, system,
+    can_dm, travel_range, address, city, state, zip). Optional latitude/longitude columns
+    skip geocoding for that row. Missing users are created with unusable passwords so they
+    can set one with a password reset.
+
+    Rows are processed in chunks: users and requests are written with bulk_create (so no
+    save()/post_save per row), addresses are geocoded through the shared cache one batch per
+    chunk, and the chunk's links are computed with one set-based match pass, after which the
+    groups around the imported requests are re-solved (see core.groups). Memory use is
+    bounded by the chunk size. Progress is checkpointed after every chunk, so an interrupted
+    import can be continued with --resume. Rows that already exist (same user and system) are
+    skipped. Rows with a bad travel range or position are counted as invalid and left out.
+    No notification emails are sent for imported rows.
+    """
+    help = 'Import GameRequests from a CSV or JSONL file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV or JSONL file to import.')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], default=None,
+                            help='Input format. Defaults to the file extension.')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--resume', action='store_true',
+                            help='Continue from the last checkpoint for this file.')
+        parser.add_argument('--checkpoint', default=None,
+                            help='Checkpoint file. Defaults to <path>.progress.')
+        parser.add_argument('--no-match', action='store_true',
+                            help='Skip the match pass (run the rematch command afterwards).')
+
+    def handle(self, *args, **options):
+        path = Path(options['path'])
+        if not path.exists():
+            raise CommandError(f"{path} does not exist.")
+        file_format = options['format'] or ('jsonl' if path.suffix in ('.jsonl', '.json') else 'csv')
+        checkpoint = Path(options['checkpoint'] or f"{path}.progress")
+        chunk_size = options['chunk_size']
+
+        done = 0
+        if options['resume'] and checkpoint.exists():
+            done = json.loads(checkpoint.read_text())['rows_done']
+            self.stdout.write(f"Resuming after row {done}.")
+
+        rows = itertools.islice(read_rows(path, file_format), done, None)
+        totals = {'imported': 0, 'skipped': 0, 'invalid': 0, 'links': 0, 'tables': 0}
+        read = 0
+        start = time.monotonic()
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            with transaction.atomic():
+                counts = self.import_chunk(chunk, match=not options['no_match'])
+            for key, value in counts.items():
+                totals[key] += value
+            done += len(chunk)
+            read += len(chunk)
+            checkpoint.write_text(json.dumps({'rows_done': done}))
+            elapsed = time.monotonic() - start
+            self.stdout.write(
+                f"{done} rows read: {totals['imported']} imported, {totals['skipped']} already present, "
+                f"{totals['invalid']} invalid, {totals['links']} DM links, {totals['tables']} tables changed "
+                f"({read / max(elapsed, 1e-9):.0f} rows/s)"
+            )
+
+        if options['no_match']:
+            # Rows were written without signals, so engines with their own index must reload.
+            get_matching_engine().reset()
+        checkpoint.unlink(missing_ok=True)
+        self.stdout.write(self.style.SUCCESS(f"Import finished, {totals['imported']} requests added."))
+
+    def import_chunk(self, chunk, match=True):
+        counts = {'imported': 0, 'skipped': 0, 'invalid': 0, 'links': 0, 'tables': 0}
+        valid = []
+        for row in chunk:
+            # JSONL values can be numbers (e.g. a ZIP code); the model fields are strings.
+            for field in TEXT_FIELDS + ['username', 'email']:
+                if row.get(field) is not None:
+                    row[field] = str(row[field])
+            if not row.get('username') or row.get('system') not in SYSTEMS:
+                counts['invalid'] += 1
+                continue
+            try:
+                row['travel_range'] = int(row.get('travel_range') or 1)
+                row['position'] = parse_coordinates(row)
+            except (TypeError, ValueError):
+                counts['invalid'] += 1
+                continue
+            row['can_dm'] = parse_bool(row.get('can_dm', False))
+            valid.append(row)
+
+        users = self.get_users(valid)
+        points = self.locate(valid)
+        requests = [
+            GameRequest(
+                user_id=users[row['username']],
+                gis_point=point,
+                **{field: row.get(field) or '' for field in TEXT_FIELDS},
+                can_dm=row['can_dm'],
+                travel_range=row['travel_range'],
+            ) for row, point in zip(valid, points)
+        ]
+        # Existing requests for the same user and system are left alone.
+        keys = {(request.user_id, request.system) for request in requests}
+        existing = set(GameRequest.objects.filter(
+            user_id__in={user_id for user_id, system in keys}).values_list('user_id', 'system'))
+        new = {}
+        for request in requests:
+            key = (request.user_id, request.system)
+            if key in existing or key in new:
+                counts['skipped'] += 1
+            else:
+                new[key] = request
+        GameRequest.objects.bulk_create(new.values(), ignore_conflicts=True)
+        # ignore_conflicts silently skips a row if another writer inserted the same user and system
+        # after `existing` was read. Only the rows read back as the ones sent are counted, added to
+        # the demand tiles and matched.
+        imported = [
+            request for request in GameRequest.objects.filter(
+                user_id__in={user_id for user_id, system in new}).only(
+                'pk', 'user_id', 'can_dm', 'travel_range', 'gis_point', *TEXT_FIELDS)
+            if is_inserted(request, new.get((request.user_id, request.system)))
+        ] if new else []
+        counts['imported'] = len(imported)
+        counts['skipped'] += len(new) - len(imported)
+        update_demand([(None, demand_state(request)) for request in imported])
+
+        if match and imported:
+            engine = get_matching_engine()
+            for request in imported:
+                engine.request_saved(request)
+            pairs = engine.match_pairs(imported)
+            counts['links'] = link_pairs(pairs)
+            counts['tables'] = regroup([request.pk for request in imported], notify=False)
+        return counts
+
+    def get_users(self, rows):
+        """
+        Returns {username: user id} for the chunk, creating missing users in bulk.
+        """
+        emails = {row['username']: row.get('email', '') for row in rows}
+        users = dict(User.objects.filter(username__in=emails.keys()).values_list('username', 'pk'))
+        missing = [name for name in emails if name not in users]
+        if missing:
+            unusable = make_password(None)
+            User.objects.bulk_create(
+                [User(username=name, email=emails[name], password=unusable) for name in missing],
+                ignore_conflicts=True)
+            users.update(User.objects.filter(username__in=missing).values_list('username', 'pk'))
+        return users
+
+    def locate(self, rows):
+        """
+        Coordinates for each row, in order. Rows with a position (see parse_coordinates) use it.
+        Otherwise the same options as a normal save apply: the map API (through the geocode cache,
+        one batch for the whole chunk), fake coordinates, or the ZIP code centroid.
+        """
+        points = [None] * len(rows)
+        to_geocode = {}
+        for i, row in enumerate(rows):
+            if row['position'] is not None:
+                points[i] = Point(*row['position'])
+            elif settings.USE_GEOPY_API:
+                to_geocode[i] = (row.get('address', ''), row.get('city', ''), row.get('state', ''), row.get('zip', ''))
+            elif settings.USE_FAKE_COORDINATES:
+                points[i] = fake_coordinates(row.get('zip'))
+        if to_geocode:
+            found = coordinates_for_addresses(set(to_geocode.values()))
+            for i, address in to_geocode.items():
+                points[i] = found[address]
+        for i, row in enumerate(rows):
+            if points[i] is None and settings.USE_ZIP_CENTROIDS:
+                points[i] = approximate_coordinates(row.get('zip'))
+            if points[i] is None:
+                points[i] = Point([])
+        return points
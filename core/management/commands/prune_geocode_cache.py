@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from core.models import GeocodeCache
+
+
+class Command(BaseCommand):
+    """
+    Removes expired geocode cache entries and trims the table to its maximum size.
+    Intended to be run periodically (e.g. daily from cron).
+    """
+    help = 'Prune expired and excess entries from the shared geocode cache.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-entries', type=int, default=None,
+                            help='Override settings.GEOCODE_CACHE_MAX_ENTRIES.')
+
+    def handle(self, *args, **options):
+        removed = GeocodeCache.prune(options['max_entries'])
+        self.stdout.write(f"Removed {removed} geocode cache entries, {GeocodeCache.objects.count()} remain.")
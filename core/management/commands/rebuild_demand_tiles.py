@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from core.functions import map_tile
+from core.models import DemandTile, GameRequest
+
+
+class Command(BaseCommand):
+    """
+    Recomputes the DemandTile aggregates from scratch. The table is kept current by the save and
+    delete paths, so this is only needed to fill it for existing requests (after the migration
+    or a change to DEMAND_TILE_ZOOMS) or after writes that bypassed them.
+    The table is locked while it is rebuilt, so saves made meanwhile are counted exactly once.
+    """
+    help = 'Rebuild the per-tile demand counts from the GameRequest table.'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(f"LOCK TABLE {connection.ops.quote_name(DemandTile._meta.db_table)} IN EXCLUSIVE MODE")
+            counts = {}
+            for system, can_dm, point in GameRequest.objects.exclude(gis_point=None).values_list(
+                    'system', 'can_dm', 'gis_point').iterator():
+                if point.coords == ():
+                    continue
+                for zoom in settings.DEMAND_TILE_ZOOMS:
+                    key = (system, zoom) + map_tile(point.x, point.y, zoom)
+                    players, dms = counts.get(key, (0, 0))
+                    counts[key] = (players, dms + 1) if can_dm else (players + 1, dms)
+            DemandTile.objects.all().delete()
+            DemandTile.objects.bulk_create([
+                DemandTile(system=system, zoom=zoom, tile_x=x, tile_y=y, players=players, dms=dms)
+                for (system, zoom, x, y), (players, dms) in counts.items()
+            ], batch_size=1000)
+        self.stdout.write(f"Wrote {len(counts)} demand tiles.")
@@ -0,0 +1,110 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+
+from core.matching import numpy
+from core.models import GameRequest
+from core.rematch import find_partitions, regroup, rematch_partition
+
+# Removes links that can never be valid regardless of distance: either side without coordinates,
+# a DM that no longer hosts, or a DM in a different system.
+INVALID_LINKS = """
+    FROM {through} t
+    JOIN {table} p ON p.id = t.from_gamerequest_id
+    JOIN {table} d ON d.id = t.to_gamerequest_id
+    WHERE p.gis_point IS NULL OR ST_IsEmpty(p.gis_point)
+       OR d.gis_point IS NULL OR ST_IsEmpty(d.gis_point)
+       OR NOT d.can_dm OR d.system <> p.system
+"""
+
+
+def _run_partition(args):
+    try:
+        return rematch_partition(*args)
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    """
+    Rebuilds every available_dms link from scratch, e.g. after changing the matching rules
+    or fixing bad coordinates.
+    Requests are split by system and by square tiles of --tile-size degrees. Each partition
+    owns the requests whose point is inside its tile and reads DMs from the tile plus a halo of
+    the largest travel range in that system, so partitions are independent and run in parallel
+    in a process pool. Each worker writes its changes with one bulk delete and one bulk insert.
+    --dry-run reports how many links would be added and removed without writing anything.
+    Afterwards the groups around every request whose links changed are re-solved, so no table
+    keeps a player whose link is gone. Hosts whose table changed are emailed unless --no-notify
+    is given.
+    """
+    help = 'Rebuild all DM/player links, partitioned by system and map tile.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tile-size', type=float, default=5.0, help='Tile size in degrees.')
+        parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                            help='Worker processes (default: number of cores).')
+        parser.add_argument('--system', action='append', default=None,
+                            help='Only rebuild this system (may be repeated).')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report the differences without writing them.')
+        parser.add_argument('--no-notify', action='store_true',
+                            help="Don't email hosts whose group changed.")
+
+    def handle(self, *args, **options):
+        if numpy is None:
+            raise CommandError('The rematch command requires NumPy.')
+        tile_size = options['tile_size']
+        dry_run = options['dry_run']
+        start = time.monotonic()
+        changed = set()
+
+        through = GameRequest.available_dms.through
+        sql = INVALID_LINKS.format(
+            through=connection.ops.quote_name(through._meta.db_table),
+            table=connection.ops.quote_name(GameRequest._meta.db_table),
+        )
+        with connection.cursor() as cursor:
+            if dry_run:
+                cursor.execute("SELECT COUNT(*) " + sql)
+                invalid = cursor.fetchone()[0]
+            else:
+                cursor.execute(
+                    f"DELETE FROM {connection.ops.quote_name(through._meta.db_table)} WHERE id IN "
+                    f"(SELECT t.id {sql}) RETURNING from_gamerequest_id, to_gamerequest_id")
+                rows = cursor.fetchall()
+                invalid = len(rows)
+                changed.update(request for row in rows for request in row)
+        self.stdout.write(f"{'Would remove' if dry_run else 'Removed'} {invalid} links to invalid DMs.")
+
+        partitions = [
+            (system, tile_x, tile_y, tile_size, halo, dry_run)
+            for system, tile_x, tile_y, halo in find_partitions(tile_size, options['system'])
+        ]
+        self.stdout.write(f"Rematching {len(partitions)} partitions with {options['processes']} processes.")
+
+        # Child processes must not share the parent's database connection.
+        connections.close_all()
+        totals = {'players': 0, 'links': 0, 'added': 0, 'removed': 0}
+        with ProcessPoolExecutor(options['processes'], mp_context=get_context('fork')) as pool:
+            for result in pool.map(_run_partition, partitions):
+                for key in totals:
+                    totals[key] += result[key]
+                changed.update(result['changed'])
+                self.stdout.write(
+                    f"{result['system']:>5} tile {result['tile']}: {result['players']} requests, "
+                    f"{result['dms']} DMs, +{result['added']} -{result['removed']} links "
+                    f"(load {result['load']:.2f}s, match {result['match']:.2f}s, write {result['write']:.2f}s)"
+                )
+        if changed and not dry_run:
+            tables = regroup(changed, notify=not options['no_notify'])
+            self.stdout.write(f"Re-solved the groups around {len(changed)} requests: {tables} tables changed.")
+        self.stdout.write(self.style.SUCCESS(
+            f"{'Dry run' if dry_run else 'Rematch'} finished in {time.monotonic() - start:.1f}s: "
+            f"{totals['players']} requests, {totals['links']} links, "
+            f"+{totals['added']} -{totals['removed'] + invalid}."
+        ))
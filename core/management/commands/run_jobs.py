@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.jobs import process_due_jobs
+from core.notifications import send_due_notifications
+
+
+class Command(BaseCommand):
+    """
+    Worker for the geocode/rematch job queue (settings.USE_JOB_QUEUE). Also sends the queued
+    group emails.
+    Any number of workers can run at once, on any machine with database access.
+    """
+    help = 'Process queued geocode and matching jobs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help='Jobs claimed per database round trip.')
+        parser.add_argument('--sleep', type=float, default=1.0,
+                            help='Seconds to wait when the queue is empty.')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once there are no due jobs instead of polling.')
+
+    def handle(self, *args, **options):
+        while True:
+            claimed = process_due_jobs(options['batch_size'])
+            sent = send_due_notifications(options['batch_size'])
+            if claimed:
+                self.stdout.write(f"Processed {claimed} jobs.")
+            if sent:
+                self.stdout.write(f"Sent {sent} group notifications.")
+            if claimed or sent:
+                continue
+            if options['once']:
+                return
+            else:
+                time.sleep(options['sleep'])
@@ -0,0 +1,442 @@
+import math
+import re
+import threading
+import zlib
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.gis.db.models import PointField
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, connections, router
+from django.db.models import BooleanField, F, Func, Value
+from django.utils.module_loading import import_string
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+METERS_PER_MILE = 1609.344
+# Largest distance a DM save looks for affected players. Nobody will ever travel
+# this far and it keeps the search area bounded.
+FANOUT_RANGE = 500
+# Same sphere PostGIS uses for geography ST_DWithin without the spheroid: the WGS84 mean radius
+# (2a + b) / 3. Both engines must use it to agree on points at the edge of a travel range.
+EARTH_RADIUS_MI = 6371008.7714 / METERS_PER_MILE
+MILES_PER_DEGREE_LAT = 69.0
+
+
+def search_box(lon, lat, radius):
+    """
+    (lon0, lat0, lon1, lat1) in degrees: a box holding every point within radius miles of
+    (lon, lat) on the sphere, padded slightly so rounding can't leave out a point on its edge.
+    A circle is widest in longitude away from its centre latitude, so the longitude span comes
+    from asin rather than from dividing by cos(lat). Spans every longitude if the circle reaches
+    a pole. Does not wrap around the antimeridian.
+    """
+    angle = radius * 1.000001 / EARTH_RADIUS_MI
+    dlat = math.degrees(angle)
+    lat0, lat1 = lat - dlat, lat + dlat
+    if lat0 <= -90.0 or lat1 >= 90.0:
+        return -180.0, max(lat0, -90.0), 180.0, min(lat1, 90.0)
+    dlon = math.degrees(math.asin(min(math.sin(angle) / math.cos(math.radians(lat)), 1.0)))
+    return lon - dlon, lat0, lon + dlon, lat1
+
+
+def has_coordinates(request):
+    """
+    True if the request has a usable gis_point. Blank coordinates are stored as an
+    empty Point() when address conversion is disabled or fails.
+    """
+    return request.gis_point is not None and request.gis_point.coords != ()
+
+
+class MatchingEngine:
+    """
+    Base class for finding which DMs/hosts and players can reach each other.
+    candidate_dms(request): ids of DMs in the same system within request's travel range.
+    players_for_dm(dm): ids of requests in the same system whose travel range reaches the DM.
+    match_pairs(requests): every (player_id, dm_id) link involving any of the requests, on either side.
+    request_saved/request_deleted: hooks for engines that keep their own copy of the data.
+    reset(): drop any cached state, used after bulk writes that bypass the model signals.
+    """
+    def candidate_dms(self, request):
+        raise NotImplementedError
+
+    def players_for_dm(self, dm):
+        raise NotImplementedError
+
+    def match_pairs(self, requests):
+        pairs = set()
+        for request in requests:
+            if has_coordinates(request):
+                pairs.update((request.pk, dm_id) for dm_id in self.candidate_dms(request))
+            pairs.update((player_id, request.pk) for player_id in self.players_for_dm(request))
+        return pairs
+
+    def request_saved(self, request):
+        pass
+
+    def request_deleted(self, request):
+        pass
+
+    def reset(self):
+        pass
+
+
+class AsGeography(Func):
+    """
+    Casts a srid 4326 geometry to geography, matching the expression of the geography GiST
+    indexes on core_gamerequest (see create_system_indexes) so the planner can use them.
+    """
+    template = '(%(expressions)s)::geography'
+    output_field = PointField(geography=True, srid=4326)
+
+
+class DWithinSphere(Func):
+    """
+    ST_DWithin(a::geography, b::geography, meters, false): true if two points are within a
+    distance on the sphere (the same sphere as haversine_miles, see EARTH_RADIUS_MI).
+    Unlike a distance comparison this can use a geography GiST index when the distance is a
+    constant. Usable directly as a filter() condition.
+    """
+    function = 'ST_DWithin'
+    template = '%(function)s(%(expressions)s, false)'
+    output_field = BooleanField()
+
+    def __init__(self, a, b, meters):
+        super().__init__(AsGeography(a), AsGeography(b), meters)
+
+
+def point_value(point):
+    return Value(point, output_field=PointField(srid=4326))
+
+
+def system_index_name(system, dms=False):
+    """
+    Name of the geography GiST index covering one system's requests (or only its DMs).
+    """
+    slug = re.sub(r'[^a-z0-9]', '', system.lower())[:20]
+    return f"core_gamereq_{'dm_' if dms else ''}geog_{slug}_{zlib.crc32(system.encode()):08x}"
+
+
+def create_system_indexes(connection, systems):
+    """
+    Creates any missing per-system geography GiST indexes: one over each system's requests and
+    one over its DMs. Each is a partial index (WHERE system = '<code>'), so a system's lookups
+    only read and lock the part of the table holding that system, and busy systems don't bloat
+    the index the others search. Built CONCURRENTLY when not inside a transaction.
+    No-op on databases other than PostgreSQL.
+    """
+    from core.models import GameRequest
+    if connection.vendor != 'postgresql':
+        return
+    table = connection.ops.quote_name(GameRequest._meta.db_table)
+    concurrently = '' if connection.in_atomic_block else 'CONCURRENTLY '
+    with connection.cursor() as cursor:
+        for system in systems:
+            for dms, condition in ((False, 'system = %s'), (True, 'system = %s AND can_dm')):
+                cursor.execute(
+                    f"CREATE INDEX {concurrently}IF NOT EXISTS {system_index_name(system, dms)} "
+                    f"ON {table} USING GIST ((gis_point::geography)) WHERE {condition}", [system])
+
+
+def drop_system_indexes(connection, systems):
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        for system in systems:
+            for dms in (False, True):
+                cursor.execute(f"DROP INDEX IF EXISTS {system_index_name(system, dms)}")
+
+
+def ensure_system_indexes(sender, using, **kwargs):
+    """
+    post_migrate receiver that gives every system in SYSTEMCHOICES its indexes, so adding a
+    system choice is all it takes to index it.
+    """
+    from core.models import SYSTEMCHOICES, GameRequest
+    database = connections[using]
+    if (not router.allow_migrate_model(using, GameRequest)
+            or GameRequest._meta.db_table not in database.introspection.table_names()):
+        return
+    create_system_indexes(database, [code for code, name in SYSTEMCHOICES])
+
+
+class PostGISMatchingEngine(MatchingEngine):
+    """
+    Default engine. Every lookup is an ST_DWithin query on the geography GiST index of the
+    request's system (see create_system_indexes). The system is always a constant in the
+    query, so the planner can pick that system's partial index.
+    Distances are compared on the sphere, and a point exactly at the travel range counts as in range.
+    """
+    def candidate_dms_queryset(self, request):
+        from core.models import GameRequest
+        return GameRequest.objects.filter(
+            DWithinSphere('gis_point', point_value(request.gis_point),
+                          Value(request.travel_range * METERS_PER_MILE)),
+            system=request.system,
+            can_dm=True
+        )
+
+    def players_for_dm_queryset(self, dm):
+        from core.models import GameRequest
+        # The constant FANOUT_RANGE condition is the one the index can use. The per-row travel
+        # range is then checked on the rows it finds.
+        return GameRequest.objects.filter(
+            DWithinSphere('gis_point', point_value(dm.gis_point), Value(FANOUT_RANGE * METERS_PER_MILE)),
+            DWithinSphere('gis_point', point_value(dm.gis_point), F('travel_range') * METERS_PER_MILE),
+            system=dm.system
+        )
+
+    def candidate_dms(self, request):
+        return list(self.candidate_dms_queryset(request).values_list('pk', flat=True))
+
+    def players_for_dm(self, dm):
+        if not dm.can_dm or not has_coordinates(dm):
+            return []
+        return list(self.players_for_dm_queryset(dm).values_list('pk', flat=True))
+
+    def match_pairs(self, requests):
+        """
+        One self-join over the request table per system in the set instead of two queries per
+        request. Each half of the UNION is driven by the given ids and reaches the other side
+        through the system's geography index.
+        """
+        from core.models import GameRequest
+        by_system = {}
+        for request in requests:
+            by_system.setdefault(request.system, []).append(request.pk)
+        table = connection.ops.quote_name(GameRequest._meta.db_table)
+        # The system is a constant on both sides so each side matches its partial index.
+        join = (
+            f"FROM {table} p JOIN {table} d "
+            f"ON p.system = %s AND d.system = %s AND d.can_dm "
+            f"AND ST_DWithin(p.gis_point::geography, d.gis_point::geography, %s, false) "
+            f"AND ST_DWithin(p.gis_point::geography, d.gis_point::geography, p.travel_range * %s, false) "
+        )
+        fanout = FANOUT_RANGE * METERS_PER_MILE
+        pairs = set()
+        with connection.cursor() as cursor:
+            for system, ids in by_system.items():
+                params = [system, system, fanout, METERS_PER_MILE]
+                cursor.execute(
+                    f"SELECT p.id, d.id {join} WHERE p.id = ANY(%s) "
+                    f"UNION SELECT p.id, d.id {join} WHERE d.id = ANY(%s)",
+                    params + [ids] + params + [ids]
+                )
+                pairs.update(cursor.fetchall())
+        return pairs
+
+
+def haversine_miles(lon, lat, lons, lats):
+    """
+    Great-circle distance in miles from one point to an array of points.
+    All inputs are in degrees; lons and lats are NumPy arrays of equal length.
+    """
+    lon, lat = math.radians(lon), math.radians(lat)
+    lons, lats = numpy.radians(lons), numpy.radians(lats)
+    a = (numpy.sin((lats - lat) / 2) ** 2
+         + math.cos(lat) * numpy.cos(lats) * numpy.sin((lons - lon) / 2) ** 2)
+    return 2 * EARTH_RADIUS_MI * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+
+class ColumnarMatchingEngine(MatchingEngine):
+    """
+    Base for engines that filter column arrays with NumPy instead of querying the database.
+    nearby(system, lon, lat, radius): arrays (id, lon, lat, can_dm, travel_range) of at least every
+    request of the system within radius miles of the point. The haversine filter does the rest.
+    Like ST_DWithin, a point exactly at the travel range counts as in range.
+    """
+    def __init__(self):
+        if numpy is None:
+            raise ImproperlyConfigured(f'{type(self).__name__} requires NumPy.')
+
+    def nearby(self, system, lon, lat, radius):
+        raise NotImplementedError
+
+    def candidate_dms(self, request):
+        if not has_coordinates(request):
+            return []
+        lon, lat = request.gis_point.x, request.gis_point.y
+        near = self.nearby(request.system, lon, lat, request.travel_range)
+        if not len(near['id']):
+            return []
+        distance = haversine_miles(lon, lat, near['lon'], near['lat'])
+        mask = near['can_dm'] & (distance <= request.travel_range)
+        return near['id'][mask].tolist()
+
+    def players_for_dm(self, dm):
+        if not dm.can_dm or not has_coordinates(dm):
+            return []
+        lon, lat = dm.gis_point.x, dm.gis_point.y
+        near = self.nearby(dm.system, lon, lat, FANOUT_RANGE)
+        if not len(near['id']):
+            return []
+        distance = haversine_miles(lon, lat, near['lon'], near['lat'])
+        mask = (distance <= FANOUT_RANGE) & (distance <= near['travel_range'])
+        return near['id'][mask].tolist()
+
+
+class InMemoryMatchingEngine(ColumnarMatchingEngine):
+    """
+    Keeps every request with coordinates in a per-process grid index, partitioned by system.
+    Grid cells are CELL_SIZE degrees square. A lookup collects the cells overlapping the
+    search radius and filters them with a single vectorized haversine, so no database round
+    trip is needed once the index is loaded.
+    The index is loaded from the database on first use and kept in sync through the
+    request_saved/request_deleted hooks, which are called from the GameRequest signals.
+    Changes made by other processes are not seen until reset() is called.
+    Note: the grid does not wrap around the antimeridian.
+    """
+    CELL_SIZE = 1.0
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._records = {}  # id -> (system, lon, lat, can_dm, travel_range)
+        self._grid = {}  # system -> {(cell_x, cell_y): set of ids}
+
+    def reset(self):
+        with self._lock:
+            self._loaded = False
+            self._records = {}
+            self._grid = {}
+
+    def _cell(self, lon, lat):
+        return math.floor(lon / self.CELL_SIZE), math.floor(lat / self.CELL_SIZE)
+
+    def _load(self):
+        from core.models import GameRequest
+        rows = GameRequest.objects.exclude(gis_point=None).values_list(
+            'pk', 'system', 'can_dm', 'travel_range', 'gis_point')
+        for pk, system, can_dm, travel_range, point in rows.iterator():
+            if point.coords != ():
+                self._insert(pk, system, point.x, point.y, can_dm, travel_range)
+        self._loaded = True
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self._load()
+
+    def _insert(self, pk, system, lon, lat, can_dm, travel_range):
+        self._remove(pk)
+        self._records[pk] = (system, lon, lat, can_dm, travel_range)
+        self._grid.setdefault(system, {}).setdefault(self._cell(lon, lat), set()).add(pk)
+
+    def _remove(self, pk):
+        record = self._records.pop(pk, None)
+        if record is None:
+            return
+        system, lon, lat = record[:3]
+        cells = self._grid[system]
+        cell = self._cell(lon, lat)
+        cells[cell].discard(pk)
+        if not cells[cell]:
+            del cells[cell]
+
+    def nearby(self, system, lon, lat, radius):
+        with self._lock:
+            self._ensure_loaded()
+            return self._nearby(system, lon, lat, radius)
+
+    def _nearby(self, system, lon, lat, radius):
+        """
+        Ids and column arrays for every request in the grid cells overlapping the
+        bounding box of a radius (miles) around a point.
+        """
+        cells = self._grid.get(system, {})
+        lon0, lat0, lon1, lat1 = search_box(lon, lat, radius)
+        x0, y0 = self._cell(lon0, lat0)
+        x1, y1 = self._cell(lon1, lat1)
+        ids = []
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(cells):
+            # Huge radius: cheaper to walk the occupied cells than the bounding box.
+            for (x, y), members in cells.items():
+                if x0 <= x <= x1 and y0 <= y <= y1:
+                    ids.extend(members)
+        else:
+            for x in range(x0, x1 + 1):
+                for y in range(y0, y1 + 1):
+                    ids.extend(cells.get((x, y), ()))
+        records = [self._records[pk] for pk in ids]
+        columns = {
+            'id': numpy.array(ids, dtype=numpy.int64),
+            'lon': numpy.array([r[1] for r in records], dtype=numpy.float64),
+            'lat': numpy.array([r[2] for r in records], dtype=numpy.float64),
+            'can_dm': numpy.array([r[3] for r in records], dtype=bool),
+            'travel_range': numpy.array([r[4] for r in records], dtype=numpy.float64),
+        }
+        return columns
+
+    def request_saved(self, request):
+        with self._lock:
+            if not self._loaded:
+                # The first lookup will read this row from the database anyway.
+                return
+            if has_coordinates(request):
+                self._insert(request.pk, request.system, request.gis_point.x, request.gis_point.y,
+                             request.can_dm, request.travel_range)
+            else:
+                self._remove(request.pk)
+
+    def request_deleted(self, request):
+        with self._lock:
+            self._remove(request.pk)
+
+
+class SnapshotMatchingEngine(ColumnarMatchingEngine):
+    """
+    Filters the columnar snapshot in settings.MATCH_SNAPSHOT_DIR (core.snapshot.MatchSnapshot).
+    Every process on the machine maps the same files, so memory per process doesn't grow with
+    the number of requests, and changes saved by any process are seen by all of them through
+    the snapshot log. Run the build_match_snapshot command periodically to fold the log into
+    a new snapshot. Until it has run once there is no snapshot and lookups go to the
+    PostGIS engine.
+    Note: the grid does not wrap around the antimeridian.
+    """
+    def __init__(self):
+        super().__init__()
+        from core.snapshot import MatchSnapshot
+        self.snapshot = MatchSnapshot(settings.MATCH_SNAPSHOT_DIR)
+        self.fallback = PostGISMatchingEngine()
+
+    def nearby(self, system, lon, lat, radius):
+        return self.snapshot.nearby(system, lon, lat, radius)
+
+    def candidate_dms(self, request):
+        from core.snapshot import SnapshotMissing
+        try:
+            return super().candidate_dms(request)
+        except SnapshotMissing:
+            return self.fallback.candidate_dms(request)
+
+    def players_for_dm(self, dm):
+        from core.snapshot import SnapshotMissing
+        try:
+            return super().players_for_dm(dm)
+        except SnapshotMissing:
+            return self.fallback.players_for_dm(dm)
+
+    def request_saved(self, request):
+        if has_coordinates(request):
+            self.snapshot.upsert(request.pk, request.system, request.gis_point.x, request.gis_point.y,
+                                 request.can_dm, request.travel_range)
+        else:
+            self.snapshot.delete(request.pk)
+
+    def request_deleted(self, request):
+        self.snapshot.delete(request.pk)
+
+    def reset(self):
+        self.snapshot.rebuild()
+
+
+@lru_cache(maxsize=None)
+def get_matching_engine():
+    """
+    Returns the shared matching engine instance named by settings.MATCHING_ENGINE.
+    """
+    path = getattr(settings, 'MATCHING_ENGINE', 'core.matching.PostGISMatchingEngine')
+    return import_string(path)()
@@ -0,0 +1,23 @@
+from django.db import migrations, models
+import django.contrib.gis.db.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodeCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address_key', models.CharField(max_length=600, unique=True)),
+                ('gis_point', django.contrib.gis.db.models.fields.PointField(blank=True, null=True, srid=4326)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('expires', models.DateTimeField(db_index=True)),
+                ('hits', models.IntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_geocodecache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MatchJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('geocode', models.BooleanField(default=False)),
+                ('version', models.IntegerField(default=0)),
+                ('attempts', models.IntegerField(default=0)),
+                ('run_after', models.DateTimeField(db_index=True)),
+                ('last_error', models.TextField(blank=True)),
+                ('game_request', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='match_job', to='core.GameRequest')),
+            ],
+        ),
+    ]
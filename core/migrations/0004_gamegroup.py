@@ -0,0 +1,25 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_matchjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GameGroup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('host', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='hosted_group', to='core.GameRequest')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='gamerequest',
+            name='group',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='players', to='core.GameGroup'),
+        ),
+    ]
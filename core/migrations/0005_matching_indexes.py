@@ -0,0 +1,48 @@
+from django.db import migrations, models
+
+# (name, condition) of the geography GiST indexes.
+GEOGRAPHY_INDEXES = [
+    ('core_gamereq_geog_gist', ''),
+    ('core_gamereq_dm_geog_gist', ' WHERE can_dm'),
+]
+
+
+def create_geography_indexes(apps, schema_editor):
+    # Geography casts only exist in PostGIS. The SpatiaLite test database goes without them.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, condition in GEOGRAPHY_INDEXES:
+        schema_editor.execute(
+            f"CREATE INDEX {name} ON core_gamerequest USING GIST ((gis_point::geography)){condition};")
+
+
+def drop_geography_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, condition in GEOGRAPHY_INDEXES:
+        schema_editor.execute(f"DROP INDEX IF EXISTS {name};")
+
+
+class Migration(migrations.Migration):
+    """
+    Indexes for the matching queries (see core.matching.PostGISMatchingEngine):
+    * GiST indexes on gis_point::geography, for all requests and for DMs only, so ST_DWithin
+      lookups on the geography cast are index scans instead of per-row distance checks.
+    * A btree on (system, can_dm) and a partial btree on system for DMs.
+    """
+
+    dependencies = [
+        ('core', '0004_gamegroup'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='gamerequest',
+            index=models.Index(fields=['system', 'can_dm'], name='core_gamereq_system_dm_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gamerequest',
+            index=models.Index(condition=models.Q(can_dm=True), fields=['system'], name='core_gamereq_dm_system_idx'),
+        ),
+        migrations.RunPython(create_geography_indexes, drop_geography_indexes),
+    ]
@@ -0,0 +1,28 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_matching_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GroupNotification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recipient', models.EmailField(max_length=254)),
+                ('fingerprint', models.CharField(max_length=40)),
+                ('sent_fingerprint', models.CharField(blank=True, max_length=40)),
+                ('pending', models.BooleanField(default=False)),
+                ('subject', models.CharField(max_length=300)),
+                ('section', models.TextField(blank=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('run_after', models.DateTimeField(db_index=True)),
+                ('last_error', models.TextField(blank=True)),
+                ('host', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='notification', to='core.GameRequest')),
+            ],
+        ),
+    ]
@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_groupnotification'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DemandTile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('system', models.CharField(choices=[('3.5e', 'D&D 3.5e'), ('PF', 'Pathfinder'), ('4e', 'D&D 4e'), ('5e', 'D&D 5e'), ('6e', 'D&D 6e Playtest')], max_length=200)),
+                ('zoom', models.SmallIntegerField()),
+                ('tile_x', models.IntegerField()),
+                ('tile_y', models.IntegerField()),
+                ('players', models.IntegerField(default=0)),
+                ('dms', models.IntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('system', 'zoom', 'tile_x', 'tile_y')},
+            },
+        ),
+    ]
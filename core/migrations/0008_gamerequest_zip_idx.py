@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_demandtile'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='gamerequest',
+            index=models.Index(fields=['zip'], name='core_gamereq_zip_idx'),
+        ),
+    ]
@@ -0,0 +1,69 @@
+import re
+import zlib
+
+from django.db import migrations
+
+# Whole-table geography indexes from 0005, replaced by the per-system ones.
+GEOGRAPHY_INDEXES = [
+    ('core_gamereq_geog_gist', ''),
+    ('core_gamereq_dm_geog_gist', ' WHERE can_dm'),
+]
+
+
+def systems(apps):
+    return [code for code, name in apps.get_model('core', 'GameRequest')._meta.get_field('system').choices]
+
+
+# Frozen copies of core.matching.system_index_name, create_system_indexes and drop_system_indexes
+# as they were when this migration was written, so later changes there don't alter it.
+
+def system_index_name(system, dms=False):
+    slug = re.sub(r'[^a-z0-9]', '', system.lower())[:20]
+    return f"core_gamereq_{'dm_' if dms else ''}geog_{slug}_{zlib.crc32(system.encode()):08x}"
+
+
+def create_system_indexes(schema_editor, systems):
+    for system in systems:
+        for dms, condition in ((False, 'system = %s'), (True, 'system = %s AND can_dm')):
+            schema_editor.execute(
+                f"CREATE INDEX IF NOT EXISTS {system_index_name(system, dms)} "
+                f"ON core_gamerequest USING GIST ((gis_point::geography)) WHERE {condition};", [system])
+
+
+def drop_system_indexes(schema_editor, systems):
+    for system in systems:
+        for dms in (False, True):
+            schema_editor.execute(f"DROP INDEX IF EXISTS {system_index_name(system, dms)};")
+
+
+def split_geography_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    create_system_indexes(schema_editor, systems(apps))
+    for name, condition in GEOGRAPHY_INDEXES:
+        schema_editor.execute(f"DROP INDEX IF EXISTS {name};")
+
+
+def merge_geography_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, condition in GEOGRAPHY_INDEXES:
+        schema_editor.execute(
+            f"CREATE INDEX IF NOT EXISTS {name} ON core_gamerequest USING GIST ((gis_point::geography)){condition};")
+    drop_system_indexes(schema_editor, systems(apps))
+
+
+class Migration(migrations.Migration):
+    """
+    Replaces the whole-table geography GiST indexes with one pair per system (all requests and
+    DMs only, see core.matching.create_system_indexes). Systems added to SYSTEMCHOICES later get
+    theirs after the next migrate.
+    """
+
+    dependencies = [
+        ('core', '0008_gamerequest_zip_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(split_geography_indexes, merge_geography_indexes),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_system_geography_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='geocodecache',
+            name='hits',
+        ),
+    ]
@@ -1,12 +1,24 @@
+from contextvars import ContextVar
+
 from django.contrib.auth.models import User
 from django.contrib.gis.db import models
 from django.contrib.gis.geos import Point
-from django.contrib.gis.measure import Distance
 from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
 
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, pre_delete
 from django.dispatch import receiver
-from core.functions import coordinates_from_api, fake_coordinates, send_email
+from core.functions import approximate_coordinates, coordinates_from_api, fake_coordinates, map_tile
+from core.instrumentation import span
+from core.tracking import DirtyFieldsMixin
+from core.matching import get_matching_engine, has_coordinates
+
+# Set while saving from the async views: post_save queues a MatchJob instead of geocoding and
+# matching inside the save, as with settings.USE_JOB_QUEUE.
+defer_matching = ContextVar('defer_matching', default=False)
 
 ##############
 # Supported game systems for system field. This must be a fixed set of choices to
@@ -20,8 +32,14 @@ SYSTEMCHOICES = [('3.5e', 'D&D 3.5e'),
                  ('5e', 'D&D 5e'),
                  ('6e', 'D&D 6e Playtest')]
 
+GROUP_SIZE = 4  # DM and 3+ players is a typical game group.
+# Fields that change who can be matched with whom. Saves that change none of these (or the
+# address) skip matching.
+MATCH_FIELDS = {'system', 'can_dm', 'travel_range', 'gis_point'}
+ADDRESS_FIELDS = ['address', 'city', 'state', 'zip']
 
-class GameRequest(models.Model):
+
+class GameRequest(DirtyFieldsMixin, models.Model):
     """
     Core game request model.
     user: associated User that made the request.
@@ -35,14 +53,22 @@ class GameRequest(models.Model):
     address, city, state, zip: string format address submitted by user.
     gis_point: geographical coordinates of the address used in the search algorithm. Note that
         Python's Point object is (longitude, latitude) contrary to the normal map format.
+    group: the game group this request has been assigned to as a player, if any.
 
     Contains a custom save() and is linked to a post_save signal for converting the address and
     finding potential game groups.
     """
     class Meta:
         unique_together = ['user', 'system']
+        indexes = [
+            models.Index(fields=['system', 'can_dm'], name='core_gamereq_system_dm_idx'),
+            models.Index(fields=['system'], condition=Q(can_dm=True), name='core_gamereq_dm_system_idx'),
+            models.Index(fields=['zip'], name='core_gamereq_zip_idx'),
+        ]
 
     user = models.ForeignKey(User, on_delete=models.CASCADE)
+    group = models.ForeignKey('GameGroup', on_delete=models.SET_NULL, blank=True, null=True,
+                              related_name='players')
     request_name = models.CharField(max_length=200)
     system = models.CharField(max_length=200, choices=SYSTEMCHOICES)
     can_dm = models.BooleanField(default=False)
@@ -54,55 +80,425 @@ class GameRequest(models.Model):
     zip = models.CharField(max_length=100)
     gis_point = models.PointField(blank=True, null=True, srid=4326, default=Point([]))
 
+    # Fields compared by save() to build update_fields.
+    tracked_fields = [
+        'request_name',
+        'system',
+        'can_dm',
+        'travel_range',
+        'address',
+        'city',
+        'state',
+        'zip',
+        'gis_point'
+    ]
+
     def save(self, *args, **kwargs):
         """
         Custom save function.
-        Finds all eligible DMs/hosts within the user's travel range and creates the many-to-many
-        relation.
-        Also sets update_fields for the post_save signal to recognize if changes to the address
-        fields have been made.
+        Sets update_fields for the post_save signal to recognize if changes to the address
+        fields have been made. A save with no changes writes nothing and fires no post_save.
+        Finding eligible DMs/hosts is done by match_request() after the save, either directly
+        from the post_save signal or from the job queue.
+        A new request created with coordinates keeps them: it gets no ZIP centroid and its
+        address isn't looked up.
         """
-        update_fields = []
-        # Gis_point is () if address conversion is disabled or if the API conversion fails..
-        # It's fine to skip on pk = None since the address will be updated and post_save will
-        # call another save() to get right back here and fill this in.
-        if self.pk is not None and self.gis_point != ():
-            dms = GameRequest.objects.filter(
-                gis_point__distance_lt=(self.gis_point, Distance(mi=self.travel_range))).filter(
-                system=self.system).filter(can_dm=True)
-            for dm in dms:
-                # TODO need to clear DMs that are no longer valid but set() causes errors.
-                self.available_dms.add(dm)
-
         if self.pk is None:  # Update_fields is only valid if the database transaction is an update.
+            self._point_given = has_coordinates(self)
+            if not self._point_given:
+                self.set_approximate_point()
             super(GameRequest, self).save(*args, **kwargs)
         else:
-            original = GameRequest.objects.get(pk=self.pk)
-            for field in [
-                'request_name',
-                'system',
-                'can_dm',
-                'travel_range',
-                'address',
-                'city',
-                'state',
-                'zip',
-                'gis_point'
-            ]:
-                if getattr(original, field) != getattr(self, field):
-                    update_fields.append(field)
+            # Changed fields come from the snapshot taken when the instance was loaded. Instances
+            # built by hand with a pk have no snapshot and fall back to reading the stored row.
+            update_fields = self.get_dirty_fields()
+            if update_fields is None:
+                with span('save_dirty_check'):
+                    original = GameRequest.objects.get(pk=self.pk)
+                if not hasattr(self, '_demand_state'):
+                    self._demand_state = demand_state(original)
+                update_fields = [
+                    field for field in self.tracked_fields if getattr(original, field) != getattr(self, field)
+                ]
+            if 'zip' in update_fields and 'gis_point' not in update_fields and self.set_approximate_point():
+                update_fields.append('gis_point')
             super(GameRequest, self).save(update_fields=update_fields, *args, **kwargs)
 
+    def set_approximate_point(self):
+        """
+        With settings.USE_ZIP_CENTROIDS, fills gis_point with the centroid of the ZIP code so the
+        request can be matched approximately right away. The precise coordinates replace it
+        once the address lookup finishes. Returns True if the point was set.
+        """
+        if not settings.USE_ZIP_CENTROIDS:
+            return False
+        point = approximate_coordinates(self.zip)
+        if point is None:
+            return False
+        self.gis_point = point
+        return True
+
     def __str__(self):
         return self.request_name
 
 
+class GameGroup(models.Model):
+    """
+    A complete table formed by the group solver (core.groups).
+    host: the DM/host request running the table. A request hosts at most one group.
+    players: reverse of GameRequest.group, the requests assigned to play at this table.
+        No request is assigned to more than one group.
+    """
+    host = models.OneToOneField(GameRequest, on_delete=models.CASCADE, related_name='hosted_group')
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Group hosted by {self.host_id}"
+
+
+class GeocodeCache(models.Model):
+    """
+    Persistent address to coordinate cache shared by all worker processes.
+    address_key: normalized address (see functions.normalize_address).
+    gis_point: cached coordinates, or null if the map API could not find the address.
+    updated: last time the entry was written by a lookup.
+    expires: entry is ignored (and replaced on the next lookup) after this time.
+    """
+    address_key = models.CharField(max_length=600, unique=True)
+    gis_point = models.PointField(blank=True, null=True, srid=4326)
+    updated = models.DateTimeField(auto_now=True)
+    expires = models.DateTimeField(db_index=True)
+
+    @classmethod
+    def prune(cls, max_entries=None):
+        """
+        Deletes expired entries, then the least recently refreshed entries over max_entries
+        (default settings.GEOCODE_CACHE_MAX_ENTRIES). Returns the number of rows removed.
+        """
+        if max_entries is None:
+            max_entries = settings.GEOCODE_CACHE_MAX_ENTRIES
+        removed, _ = cls.objects.filter(expires__lte=timezone.now()).delete()
+        cutoff = cls.objects.order_by('-updated').values_list('updated', flat=True)[max_entries:max_entries + 1]
+        if cutoff:
+            count, _ = cls.objects.filter(updated__lte=cutoff[0]).delete()
+            removed += count
+        return removed
+
+    def __str__(self):
+        return self.address_key
+
+
+class MatchJob(models.Model):
+    """
+    Pending geocode/rematch work for a GameRequest, processed by the run_jobs command.
+    There is at most one row per request, so repeated saves coalesce into one job.
+    geocode: the address changed and coordinates must be looked up before matching.
+        Once set it stays set until the job runs, even if a later save only needs a rematch.
+    version: bumped on every enqueue. A worker only deletes the job if the version is unchanged,
+        so a save made while the job is running gets processed again once it finishes.
+    attempts, run_after, last_error: retry state. Failed jobs are retried with exponential backoff.
+    """
+    game_request = models.OneToOneField(GameRequest, on_delete=models.CASCADE, related_name='match_job')
+    geocode = models.BooleanField(default=False)
+    version = models.IntegerField(default=0)
+    attempts = models.IntegerField(default=0)
+    run_after = models.DateTimeField(db_index=True)
+    last_error = models.TextField(blank=True)
+
+    @classmethod
+    def enqueue(cls, request, geocode=False):
+        """
+        Adds or updates the job for a request with a single INSERT ... ON CONFLICT statement.
+        An existing job keeps its run_after: it is either due already, leased by a worker
+        running it (which must not be handed to a second worker), or waiting out a retry delay.
+        The worker holding it sees the new version when it finishes and runs it again
+        (see jobs.process_job).
+        """
+        table = connection.ops.quote_name(cls._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} (game_request_id, geocode, version, attempts, run_after, last_error) "
+                f"VALUES (%s, %s, 0, 0, %s, '') "
+                f"ON CONFLICT (game_request_id) DO UPDATE SET "
+                f"geocode = {table}.geocode OR EXCLUDED.geocode, "
+                f"version = {table}.version + 1, "
+                f"attempts = 0",
+                [request.pk, geocode, timezone.now()]
+            )
+
+    def __str__(self):
+        return f"{'geocode' if self.geocode else 'rematch'} {self.game_request_id}"
+
+
+class GroupNotification(models.Model):
+    """
+    Outbox entry for the group email of a host request, sent by core.notifications.
+    There is one row per host, so changes made before the email goes out coalesce into one message.
+    fingerprint: hash of the host and its current players (see notifications.fingerprint).
+    sent_fingerprint: fingerprint of the last group announced to this host. A group is only
+        announced again once its membership differs, so saves nearby don't resend the same email.
+    pending: the current group still has to be sent.
+    recipient, subject, section: the host's address, the subject used when the email covers
+        this group only, and the player list for this group.
+    attempts, run_after, last_error: retry state, as on MatchJob.
+    """
+    host = models.OneToOneField(GameRequest, on_delete=models.CASCADE, related_name='notification')
+    recipient = models.EmailField()
+    fingerprint = models.CharField(max_length=40)
+    sent_fingerprint = models.CharField(max_length=40, blank=True)
+    pending = models.BooleanField(default=False)
+    subject = models.CharField(max_length=300)
+    section = models.TextField(blank=True)
+    attempts = models.IntegerField(default=0)
+    run_after = models.DateTimeField(db_index=True)
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"{'pending' if self.pending else 'sent'} notification for {self.host_id}"
+
+
+class DemandTile(models.Model):
+    """
+    Number of located requests per system in a map tile, for demand maps and "players near you"
+    counts. Kept current by update_demand from the GameRequest save/delete paths; the
+    rebuild_demand_tiles command recomputes it from scratch.
+    zoom, tile_x, tile_y: Web Mercator tile (see functions.map_tile), at each zoom level in
+        settings.DEMAND_TILE_ZOOMS.
+    players: requests that can't DM. dms: requests that can.
+    """
+    class Meta:
+        unique_together = ['system', 'zoom', 'tile_x', 'tile_y']
+
+    system = models.CharField(max_length=200, choices=SYSTEMCHOICES)
+    zoom = models.SmallIntegerField()
+    tile_x = models.IntegerField()
+    tile_y = models.IntegerField()
+    players = models.IntegerField(default=0)
+    dms = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.system} {self.zoom}/{self.tile_x}/{self.tile_y}"
+
+
+def sync_links(existing, wanted):
+    """
+    Brings the available_dms through table in line with a freshly computed set of links.
+    existing: dict of (player_id, dm_id) -> through table row id currently in the database.
+    wanted: set of (player_id, dm_id) pairs that should exist afterwards.
+    Stale rows are removed with one DELETE and new rows added with one bulk INSERT. Both are
+    idempotent: rows already deleted or already inserted by a concurrent writer are skipped.
+    """
+    through = GameRequest.available_dms.through
+    stale = [row_id for pair, row_id in existing.items() if pair not in wanted]
+    if stale:
+        through.objects.filter(pk__in=stale).delete()
+    missing = [pair for pair in wanted if pair not in existing]
+    if missing:
+        through.objects.bulk_create([
+            through(from_gamerequest_id=player_id, to_gamerequest_id=dm_id)
+            for player_id, dm_id in missing
+        ], ignore_conflicts=True)
+
+
+def link_pairs(pairs):
+    """
+    Adds (player_id, dm_id) links to the through table in one bulk INSERT, skipping any that
+    already exist. Returns the number of pairs submitted.
+    """
+    through = GameRequest.available_dms.through
+    through.objects.bulk_create([
+        through(from_gamerequest_id=player_id, to_gamerequest_id=dm_id) for player_id, dm_id in pairs
+    ], ignore_conflicts=True)
+    return len(pairs)
+
+
+def refresh_available_dms(request):
+    """
+    Recomputes the DM/host list for a single request from every DM within its travel range.
+    DMs that are no longer valid (moved, stopped hosting, changed system or are now out of range)
+    are unlinked. A request without coordinates (e.g. an edited address that couldn't be found)
+    loses all its links, so it can't stay seated at a table it may no longer reach.
+    Uses a fixed number of queries no matter how many DMs are nearby.
+    """
+    through = GameRequest.available_dms.through
+    dm_ids = []
+    if has_coordinates(request):
+        with span('candidate_dms'):
+            dm_ids = get_matching_engine().candidate_dms(request)
+    existing = {
+        (player_id, dm_id): row_id for row_id, player_id, dm_id in through.objects.filter(
+            from_gamerequest_id=request.pk).values_list('pk', 'from_gamerequest_id', 'to_gamerequest_id')
+    }
+    sync_links(existing, {(request.pk, dm_id) for dm_id in dm_ids})
+
+
+def refresh_dm_links(dm):
+    """
+    Set-based replacement for calling save() on every request near a DM.
+    The matching engine finds every request in the same system whose own travel range
+    reaches the DM, then the through table rows pointing at this DM are diffed against that set.
+    If the request can no longer host (or has no coordinates) all links to it are removed.
+    Query count is constant regardless of how many players are nearby.
+    """
+    through = GameRequest.available_dms.through
+    with span('dm_fanout'):
+        wanted = {(player_id, dm.pk) for player_id in get_matching_engine().players_for_dm(dm)}
+        existing = {
+            (player_id, dm_id): row_id for row_id, player_id, dm_id in through.objects.filter(
+                to_gamerequest_id=dm.pk).values_list('pk', 'from_gamerequest_id', 'to_gamerequest_id')
+        }
+        sync_links(existing, wanted)
+
+
+def locate_request(instance):
+    """
+    Sets gis_point on an instance from its address, using the map API or fake coordinates
+    depending on settings. Does not save. Returns False if neither option is enabled, in which
+    case the blank coordinates are left intact. One of these options should probably be enabled
+    though, otherwise coordinates will always be () and the search won't work.
+    """
+    if settings.USE_GEOPY_API:
+        point = coordinates_from_api(
+            instance.address,
+            instance.city,
+            instance.state,
+            instance.zip
+        )
+        # Addresses that can't be found fall back to the ZIP code centroid if one is known,
+        # otherwise they keep blank coordinates and are left out of the search.
+        if point is None:
+            point = approximate_coordinates(instance.zip) if settings.USE_ZIP_CENTROIDS else None
+        instance.gis_point = point if point is not None else Point([])
+        return True
+    # To test without calling the API use fake coordinates.
+    elif settings.USE_FAKE_COORDINATES:
+        instance.gis_point = fake_coordinates(instance.zip)
+        return True
+    return False
+
+
+def match_request(instance, dm_changed=True, old_point=None):
+    """
+    Runs the matching for a saved request:
+    * Refresh the list of DMs/hosts within the request's travel range.
+    * If this person can DM, update the DM list of every request within a 500 mile radius.
+        Otherwise, a DM that makes their request after a player will not appear
+        in that player's list. A DM that stops hosting (dm_changed) also needs to be removed
+        from those lists. This is a single bulk update of the link table rather than a save()
+        per request, so no other post_saves are spawned.
+    * Re-solve the game groups of the player/DM graph within settings.REGROUP_DEPTH links of
+        this request, and email every DM whose group changed (see core.groups).
+    All of it runs in one transaction holding the advisory locks of the request's region
+    (see core.locking), so concurrent submits nearby can't miss each other's links.
+    old_point: the request's location before this save, if it moved.
+    """
+    from core.groups import update_groups
+    from core.locking import lock_match_region
+    with transaction.atomic():
+        lock_match_region(instance, old_point)
+        refresh_available_dms(instance)
+        if instance.can_dm or dm_changed:
+            refresh_dm_links(instance)
+        update_groups([instance.pk], depth=settings.REGROUP_DEPTH)
+
+
+def previous_point(instance):
+    """
+    The gis_point a request had when it was loaded, while a save is in progress (the
+    DirtyFieldsMixin snapshot is retaken once post_save has run). None if unknown.
+    """
+    return (getattr(instance, '_field_snapshot', None) or {}).get('gis_point')
+
+
+def demand_state(request):
+    """
+    (system, can_dm, lon, lat) a request counts towards in DemandTile, or None if it isn't located.
+    """
+    if not has_coordinates(request):
+        return None
+    return request.system, request.can_dm, request.gis_point.x, request.gis_point.y
+
+
+def counted_demand_state(instance):
+    """
+    The state a saved request was last counted with: the one recorded by the last update_demand
+    on this instance, or otherwise its values when it was loaded (the DirtyFieldsMixin snapshot
+    is only retaken once post_save has run).
+    """
+    if hasattr(instance, '_demand_state'):
+        return instance._demand_state
+    snapshot = getattr(instance, '_field_snapshot', None) or {}
+    if not {'system', 'can_dm', 'gis_point'} <= snapshot.keys():
+        return None
+    point = snapshot['gis_point']
+    if point is None or point.coords == ():
+        return None
+    return snapshot['system'], snapshot['can_dm'], point.x, point.y
+
+
+def update_demand(changes):
+    """
+    Applies (old state, new state) changes (see demand_state) to DemandTile, with one
+    INSERT ... ON CONFLICT statement for all affected tiles.
+    """
+    deltas = {}
+    for old, new in changes:
+        if old == new:
+            continue
+        for state, sign in ((old, -1), (new, 1)):
+            if state is None:
+                continue
+            system, can_dm, lon, lat = state
+            for zoom in settings.DEMAND_TILE_ZOOMS:
+                key = (system, zoom) + map_tile(lon, lat, zoom)
+                players, dms = deltas.get(key, (0, 0))
+                deltas[key] = (players, dms + sign) if can_dm else (players + sign, dms)
+    rows = [key + counts for key, counts in deltas.items() if counts != (0, 0)]
+    if not rows:
+        return
+    table = connection.ops.quote_name(DemandTile._meta.db_table)
+    values = ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(rows))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} (system, zoom, tile_x, tile_y, players, dms) VALUES {values} "
+            f"ON CONFLICT (system, zoom, tile_x, tile_y) DO UPDATE SET "
+            f"players = {table}.players + EXCLUDED.players, "
+            f"dms = {table}.dms + EXCLUDED.dms",
+            [value for row in rows for value in row]
+        )
+
+
+def record_demand(instance, created=False):
+    """
+    Moves a saved request's count from the state it was last counted with to its current one.
+    """
+    new = demand_state(instance)
+    update_demand([(None if created else counted_demand_state(instance), new)])
+    instance._demand_state = new
+
+
+def request_list_key(user_id):
+    return f"core:request_list:{user_id}"
+
+
+def user_request_list(user_id):
+    """
+    The user's requests for the home page as {'id', 'request_name'} dicts. Cached until one of
+    the user's requests is saved or deleted (see on_save/on_delete), or for
+    settings.REQUEST_LIST_CACHE_TIMEOUT seconds for changes that bypass the signals (bulk imports).
+    """
+    key = request_list_key(user_id)
+    requests = cache.get(key)
+    if requests is None:
+        requests = list(GameRequest.objects.filter(user_id=user_id).order_by('pk').values('id', 'request_name')[:100])
+        cache.set(key, requests, settings.REQUEST_LIST_CACHE_TIMEOUT)
+    return requests
+
+
 @receiver(post_save, sender=GameRequest)
 def on_save(sender, instance, created, update_fields, **kwargs):
     """
     # Receiver for save() on the GameRequest model.
-    To avoid causing long page load times (such as if an API rate limiter is required)
-    some data processing is handled as a post-save signal while the user is sent the next page.
     Does three things:
     * Check if the location coordinates need to be updated and, if so,
         get them from the map API.
@@ -110,7 +506,15 @@ def on_save(sender, instance, created, update_fields, **kwargs):
         of players.
     * Send an email notification for any DM that has a player group
         involving the new request.
+    With settings.USE_JOB_QUEUE enabled none of this runs here. A single MatchJob row is
+    written instead and the work is done by the run_jobs worker, so the user gets the next
+    page without waiting for the map API or the matching. The async views do the same by
+    setting defer_matching. Otherwise it runs synchronously inside the request.
+    Any save clears the owner's cached request list for the home page and moves the request's
+    count in the DemandTile aggregates.
     """
+    cache.delete(request_list_key(instance.user_id))
+    record_demand(instance, created)
     address_updated = False
 
     # In some cases (new models or saves with no changes) update_fields will be None.
@@ -118,50 +522,73 @@ def on_save(sender, instance, created, update_fields, **kwargs):
     # attempt to evaluate the if expression.
 
     if created:
-        address_updated = True
+        address_updated = not getattr(instance, '_point_given', False)
     if update_fields is None:
         pass
-    elif any([field in update_fields for field in ['address', 'city', 'state', 'zip']]):
+    elif any([field in update_fields for field in ADDRESS_FIELDS]):
         address_updated = True
+    elif not MATCH_FIELDS.intersection(update_fields):
+        return  # Only the request name changed, nothing to match.
+
+    # Keep engines with their own copy of the locations (e.g. the in-memory index) current.
+    get_matching_engine().request_saved(instance)
+
+    if settings.USE_JOB_QUEUE or defer_matching.get():
+        MatchJob.enqueue(instance, geocode=address_updated)
+        return
 
     # Either a new model or an update to an existing address calls the address to point conversion.
-    if address_updated:
-        if settings.USE_GEOPY_API:
-            instance.gis_point = coordinates_from_api(
-                instance.address,
-                instance.city,
-                instance.state,
-                instance.zip
-            )
-            instance.save()
-            return  # To avoid double emails abort this post_save attempt after saving.
-        # To test without calling the API use fake coordinates.
-        elif settings.USE_FAKE_COORDINATES:
-            instance.gis_point = fake_coordinates()
-            instance.save()
-            return
-        # Else leave blank coordinates intact. One of these options should probably be enabled
-        # though, otherwise coordinates will always be () and the search won't work.
-
-    # If this person can DM call the save function for
-    # every request within a 500 mile radius to update their DM list.
-    # Otherwise, a DM that makes their request after a player will not appear
-    # in that player's list. 500 miles because nobody will ever
-    # travel that far and it cuts the volume of requests to process.
-    # Since no other fields are changing this will not spawn more post_saves.
-    if instance.can_dm:
-        request_list = GameRequest.objects.filter(
-            gis_point__distance_lt=(instance.gis_point, Distance(mi=500)),
-            system=instance.system
-        )
-        for r in request_list:
-            # TODO potential scaling issue, can this be done with fewer database transactions?
-            r.save()
-
-    if instance.gis_point.coords != ():
-        # Find all DMs that could host this player.
-        for host in instance.available_dms.all():
-            # Find all players that list this DM as a possible host.
-            players = GameRequest.objects.filter(available_dms=host)
-            if len(players) >= 4:  # DM and 3+ players is a typical game group.
-                send_email(host, players)
+    if address_updated and locate_request(instance):
+        instance.save()
+        return  # To avoid double emails abort this post_save attempt after saving.
+
+    match_request(instance, dm_changed=update_fields is not None and 'can_dm' in update_fields,
+                  old_point=previous_point(instance))
+
+
+def group_members(instance):
+    """
+    Ids of the other requests sharing a group with this one, in a single query: the players of
+    the group it hosts, plus the host and other players of the group it plays in.
+    These are the only requests whose groups can change when it is deleted. Links and groups
+    elsewhere never depended on it, and removing a request can't complete a table that was
+    incomplete before.
+    """
+    members = Q(group__host_id=instance.pk)
+    if instance.group_id is not None:
+        members |= Q(group_id=instance.group_id) | Q(hosted_group__id=instance.group_id)
+    return set(GameRequest.objects.filter(members).exclude(pk=instance.pk).values_list('pk', flat=True))
+
+
+@receiver(pre_delete, sender=GameRequest)
+def before_delete(sender, instance, **kwargs):
+    """
+    Receiver run before a GameRequest is deleted, inside the delete's transaction.
+    Takes the request's matching locks (see lock_match_region) before the delete touches any row,
+    so the delete and the re-solve in on_delete queue behind overlapping saves instead of
+    deadlocking with them. Then records the group members that need their groups re-solved
+    once it is gone.
+    """
+    from core.locking import lock_match_region
+    lock_match_region(instance)
+    instance._group_members = group_members(instance)
+
+
+@receiver(post_delete, sender=GameRequest)
+def on_delete(sender, instance, **kwargs):
+    """
+    Receiver for delete() on the GameRequest model.
+    Clears the owner's cached request list, removes the request from the DemandTile counts and
+    from any matching engine that keeps its own index, then re-solves the groups around its
+    former group members. The deletion has already removed its links, its hosted GameGroup and
+    the group assignments pointing at that group. Only the neighbourhood within
+    settings.REGROUP_DEPTH links is loaded, so the number of queries stays bounded however
+    popular the deleted DM's table was. Changed tables are notified in bulk.
+    """
+    cache.delete(request_list_key(instance.user_id))
+    update_demand([(counted_demand_state(instance), None)])
+    get_matching_engine().request_deleted(instance)
+    members = getattr(instance, '_group_members', None)
+    if members:
+        from core.groups import update_groups
+        update_groups(members, depth=settings.REGROUP_DEPTH)
@@ -0,0 +1,168 @@
+import hashlib
+import logging
+import traceback
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from core.instrumentation import span
+from core.jobs import retry_delay
+from core.models import GameRequest, GroupNotification
+
+logger = logging.getLogger(__name__)
+
+FROM_EMAIL = 'notifications@gamefinder.com'
+
+
+def fingerprint(host_id, player_ids):
+    """
+    Identifies a group by its host and members, independent of player order.
+    """
+    key = f"{host_id}:" + ','.join(str(player) for player in sorted(player_ids))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def group_section(host, players):
+    """
+    The part of the email listing the players of one group.
+    """
+    section = f"Some players are available for {host.request_name}!\n"
+    for player in players:
+        section += f"{player.user.username}      {player.user.email}\n"
+    return section
+
+
+def queue_notifications(tables):
+    """
+    Records group changes in the outbox. tables: {host_id: [player ids]}, where an empty list
+    means the host's group was dissolved.
+    A group is queued only if it differs from the last one announced to its host. A group that
+    is dissolved, or changes back to the announced one, before its email goes out is dropped.
+    The send time of a pending entry is kept when it changes again, so a busy area gets one
+    digest per NOTIFICATION_DIGEST_DELAY instead of one email per change.
+    Returns the number of groups queued.
+    """
+    if not tables:
+        return 0
+    existing = {row.host_id: row for row in GroupNotification.objects.filter(host_id__in=tables.keys())}
+    announce = {host: members for host, members in tables.items() if members}
+    hosts = GameRequest.objects.select_related('user').in_bulk(announce.keys())
+    players = GameRequest.objects.select_related('user').in_bulk(
+        {player for members in announce.values() for player in members})
+
+    run_after = timezone.now() + settings.NOTIFICATION_DIGEST_DELAY
+    created, updated = [], []
+    for host_id, members in tables.items():
+        row = existing.get(host_id)
+        key = fingerprint(host_id, members) if members else ''
+        if row is None:
+            if not members:
+                continue
+            row = GroupNotification(host_id=host_id)
+            created.append(row)
+        elif key in ('', row.sent_fingerprint):
+            if row.pending:
+                row.pending = False
+                row.fingerprint = row.sent_fingerprint
+                updated.append(row)
+            continue
+        elif row.pending and key == row.fingerprint:
+            continue
+        else:
+            updated.append(row)
+        host = hosts[host_id]
+        row.recipient = host.user.email
+        row.subject = f"Players found for {host.request_name}!"
+        row.section = group_section(host, [players[player] for player in members])
+        row.fingerprint = key
+        if not row.pending:
+            row.run_after = run_after
+            row.attempts = 0
+        row.pending = True
+
+    if created:
+        GroupNotification.objects.bulk_create(created, ignore_conflicts=True)
+    if updated:
+        GroupNotification.objects.bulk_update(
+            updated, ['recipient', 'subject', 'section', 'fingerprint', 'pending', 'run_after', 'attempts'])
+    return sum(1 for row in created + updated if row.pending)
+
+
+def claim_notifications(batch_size):
+    """
+    Claims up to batch_size due outbox entries, locked and leased the same way as jobs
+    (see jobs.claim_jobs).
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        rows = list(GroupNotification.objects.select_for_update(skip_locked=True).filter(
+            pending=True, run_after__lte=now).order_by('run_after')[:batch_size])
+        GroupNotification.objects.filter(pk__in=[row.pk for row in rows]).update(
+            run_after=now + settings.JOB_LEASE, attempts=F('attempts') + 1)
+    for row in rows:
+        row.attempts += 1
+    return rows
+
+
+def digest_message(recipient, rows, connection):
+    """
+    One email to a recipient covering all of their claimed groups.
+    """
+    subject = rows[0].subject if len(rows) == 1 else f"Players found for {len(rows)} of your games!"
+    body = '\n'.join(row.section for row in rows)
+    return EmailMessage(subject, body, FROM_EMAIL, [recipient], connection=connection)
+
+
+def mark_sent(rows):
+    for row in rows:
+        # Only clear the entry if the group didn't change again while it was being sent.
+        GroupNotification.objects.filter(pk=row.pk, fingerprint=row.fingerprint).update(
+            pending=False, sent_fingerprint=row.fingerprint, last_error='')
+
+
+def mark_failed(rows, error):
+    now = timezone.now()
+    for row in rows:
+        current = GroupNotification.objects.filter(pk=row.pk)
+        if row.attempts >= settings.JOB_MAX_ATTEMPTS:
+            logger.error("Dropping %s after %s attempts:\n%s", row, row.attempts, error)
+            current.filter(fingerprint=row.fingerprint).update(pending=False, last_error=error)
+        else:
+            logger.warning("Sending %s failed (attempt %s), retrying:\n%s", row, row.attempts, error)
+            current.update(run_after=now + retry_delay(row.attempts), last_error=error)
+
+
+def send_due_notifications(batch_size=100):
+    """
+    Sends the due outbox entries as one digest email per recipient, all over a single mail
+    connection. Entries whose email fails are retried with backoff, like jobs.
+    Returns the number of entries claimed.
+    """
+    rows = claim_notifications(batch_size)
+    if not rows:
+        return 0
+    digests = {}
+    for row in rows:
+        digests.setdefault(row.recipient, []).append(row)
+
+    with span('send_email'):
+        connection = get_connection()
+        try:
+            connection.open()
+        except Exception:
+            mark_failed(rows, traceback.format_exc())
+            return len(rows)
+        try:
+            for recipient, entries in digests.items():
+                try:
+                    connection.send_messages([digest_message(recipient, entries, connection)])
+                except Exception:
+                    mark_failed(entries, traceback.format_exc())
+                else:
+                    mark_sent(entries)
+        finally:
+            connection.close()
+    return len(rows)
@@ -0,0 +1,107 @@
+import math
+import time
+
+from django.conf import settings
+from django.contrib.gis.geos import Polygon
+from django.db import transaction
+from django.db.models import Max
+
+from core.groups import update_groups
+from core.matching import FANOUT_RANGE, MILES_PER_DEGREE_LAT, haversine_miles, numpy
+from core.models import GameRequest, sync_links
+
+
+def find_partitions(tile_size, systems=None):
+    """
+    Lists the (system, tile_x, tile_y, halo) partitions that contain at least one request with
+    coordinates. Tiles are squares of tile_size degrees; halo is the largest travel range in the
+    system (capped at FANOUT_RANGE) in miles. Streams the points, so memory is bounded by the
+    number of distinct tiles.
+    """
+    halos = dict(GameRequest.objects.values_list('system').annotate(Max('travel_range')))
+    rows = GameRequest.objects.exclude(gis_point=None)
+    if systems:
+        rows = rows.filter(system__in=systems)
+    tiles = set()
+    for system, point in rows.values_list('system', 'gis_point').iterator():
+        if point.coords != ():
+            tiles.add((system, math.floor(point.x / tile_size), math.floor(point.y / tile_size)))
+    return [
+        (system, tile_x, tile_y, min(halos[system], FANOUT_RANGE))
+        for system, tile_x, tile_y in sorted(tiles)
+    ]
+
+
+def rematch_partition(system, tile_x, tile_y, tile_size, halo, dry_run):
+    """
+    Rebuilds the DM links of every request in one system whose point falls in one tile.
+    Loads the tile's requests and the DMs in the tile plus a halo of `halo` miles, filters them
+    with a vectorized haversine against each request's travel range (capped at FANOUT_RANGE),
+    then diffs the result against the stored links and writes the changes in bulk.
+    Returns a dict of counts and timings for the report, and the ids of the requests on either
+    end of a changed link ('changed'), whose groups need re-solving.
+    """
+    start = time.monotonic()
+    x0, y0 = tile_x * tile_size, tile_y * tile_size
+    x1, y1 = x0 + tile_size, y0 + tile_size
+    players = [
+        (pk, point.x, point.y, min(travel_range, FANOUT_RANGE)) for pk, point, travel_range in
+        GameRequest.objects.filter(
+            system=system, gis_point__contained=Polygon.from_bbox((x0, y0, x1, y1))
+        ).values_list('pk', 'gis_point', 'travel_range').iterator()
+        # Points on a tile edge belong to the tile to their north/east only.
+        if point.coords != () and math.floor(point.x / tile_size) == tile_x
+        and math.floor(point.y / tile_size) == tile_y
+    ]
+    halo_lat = halo / MILES_PER_DEGREE_LAT
+    widest = min(max(abs(y0), abs(y1)) + halo_lat, 89.0)
+    halo_lon = halo / (MILES_PER_DEGREE_LAT * math.cos(math.radians(widest)))
+    dms = [
+        (pk, point.x, point.y) for pk, point in GameRequest.objects.filter(
+            system=system, can_dm=True,
+            gis_point__contained=Polygon.from_bbox((x0 - halo_lon, max(y0 - halo_lat, -90),
+                                                    x1 + halo_lon, min(y1 + halo_lat, 90)))
+        ).values_list('pk', 'gis_point').iterator() if point.coords != ()
+    ]
+    loaded = time.monotonic()
+
+    wanted = set()
+    if players and dms:
+        dm_ids = numpy.array([dm[0] for dm in dms], dtype=numpy.int64)
+        dm_lons = numpy.array([dm[1] for dm in dms], dtype=numpy.float64)
+        dm_lats = numpy.array([dm[2] for dm in dms], dtype=numpy.float64)
+        for pk, lon, lat, travel_range in players:
+            # Inclusive, like the matching engines.
+            reachable = dm_ids[haversine_miles(lon, lat, dm_lons, dm_lats) <= travel_range]
+            wanted.update((pk, dm_id) for dm_id in reachable.tolist())
+    matched = time.monotonic()
+
+    through = GameRequest.available_dms.through
+    player_ids = [player[0] for player in players]
+    existing = {
+        (player_id, dm_id): row_id for row_id, player_id, dm_id in through.objects.filter(
+            from_gamerequest_id__in=player_ids).values_list('pk', 'from_gamerequest_id', 'to_gamerequest_id')
+    } if player_ids else {}
+    added = [pair for pair in wanted if pair not in existing]
+    removed = [pair for pair in existing if pair not in wanted]
+    if not dry_run:
+        with transaction.atomic():
+            sync_links(existing, wanted)
+    return {
+        'system': system, 'tile': (tile_x, tile_y), 'players': len(players), 'dms': len(dms),
+        'links': len(wanted), 'added': len(added), 'removed': len(removed),
+        'changed': sorted({request for pair in added + removed for request in pair}),
+        'load': loaded - start, 'match': matched - loaded, 'write': time.monotonic() - matched,
+    }
+
+
+def regroup(request_ids, notify=True, batch_size=500):
+    """
+    Re-solves the groups around requests whose links changed, batch_size seed requests at a
+    time (see core.groups.update_groups). Returns the number of tables that changed.
+    """
+    request_ids = sorted(request_ids)
+    changed = 0
+    for i in range(0, len(request_ids), batch_size):
+        changed += len(update_groups(request_ids[i:i + batch_size], notify=notify, depth=settings.REGROUP_DEPTH))
+    return changed
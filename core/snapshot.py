@@ -0,0 +1,308 @@
+import fcntl
+import math
+import os
+import shutil
+import struct
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Grid cells are CELL_SIZE degrees square. Rows are sorted by cell key, so each column of cells
+# in a bounding box is one contiguous slice found with two binary searches.
+CELL_SIZE = 1.0
+# Log record: operation, id, longitude, latitude, system code, can_dm, travel range, time written
+# (epoch seconds).
+LOG_RECORD = struct.Struct('<Bqddhbfd')
+UPSERT, DELETE = 1, 2
+COLUMNS = ('id', 'lon', 'lat', 'system', 'can_dm', 'travel_range', 'key')
+
+
+class SnapshotMissing(Exception):
+    """
+    Raised by lookups on a snapshot directory that has no generation yet, i.e. before the first
+    rebuild (the build_match_snapshot command).
+    """
+
+
+def system_codes():
+    """
+    Small integer code for each system. Codes follow SYSTEMCHOICES, so changing its order needs
+    a snapshot rebuild.
+    """
+    from core.models import SYSTEMCHOICES
+    return {code: i for i, (code, name) in enumerate(SYSTEMCHOICES)}
+
+
+def cell_x(lon):
+    return math.floor(lon / CELL_SIZE) + 180
+
+
+def cell_y(lat):
+    return math.floor(lat / CELL_SIZE) + 90
+
+
+def cell_key(system, x, y):
+    return (system << 20) | (x << 10) | y
+
+
+class MatchSnapshot:
+    """
+    Columnar copy of the match-relevant fields of every located request, shared by all processes
+    on a machine through memory-mapped files.
+    A generation is a directory of NumPy arrays: id (int64), lon/lat (float64), system code
+    (int16), can_dm (bitmap, 8 rows per byte), travel_range (float32) and the grid cell key
+    (int64). Rows are sorted by cell key. The arrays are loaded with mmap_mode='r', so every
+    process reads the same page cache copy instead of holding its own objects.
+    Changes are appended to the generation's log as fixed-size upsert/tombstone records. Each
+    process replays new log records into a small overlay before a lookup, which hides the base
+    rows they replace. rebuild() writes a new generation from the database and moves the log
+    records that the read may have missed into it (see _rebuild). The CURRENT file names the live
+    generation.
+    Writers lock the log with flock, so appends never interleave with a rebuild switching
+    generations.
+    """
+    def __init__(self, path):
+        self.path = str(path)
+        self._lock = threading.RLock()
+        self._generation = None
+        self._columns = None
+        self._log = None
+        self._log_offset = 0
+        self._overlay = {}  # id -> (lon, lat, system, can_dm, travel_range), or None for deleted
+        self._overlay_columns = None
+        self._codes = None
+
+    def _codes_for(self):
+        if self._codes is None:
+            self._codes = system_codes()
+        return self._codes
+
+    def _current(self):
+        try:
+            with open(os.path.join(self.path, 'CURRENT')) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _log_path(self, generation):
+        return os.path.join(self.path, generation, 'log')
+
+    def database_rows(self):
+        """
+        (id, lon, lat, system code, can_dm, travel_range) for every located request.
+        """
+        from core.models import GameRequest
+        codes = self._codes_for()
+        rows = []
+        for pk, system, can_dm, travel_range, point in GameRequest.objects.exclude(gis_point=None).values_list(
+                'pk', 'system', 'can_dm', 'travel_range', 'gis_point').iterator():
+            if point.coords != () and system in codes:
+                rows.append((pk, point.x, point.y, codes[system], can_dm, travel_range))
+        return rows
+
+    def rebuild(self):
+        """
+        Writes a new generation from the database and makes it current. Concurrent rebuilds
+        (from other processes too) run one at a time.
+        Returns the number of rows in it.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, 'rebuild.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                return self._rebuild()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _rebuild(self):
+        """
+        A record is appended when its request is saved, before the saving transaction commits,
+        so a change logged shortly before the database read may not be visible to it yet. Every
+        record written from MATCH_SNAPSHOT_LOG_OVERLAP seconds before the read onwards is
+        replayed into the new generation; replaying a change the read already saw is harmless.
+        """
+        from django.conf import settings
+        previous = self._current()
+        since = time.time() - settings.MATCH_SNAPSHOT_LOG_OVERLAP
+        rows = self.database_rows()
+
+        generation = f"{time.time_ns():x}-{os.getpid()}"
+        directory = os.path.join(self.path, generation)
+        building = directory + '.tmp'
+        os.makedirs(building)
+        ids = numpy.array([row[0] for row in rows], dtype=numpy.int64)
+        lons = numpy.array([row[1] for row in rows], dtype=numpy.float64)
+        lats = numpy.array([row[2] for row in rows], dtype=numpy.float64)
+        systems = numpy.array([row[3] for row in rows], dtype=numpy.int16)
+        keys = ((systems.astype(numpy.int64) << 20)
+                | ((numpy.floor(lons / CELL_SIZE).astype(numpy.int64) + 180) << 10)
+                | (numpy.floor(lats / CELL_SIZE).astype(numpy.int64) + 90))
+        order = numpy.argsort(keys, kind='stable')
+        columns = {
+            'id': ids[order],
+            'lon': lons[order],
+            'lat': lats[order],
+            'system': systems[order],
+            'can_dm': numpy.packbits(numpy.array([row[4] for row in rows], dtype=bool)[order]),
+            'travel_range': numpy.array([row[5] for row in rows], dtype=numpy.float32)[order],
+            'key': keys[order],
+        }
+        for name, values in columns.items():
+            numpy.save(os.path.join(building, f"{name}.npy"), values)
+        open(os.path.join(building, 'log'), 'wb').close()
+        os.rename(building, directory)
+
+        if previous:
+            with open(self._log_path(previous), 'rb') as old_log:
+                fcntl.flock(old_log, fcntl.LOCK_EX)
+                try:
+                    data = old_log.read()
+                    complete = len(data) // LOG_RECORD.size * LOG_RECORD.size
+                    with open(self._log_path(generation), 'ab') as new_log:
+                        for offset in range(0, complete, LOG_RECORD.size):
+                            if LOG_RECORD.unpack_from(data, offset)[-1] >= since:
+                                new_log.write(data[offset:offset + LOG_RECORD.size])
+                    self._set_current(generation)
+                finally:
+                    fcntl.flock(old_log, fcntl.LOCK_UN)
+        else:
+            self._set_current(generation)
+
+        # Processes still mapping an old generation keep their open files until they switch.
+        for name in os.listdir(self.path):
+            if name != generation and not name.startswith('CURRENT') and name != 'rebuild.lock':
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+        return len(rows)
+
+    def _set_current(self, generation):
+        pending = os.path.join(self.path, f"CURRENT.{os.getpid()}")
+        with open(pending, 'w') as f:
+            f.write(generation)
+        os.replace(pending, os.path.join(self.path, 'CURRENT'))
+
+    def _append(self, record):
+        """
+        Appends a log record to the current generation, retrying if a rebuild switches
+        generations in the meantime. Without a snapshot there is nothing to update: the first
+        rebuild reads the row from the database.
+        """
+        while True:
+            generation = self._current()
+            if generation is None:
+                return
+            try:
+                with open(self._log_path(generation), 'ab') as log:
+                    fcntl.flock(log, fcntl.LOCK_EX)
+                    try:
+                        if self._current() != generation:
+                            continue
+                        log.write(record)
+                        log.flush()
+                        return
+                    finally:
+                        fcntl.flock(log, fcntl.LOCK_UN)
+            except FileNotFoundError:
+                continue
+
+    def upsert(self, pk, system, lon, lat, can_dm, travel_range):
+        code = self._codes_for().get(system)
+        if code is None:
+            self.delete(pk)
+            return
+        self._append(LOG_RECORD.pack(UPSERT, pk, lon, lat, code, can_dm, travel_range, time.time()))
+
+    def delete(self, pk):
+        self._append(LOG_RECORD.pack(DELETE, pk, 0.0, 0.0, 0, False, 0.0, time.time()))
+
+    def _refresh(self):
+        """
+        Maps the current generation and replays new log records. Raises SnapshotMissing if there
+        is none: building one reads every request, far too slow (and lock-holding) for the first
+        lookup of a web request.
+        """
+        generation = self._current()
+        if generation is None:
+            raise SnapshotMissing(f"No match snapshot in {self.path}, run build_match_snapshot.")
+        if generation != self._generation:
+            directory = os.path.join(self.path, generation)
+            self._columns = {
+                name: numpy.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r') for name in COLUMNS
+            }
+            if self._log is not None:
+                self._log.close()
+            self._log = open(self._log_path(generation), 'rb')
+            self._log_offset = 0
+            self._overlay = {}
+            self._overlay_columns = None
+            self._generation = generation
+
+        size = os.fstat(self._log.fileno()).st_size
+        complete = (size - self._log_offset) // LOG_RECORD.size * LOG_RECORD.size
+        if complete:
+            self._log.seek(self._log_offset)
+            for op, pk, lon, lat, system, can_dm, travel_range, written in LOG_RECORD.iter_unpack(
+                    self._log.read(complete)):
+                self._overlay[pk] = (lon, lat, system, bool(can_dm), travel_range) if op == UPSERT else None
+            self._log_offset += complete
+            self._overlay_columns = None
+
+    def _overlay_arrays(self):
+        if self._overlay_columns is None:
+            live = [(pk, *record) for pk, record in self._overlay.items() if record is not None]
+            self._overlay_columns = {
+                'replaced': numpy.array(sorted(self._overlay), dtype=numpy.int64),
+                'id': numpy.array([row[0] for row in live], dtype=numpy.int64),
+                'lon': numpy.array([row[1] for row in live], dtype=numpy.float64),
+                'lat': numpy.array([row[2] for row in live], dtype=numpy.float64),
+                'system': numpy.array([row[3] for row in live], dtype=numpy.int16),
+                'can_dm': numpy.array([row[4] for row in live], dtype=bool),
+                'travel_range': numpy.array([row[5] for row in live], dtype=numpy.float64),
+            }
+        return self._overlay_columns
+
+    def nearby(self, system, lon, lat, radius):
+        """
+        Column arrays (id, lon, lat, can_dm, travel_range) for every request of a system in the
+        grid cells overlapping the bounding box of a radius (miles) around a point.
+        """
+        from core.matching import search_box
+        lon0, lat0, lon1, lat1 = search_box(lon, lat, radius)
+        x0, x1 = max(cell_x(lon0), 0), min(cell_x(lon1), 360)
+        y0, y1 = cell_y(lat0), cell_y(lat1)
+        code = self._codes_for().get(system)
+        with self._lock:
+            self._refresh()
+            base = self._columns
+            overlay = self._overlay_arrays()
+        if code is None:
+            return {name: numpy.array([]) for name in ('id', 'lon', 'lat', 'can_dm', 'travel_range')}
+
+        keys = base['key']
+        slices = []
+        for x in range(x0, x1 + 1):
+            start = numpy.searchsorted(keys, cell_key(code, x, y0), 'left')
+            end = numpy.searchsorted(keys, cell_key(code, x, y1), 'right')
+            if end > start:
+                slices.append(numpy.arange(start, end))
+        rows = numpy.concatenate(slices) if slices else numpy.array([], dtype=numpy.int64)
+        ids = base['id'][rows]
+        if len(overlay['replaced']):
+            keep = ~numpy.isin(ids, overlay['replaced'])
+            rows, ids = rows[keep], ids[keep]
+        can_dm = ((base['can_dm'][rows >> 3] >> (7 - (rows & 7))) & 1).astype(bool)
+
+        near = ((overlay['system'] == code)
+                & (overlay['lon'] >= (x0 - 180) * CELL_SIZE) & (overlay['lon'] < (x1 - 179) * CELL_SIZE)
+                & (overlay['lat'] >= (y0 - 90) * CELL_SIZE) & (overlay['lat'] < (y1 - 89) * CELL_SIZE))
+        return {
+            'id': numpy.concatenate([ids, overlay['id'][near]]),
+            'lon': numpy.concatenate([base['lon'][rows], overlay['lon'][near]]),
+            'lat': numpy.concatenate([base['lat'][rows], overlay['lat'][near]]),
+            'can_dm': numpy.concatenate([can_dm, overlay['can_dm'][near]]),
+            'travel_range': numpy.concatenate([base['travel_range'][rows].astype(numpy.float64),
+                                               overlay['travel_range'][near]]),
+        }
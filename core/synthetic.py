@@ -0,0 +1,71 @@
+import math
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import Point
+
+from core.geocoding import get_zip_centroids
+from core.matching import MILES_PER_DEGREE_LAT
+from core.models import SYSTEMCHOICES, GameRequest
+
+
+def synthetic_points(count, cities=10, spread=15.0, rng=random):
+    """
+    Random points clustered around real city centres from the bundled ZIP code table.
+    cities: number of city centres used (the first N ZIP codes of a shuffled table).
+    spread: standard deviation of the distance from the city centre in miles. Smaller values
+        give denser populations.
+    Returns a list of (longitude, latitude, zip_code) tuples.
+    """
+    centroids = list(get_zip_centroids().centroids.items())
+    rng.shuffle(centroids)
+    centres = centroids[:max(1, min(cities, len(centroids)))]
+    points = []
+    for _ in range(count):
+        zip_code, (lon, lat) = rng.choice(centres)
+        dlat = rng.gauss(0, spread) / MILES_PER_DEGREE_LAT
+        dlon = rng.gauss(0, spread) / (MILES_PER_DEGREE_LAT * math.cos(math.radians(lat)))
+        points.append((lon + dlon, lat + dlat, zip_code))
+    return points
+
+
+def create_population(size, dm_ratio=0.2, systems=None, travel_ranges=(5, 50), cities=10,
+                      spread=15.0, seed=None, prefix='synthetic'):
+    """
+    Creates `size` users with one GameRequest each using bulk_create, so no geocoding,
+    matching or emails happen. Links are not created; run a rematch (or MatchingEngine.match_pairs)
+    afterwards if the benchmark needs them.
+    dm_ratio: fraction of requests that can DM.
+    systems: system codes to pick from (default: all SYSTEMCHOICES).
+    travel_ranges: (min, max) travel range in miles, picked uniformly.
+    cities, spread: see synthetic_points.
+    Returns the created GameRequests with primary keys loaded.
+    """
+    rng = random.Random(seed)
+    systems = systems or [code for code, name in SYSTEMCHOICES]
+    password = make_password(None)
+    users = User.objects.bulk_create([
+        User(username=f"{prefix}_{i}", email=f"{prefix}_{i}@example.com", password=password)
+        for i in range(size)
+    ])
+    if users and users[0].pk is None:
+        users = list(User.objects.filter(username__startswith=f"{prefix}_").order_by('pk'))
+    requests = []
+    for user, (lon, lat, zip_code) in zip(users, synthetic_points(size, cities, spread, rng)):
+        requests.append(GameRequest(
+            user=user,
+            request_name=f"{user.username} game",
+            system=rng.choice(systems),
+            can_dm=rng.random() < dm_ratio,
+            travel_range=rng.randint(*travel_ranges),
+            address=f"{rng.randint(1, 9999)} Main St",
+            city='',
+            state='',
+            zip=zip_code,
+            gis_point=Point(lon, lat),
+        ))
+    GameRequest.objects.bulk_create(requests)
+    if requests and requests[0].pk is None:
+        requests = list(GameRequest.objects.filter(user__username__startswith=f"{prefix}_"))
+    return requests
@@ -1,3 +1,1749 @@
-from django.test import TestCase
+import asyncio
+import csv
+import io
+import itertools
+import json
+import math
+import os
+import random
+import tempfile
+import time
+import threading
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from collections import Counter
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.contrib.admin.sites import AdminSite
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import Point
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.db.models.signals import post_save
+from django.http import HttpResponse
+from django.test import (
+    AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from core import views
+from core.admin import EstimatedCountPaginator, GameRequestAdmin
+from core.db import PIN_COOKIE, REPLICA, ReplicaPinMiddleware, ReplicaRouter, replica_reads
+from core.export import TABLES, export_chunks
+from core.functions import coordinates_for_addresses, map_tile, normalize_address
+from core.geocoding import ClientPool, NominatimGeocoder, TokenBucket, ZipCentroids
+from core.groups import solve_groups, update_groups
+from core.instrumentation import InstrumentationMiddleware, metrics, render_prometheus, span
+from core.jobs import claim_jobs, process_job
+from core.matching import (
+    EARTH_RADIUS_MI, FANOUT_RANGE, InMemoryMatchingEngine, PostGISMatchingEngine, SnapshotMatchingEngine,
+    get_matching_engine, has_coordinates, haversine_miles, numpy, system_index_name
+)
+from core.models import (
+    GROUP_SIZE, DemandTile, GameGroup, GameRequest, GeocodeCache, GroupNotification, MatchJob, link_pairs
+)
+from core.notifications import queue_notifications, send_due_notifications
+from core.rematch import find_partitions, regroup, rematch_partition
+from core.snapshot import MatchSnapshot, SnapshotMissing
+from core.synthetic import create_population
+
+
+@skipUnless(numpy is not None, 'The in-memory matching engine needs NumPy.')
+@override_settings(USE_GEOPY_API=False, USE_JOB_QUEUE=False, MATCHING_ENGINE='core.matching.InMemoryMatchingEngine',
+                   EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class DMFanoutTests(TestCase):
+    """
+    A DM's save updates the DM list of every player around it with one diff of the link table
+    (refresh_dm_links) instead of a save() per player.
+    """
+    def setUp(self):
+        get_matching_engine.cache_clear()
+        self.addCleanup(get_matching_engine.cache_clear)
+
+    def populate(self, players, prefix):
+        """
+        A DM and players within a few miles of it, none of them linked yet. Returns the DM.
+        """
+        rng = random.Random(players)
+        users = User.objects.bulk_create([
+            User(username=f"{prefix}{i}", email=f"{prefix}{i}@example.com") for i in range(players + 1)
+        ])
+        if users[0].pk is None:
+            users = list(User.objects.filter(username__startswith=prefix).order_by('pk'))
+        GameRequest.objects.bulk_create([
+            GameRequest(user=user, request_name=prefix, system='5e', can_dm=i == 0, travel_range=30,
+                        address='1 Main St', city='', state='', zip='',
+                        gis_point=Point(-122.33 + rng.uniform(-0.1, 0.1), 47.61 + rng.uniform(-0.1, 0.1)))
+            for i, user in enumerate(users)
+        ])
+        dm = GameRequest.objects.get(request_name=prefix, can_dm=True)
+        engine = get_matching_engine()
+        engine.reset()
+        engine.players_for_dm(dm)  # Load the index outside the counted queries.
+        cache.clear()
+        return dm
+
+    def players_of(self, dm):
+        through = GameRequest.available_dms.through
+        return set(through.objects.filter(to_gamerequest=dm).exclude(from_gamerequest=dm).values_list(
+            'from_gamerequest_id', flat=True))
+
+    def test_dm_save_queries_do_not_grow_with_players(self):
+        with transaction.atomic():
+            dm = self.populate(5, 'few')
+            dm.travel_range += 1
+            with CaptureQueriesContext(connection) as context:
+                dm.save()
+            self.assertEqual(len(self.players_of(dm)), 5)
+            transaction.set_rollback(True)
+
+        dm = self.populate(400, 'many')
+        dm.travel_range += 1
+        with self.assertNumQueries(len(context.captured_queries)):
+            dm.save()
+        self.assertEqual(len(self.players_of(dm)), 400)
+
+    def test_dm_leaves_every_list_when_it_stops_hosting_or_moves_away(self):
+        for change in ('stops', 'moves'):
+            with self.subTest(change), transaction.atomic():
+                dm = self.populate(20, change)
+                dm.travel_range += 1
+                dm.save()
+                self.assertEqual(len(self.players_of(dm)), 20)
+                if change == 'stops':
+                    dm.can_dm = False
+                else:
+                    dm.gis_point = Point(-73.99, 40.73)
+                dm.save()
+                self.assertEqual(self.players_of(dm), set())
+                self.assertFalse(GameRequest.objects.filter(group__host=dm).exists())
+                transaction.set_rollback(True)
+
+
+def destination(lon, lat, miles, bearing):
+    """
+    The point miles from (lon, lat) along a bearing in degrees, on the sphere of haversine_miles.
+    """
+    angle = miles / EARTH_RADIUS_MI
+    lon, lat, bearing = math.radians(lon), math.radians(lat), math.radians(bearing)
+    lat2 = math.asin(math.sin(lat) * math.cos(angle) + math.cos(lat) * math.sin(angle) * math.cos(bearing))
+    lon2 = lon + math.atan2(math.sin(bearing) * math.sin(angle) * math.cos(lat),
+                            math.cos(angle) - math.sin(lat) * math.sin(lat2))
+    return math.degrees(lon2), math.degrees(lat2)
+
+
+def miles_between(a, b):
+    return float(haversine_miles(a[0], a[1], numpy.array([b[0]]), numpy.array([b[1]]))[0])
+
+
+def at_range(lon, lat, miles, north):
+    """
+    The point due north (or south) of (lon, lat) that is as close to exactly miles away as
+    floats allow without going over.
+    """
+    pole = 90.0 if north else -90.0
+    point = destination(lon, lat, miles, 0 if north else 180)
+    while miles_between((lon, lat), point) > miles:
+        point = (point[0], math.nextafter(point[1], lat))
+    while miles_between((lon, lat), (point[0], math.nextafter(point[1], pole))) <= miles:
+        point = (point[0], math.nextafter(point[1], pole))
+    return point
+
+
+@skipUnless(numpy is not None, 'The in-memory and snapshot matching engines need NumPy.')
+@override_settings(USE_GEOPY_API=False, USE_JOB_QUEUE=False,
+                   EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class EngineParityTests(TestCase):
+    """
+    Checks that the in-memory and snapshot engines find the same DMs and players as the PostGIS
+    engine, and that their indexes follow saves and deletes made through the model signals.
+    The expected answer is worked out pair by pair with haversine_miles from the database rows.
+    Besides a random population, requests are placed on and around grid cell edges and corners,
+    at the travel range give or take 1e-7 of it, and as close to exactly at the range as floats
+    allow. PostGIS rounds its distances differently, so it is only compared away from those last
+    points.
+    """
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(MATCH_SNAPSHOT_DIR=directory.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        get_matching_engine.cache_clear()
+        self.addCleanup(get_matching_engine.cache_clear)
+
+        create_population(150, dm_ratio=0.3, systems=['5e', '4e'], travel_ranges=(5, 60), cities=3,
+                          spread=40.0, seed=2, prefix='parity')
+        requests = []
+        # A DM on a cell corner, one just inside the corner cell and one on a cell edge, each with
+        # players all around at their travel range.
+        for dm in ((-122.0, 47.0), (-121.9999999, 46.9999999), (-100.0, 40.5)):
+            requests.append(('5e', True, 20, dm))
+            for bearing in range(0, 360, 45):
+                for miles in (20 * (1 - 1e-7), 20 * (1 + 1e-7)):
+                    requests.append(('5e', False, 20, destination(*dm, miles, bearing)))
+            for north in (True, False):
+                requests.append(('5e', False, 20, at_range(*dm, 20, north)))
+            # Players on the cell lines through the DM, either side of them.
+            for offset in (-1e-9, 0.0, 1e-9):
+                requests.append(('5e', False, 5, (dm[0] + offset, dm[1] + 0.05)))
+                requests.append(('5e', False, 5, (dm[0] + 0.05, dm[1] + offset)))
+            # The same DM in another system, which nobody above may find.
+            requests.append(('4e', True, 20, dm))
+        # At 60 degrees north a circle is widest in longitude well north of its centre. This DM is
+        # in the cell just past a search box worked out from the centre latitude.
+        angle = 399 / EARTH_RADIUS_MI
+        bearing = math.degrees(math.acos(math.tan(angle) * math.tan(math.radians(60.0))))
+        widest = destination(20.0, 60.0, 399, bearing)[0]
+        player = (20.0 + 32.005 - widest, 60.0)
+        requests.append(('5e', False, 400, player))
+        requests.append(('5e', True, 10, destination(*player, 399, bearing)))
+
+        users = User.objects.bulk_create([User(username=f"edge{i}") for i in range(len(requests))])
+        if users[0].pk is None:
+            users = list(User.objects.filter(username__startswith='edge').order_by('pk'))
+        GameRequest.objects.bulk_create([
+            GameRequest(user=user, request_name='edge', system=system, can_dm=can_dm, travel_range=travel_range,
+                        gis_point=Point(*point))
+            for user, (system, can_dm, travel_range, point) in zip(users, requests)
+        ])
+
+    def expected(self):
+        """
+        (requests, {id: candidate DM ids}, {id: player ids}, pairs near the travel range).
+        """
+        requests = [r for r in GameRequest.objects.all() if has_coordinates(r)]
+        lons = numpy.array([r.gis_point.x for r in requests])
+        lats = numpy.array([r.gis_point.y for r in requests])
+        candidates = {r.pk: set() for r in requests}
+        players = {r.pk: set() for r in requests}
+        ties = set()
+        for player in requests:
+            distances = haversine_miles(player.gis_point.x, player.gis_point.y, lons, lats)
+            for dm, miles in zip(requests, distances.tolist()):
+                if not dm.can_dm or dm.system != player.system:
+                    continue
+                if abs(miles - player.travel_range) < 1e-9 * player.travel_range:
+                    ties.add((player.pk, dm.pk))
+                if miles <= player.travel_range:
+                    candidates[player.pk].add(dm.pk)
+                    if miles <= FANOUT_RANGE:
+                        players[dm.pk].add(player.pk)
+        return requests, candidates, players, ties
+
+    def assertAgrees(self, engine, exact=True):
+        requests, candidates, players, ties = self.expected()
+        ignored = set() if exact else ties
+        for request in requests:
+            self.assertEqual(
+                {(request.pk, dm) for dm in engine.candidate_dms(request)} - ignored,
+                {(request.pk, dm) for dm in candidates[request.pk]} - ignored, request)
+            self.assertEqual(
+                {(player, request.pk) for player in engine.players_for_dm(request)} - ignored,
+                {(player, request.pk) for player in players[request.pk]} - ignored, request)
+        pairs = {(player, dm) for player, dms in candidates.items() for dm in dms}
+        self.assertEqual(engine.match_pairs(requests) - ignored, pairs - ignored)
+
+    def test_in_memory_engine(self):
+        self.assertAgrees(InMemoryMatchingEngine())
+
+    def test_snapshot_engine(self):
+        engine = SnapshotMatchingEngine()
+        engine.reset()
+        self.assertAgrees(engine)
+
+    @skipUnless(connection.vendor == 'postgresql', 'The PostGIS engine needs PostgreSQL.')
+    def test_postgis_engine(self):
+        self.assertAgrees(PostGISMatchingEngine(), exact=False)
+
+    def test_indexes_follow_saves_and_deletes(self):
+        for path in ('core.matching.InMemoryMatchingEngine', 'core.matching.SnapshotMatchingEngine'):
+            with self.subTest(engine=path), override_settings(MATCHING_ENGINE=path), transaction.atomic():
+                get_matching_engine.cache_clear()
+                engine = get_matching_engine()
+                engine.reset()
+                self.assertAgrees(engine)
+                dm = GameRequest(user=User.objects.create(username=f"moving{path}"), request_name='moving',
+                                 system='5e', can_dm=True, travel_range=20, address='1 Main St', city='',
+                                 state='', zip='', gis_point=Point(-121.95, 47.05))
+                dm.save()
+                self.assertAgrees(engine)
+                dm.gis_point = Point(-100.01, 40.49)
+                dm.save()
+                self.assertAgrees(engine)
+                dm.system = '4e'
+                dm.save()
+                self.assertAgrees(engine)
+                dm.can_dm = False
+                dm.save()
+                self.assertAgrees(engine)
+                dm.delete()
+                self.assertAgrees(engine)
+                transaction.set_rollback(True)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Query plans are only checked on PostGIS.')
+class MatchingIndexTests(TestCase):
+    """
+    Fails if the matching queries stop using their system's geography GiST index
+    (core.matching.create_system_indexes).
+    Sequential scans are disabled so the (small) test table can't make a scan look cheaper.
+    """
+    def setUp(self):
+        user = User.objects.create(username='indexes')
+        self.request = GameRequest(user=user, request_name='plan', system='5e', can_dm=True,
+                                   travel_range=25, gis_point=Point(-123.4227, 48.1065))
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def assertUsesIndex(self, queryset, index):
+        plan = queryset.explain()
+        self.assertIn(index, plan, plan)
+
+    def test_candidate_dms_uses_geography_index(self):
+        queryset = PostGISMatchingEngine().candidate_dms_queryset(self.request)
+        self.assertUsesIndex(queryset, system_index_name('5e', dms=True))
+
+    def test_players_for_dm_uses_geography_index(self):
+        queryset = PostGISMatchingEngine().players_for_dm_queryset(self.request)
+        self.assertUsesIndex(queryset, system_index_name('5e'))
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Advisory locks are only used on PostgreSQL.')
+# Requests are created with coordinates, so no lookups or ZIP centroids replace them.
+@override_settings(USE_GEOPY_API=False, USE_JOB_QUEUE=False, MATCHING_ENGINE='core.matching.PostGISMatchingEngine',
+                   EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class ConcurrentMatchingTests(TransactionTestCase):
+    """
+    Submits overlapping requests from several threads at once and checks that the links come out
+    the same as submitting them one at a time, and that no request is seated at two tables.
+    All requests are within a few miles of each other, so almost every submit conflicts.
+    """
+    THREADS = 8
+    REQUESTS = 120
+
+    def setUp(self):
+        get_matching_engine.cache_clear()
+        rng = random.Random(7)
+        self.submissions = [
+            (User.objects.create(username=f"stress{i}", email=f"stress{i}@example.com"), {
+                'can_dm': rng.random() < 0.25,
+                'travel_range': rng.randint(5, 30),
+                'point': (-122.33 + rng.uniform(-0.2, 0.2), 47.61 + rng.uniform(-0.2, 0.2)),
+            }) for i in range(self.REQUESTS)
+        ]
+
+    def submit(self, user, spec):
+        GameRequest(user=user, request_name='stress', system='5e', can_dm=spec['can_dm'],
+                    travel_range=spec['travel_range'], address='1 Main St', city='', state='', zip='',
+                    gis_point=Point(*spec['point'])).save()
+
+    def links(self):
+        # Keyed by user so runs with different request ids can be compared.
+        through = GameRequest.available_dms.through
+        return set(through.objects.values_list('from_gamerequest__user_id', 'to_gamerequest__user_id'))
+
+    def assertValidGroups(self):
+        through = GameRequest.available_dms.through
+        links = set(through.objects.values_list('from_gamerequest_id', 'to_gamerequest_id'))
+        hosts = set(GameGroup.objects.values_list('host_id', flat=True))
+        tables = {}
+        for player, host in GameRequest.objects.filter(group__isnull=False).values_list('pk', 'group__host_id'):
+            self.assertIn((player, host), links)
+            self.assertNotIn(player, hosts)
+            tables.setdefault(host, []).append(player)
+        for host in hosts:
+            self.assertGreaterEqual(len(tables.get(host, [])), GROUP_SIZE - 1)
+
+    def run_concurrently(self, actions):
+        """
+        Runs the callables in actions from THREADS threads at once.
+        """
+        barrier = threading.Barrier(self.THREADS)
+        errors = []
+
+        def worker(actions):
+            try:
+                barrier.wait()
+                for action in actions:
+                    action()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=worker, args=(actions[i::self.THREADS],))
+            for i in range(self.THREADS)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_concurrent_submits_match_serial_run(self):
+        self.run_concurrently([
+            lambda user=user, spec=spec: self.submit(user, spec) for user, spec in self.submissions
+        ])
+        concurrent = self.links()
+        self.assertValidGroups()
+
+        GameRequest.objects.all().delete()
+        for user, spec in self.submissions:
+            self.submit(user, spec)
+        self.assertValidGroups()
+        self.assertEqual(concurrent, self.links())
+
+    def test_concurrent_deletes_and_submits(self):
+        first, second = self.submissions[::2], self.submissions[1::2]
+        for user, spec in first:
+            self.submit(user, spec)
+        deleted = [user for user, spec in first[::2]]
+        actions = [lambda user=user: GameRequest.objects.get(user=user).delete() for user in deleted]
+        actions += [lambda user=user, spec=spec: self.submit(user, spec) for user, spec in second]
+        random.Random(11).shuffle(actions)
+        self.run_concurrently(actions)
+        concurrent = self.links()
+        self.assertValidGroups()
+
+        GameRequest.objects.all().delete()
+        for user, spec in self.submissions:
+            if user not in deleted:
+                self.submit(user, spec)
+        self.assertValidGroups()
+        self.assertEqual(concurrent, self.links())
+
+
+@skipUnless(numpy is not None, 'The in-memory matching engine needs NumPy.')
+@override_settings(USE_GEOPY_API=False, USE_FAKE_COORDINATES=True, USE_ZIP_CENTROIDS=True,
+                   USE_JOB_QUEUE=False, MATCHING_ENGINE='core.matching.InMemoryMatchingEngine',
+                   EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class QueryCountTests(TestCase):
+    """
+    Runs the views through the test client against populations of increasing size and fails if
+    the number of queries changes with the size, which is what an N+1 pattern looks like.
+    Every population is one dense cluster in a single system where every player reaches every DM,
+    so the player/DM graph has the same shape at every size and only the number of rows grows.
+    Uses the in-memory matching engine so it also runs on the SpatiaLite stand-in database
+    (GAMEFINDER_DATABASE=spatialite).
+    """
+    SIZES = (25, 100, 400)
+
+    def setUp(self):
+        get_matching_engine.cache_clear()
+        self.addCleanup(get_matching_engine.cache_clear)
+
+    def populate(self, size):
+        population = create_population(size, dm_ratio=0.2, systems=['5e'], travel_ranges=(40, 60),
+                                       cities=1, spread=2.0, seed=size, prefix=f"count{size}")
+        engine = get_matching_engine()
+        engine.reset()
+        link_pairs(engine.match_pairs(population))
+        update_groups([population[0].pk], notify=False)
+        return population
+
+    def count_queries(self, scenario):
+        """
+        {population size: queries} for scenario(population), which returns the callable to measure.
+        Each size runs in a rolled back savepoint with a cold cache and matching index.
+        """
+        counts = {}
+        for size in self.SIZES:
+            with transaction.atomic():
+                population = self.populate(size)
+                run = scenario(population)
+                cache.clear()
+                get_matching_engine().reset()
+                with CaptureQueriesContext(connection) as context:
+                    run()
+                counts[size] = len(context.captured_queries)
+                transaction.set_rollback(True)
+        return counts
+
+    def assertConstantQueries(self, scenario):
+        counts = self.count_queries(scenario)
+        self.assertEqual(len(set(counts.values())), 1, f"Query count grows with the population: {counts}")
+
+    def login(self, game_request):
+        self.client.force_login(game_request.user)
+
+    def busiest_dm(self, population):
+        through = GameRequest.available_dms.through
+        dm_id, _ = Counter(through.objects.values_list('to_gamerequest_id', flat=True)).most_common(1)[0]
+        return GameRequest.objects.get(pk=dm_id)
+
+    def form_data(self, game_request, **changes):
+        data = {field: getattr(game_request, field) for field in
+                ('request_name', 'system', 'can_dm', 'travel_range', 'address', 'city', 'state', 'zip')}
+        data.update(changes)
+        if not data['can_dm']:
+            del data['can_dm']
+        return data
+
+    def test_index(self):
+        def scenario(population):
+            self.login(population[0])
+            return lambda: self.assertEqual(self.client.get(reverse('core:index')).status_code, 200)
+        self.assertConstantQueries(scenario)
+
+    def test_details(self):
+        def scenario(population):
+            dm = self.busiest_dm(population)
+            self.login(dm)
+            return lambda: self.assertEqual(self.client.get(reverse('core:details', args=[dm.pk])).status_code, 200)
+        self.assertConstantQueries(scenario)
+
+    def submit_new(self, can_dm):
+        def scenario(population):
+            template = population[0]
+            user = User.objects.create(username=f"submitter{len(population)}", email='submitter@example.com')
+            self.client.force_login(user)
+            data = self.form_data(template, request_name='new', can_dm=can_dm)
+            return lambda: self.assertEqual(self.client.post(reverse('core:submit', args=[0]), data).status_code, 302)
+        return scenario
+
+    def test_submit_player(self):
+        self.assertConstantQueries(self.submit_new(False))
+
+    def test_submit_dm(self):
+        self.assertConstantQueries(self.submit_new(True))
+
+    def test_submit_update(self):
+        def scenario(population):
+            dm = self.busiest_dm(population)
+            self.login(dm)
+            data = self.form_data(dm, travel_range=dm.travel_range + 1)
+            return lambda: self.assertEqual(
+                self.client.post(reverse('core:submit', args=[dm.pk]), data).status_code, 302)
+        self.assertConstantQueries(scenario)
+
+    def test_delete(self):
+        def scenario(population):
+            dm = self.busiest_dm(population)
+            self.login(dm)
+            return lambda: self.assertEqual(self.client.get(reverse('core:delete', args=[dm.pk])).status_code, 302)
+        self.assertConstantQueries(scenario)
+
+    def test_api_requests(self):
+        def scenario(population):
+            dm = self.busiest_dm(population)
+            self.login(dm)
+            return lambda: self.assertEqual(self.client.get(reverse('core:api requests')).status_code, 200)
+        self.assertConstantQueries(scenario)
+
+
+class ReplicaRoutingTests(SimpleTestCase):
+    """
+    Routing decisions of core.db.ReplicaRouter. The replica tests need a second database alias:
+    GAMEFINDER_REPLICA_NAME=<any name> python manage.py test (it is mirrored to default).
+    """
+    def setUp(self):
+        self.router = ReplicaRouter()
+        self.factory = RequestFactory()
+
+    def read_databases(self, request):
+        """
+        Where a replica_reads view reads requests and users from.
+        """
+        @replica_reads
+        def view(request):
+            return self.router.db_for_read(GameRequest), self.router.db_for_read(User)
+        return view(request)
+
+    def test_writes_and_other_views_use_primary(self):
+        self.assertEqual(self.router.db_for_read(GameRequest), 'default')
+        self.assertEqual(self.router.db_for_write(GameRequest, instance=GameRequest()), 'default')
+        self.assertFalse(self.router.allow_migrate(REPLICA, 'core'))
+
+    @skipUnless(REPLICA in settings.DATABASES, 'No replica database configured.')
+    def test_read_views_use_replica(self):
+        self.assertEqual(self.read_databases(self.factory.get('/')), (REPLICA, 'default'))
+
+    @skipUnless(REPLICA in settings.DATABASES, 'No replica database configured.')
+    def test_reads_after_a_write_stay_on_primary(self):
+        def view(request):
+            self.router.db_for_write(GameRequest)
+            return HttpResponse()
+        # Any method counts, as long as something was written.
+        response = ReplicaPinMiddleware(view)(self.factory.get('/'))
+        self.assertIn(PIN_COOKIE, response.cookies)
+        get = self.factory.get('/')
+        get.COOKIES[PIN_COOKIE] = response.cookies[PIN_COOKIE].value
+        self.assertEqual(self.read_databases(get), ('default', 'default'))
+
+    def test_reads_do_not_pin(self):
+        response = ReplicaPinMiddleware(lambda request: HttpResponse())(self.factory.post('/'))
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+
+@skipUnless(REPLICA in settings.DATABASES, 'No replica database configured.')
+class ReplicaStickinessTests(TestCase):
+    """
+    The index page right after a delete (a GET) must read the primary, or the replica's copy of
+    the deleted request ends up in the user's cached request list.
+    """
+    databases = {'default', REPLICA}
+
+    def test_index_after_delete_reads_primary(self):
+        user = User.objects.create(username='sticky')
+        GameRequest.objects.bulk_create([
+            GameRequest(user=user, request_name='gone', system='5e', travel_range=10, gis_point=Point(-122.33, 47.61))
+        ])
+        game_request = GameRequest.objects.get(user=user)
+        self.client.force_login(user)
+        response = self.client.get(reverse('core:delete', args=[game_request.pk]))
+        self.assertIn(PIN_COOKIE, response.cookies)
+
+        cache.clear()
+        with CaptureQueriesContext(connections[REPLICA]) as replica:
+            response = self.client.get(reverse('core:index'))
+        self.assertEqual(replica.captured_queries, [])
+        self.assertEqual(list(response.context['GameRequestList']), [])
+
+
+def best_table_count(edges, table_size):
+    """
+    Brute force: the most hosts that can all get table_size players at once.
+    """
+    nodes = sorted({node for edge in edges for node in edge})
+    best = 0
+    # Fillable host sets stay fillable when a host is removed, so sizes can be tried in order.
+    for size in range(1, len(nodes) + 1):
+        if not any(fillable(set(hosts), edges, table_size) for hosts in itertools.combinations(nodes, size)):
+            break
+        best = size
+    return best
+
+
+def fillable(hosts, edges, table_size):
+    """
+    Tries every assignment of the non-host players to hosts they link to.
+    """
+    options = {}
+    for player, host in edges:
+        if player != host and host in hosts and player not in hosts:
+            options.setdefault(player, set()).add(host)
+    players = list(options)
+    for choice in itertools.product(*[sorted(options[player]) + [None] for player in players]):
+        seats = Counter(host for host in choice if host is not None)
+        if all(seats[host] == table_size for host in hosts):
+            return True
+    return False
+
+
+class SolveGroupsTests(SimpleTestCase):
+    """
+    core.groups.solve_groups against a brute-force oracle on small random graphs.
+    """
+    def assertValidTables(self, tables, edges, table_size, max_table):
+        links = set(edges)
+        seated = []
+        for host, players in tables.items():
+            self.assertGreaterEqual(len(players), table_size)
+            self.assertLessEqual(len(players), max_table)
+            for player in players:
+                self.assertIn((player, host), links)
+            seated += [host] + players
+        self.assertEqual(len(seated), len(set(seated)), 'A request is at more than one table.')
+
+    def test_known_graph(self):
+        edges = [(0, 7), (1, 7), (2, 3), (2, 5), (2, 7), (3, 1), (4, 1), (4, 7), (5, 1), (6, 5), (6, 7),
+                 (7, 5), (8, 3)]
+        tables = solve_groups(edges, 3)
+        self.assertValidTables(tables, edges, 3, 3)
+        self.assertEqual(len(tables), 2)
+
+    def test_matches_brute_force(self):
+        rng = random.Random(12)
+        for _ in range(150):
+            nodes = rng.randint(4, 8)
+            edges = [(rng.randrange(nodes), rng.randrange(nodes)) for _ in range(rng.randint(3, 14))]
+            table_size = rng.choice([1, 2, 3])
+            max_table = table_size + rng.choice([0, 1, 2])
+            current = {rng.randrange(nodes): rng.randrange(nodes) for _ in range(2)}
+            tables = solve_groups(edges, table_size, max_table, current)
+            self.assertValidTables(tables, edges, table_size, max_table)
+            self.assertEqual(len(tables), best_table_count(edges, table_size), edges)
+
+    def test_keeps_current_groups(self):
+        edges = [(player, host) for host in (10, 20) for player in range(1, 7)]
+        current = {1: 10, 2: 10, 3: 10, 4: 20, 5: 20, 6: 20}
+        self.assertEqual(solve_groups(edges, 3, 3, current), {10: [1, 2, 3], 20: [4, 5, 6]})
+
+
+class GroupUpdateTests(TestCase):
+    """
+    update_groups and the delete path on small hand-built graphs.
+    """
+    def build(self, dms, links, groups):
+        """
+        One request per letter, created without signals, so no matching runs.
+        dms: letters of the requests that can DM. links: 'PD' strings, player P can play with DM D.
+        groups: {host letter: player letters} of the existing tables.
+        """
+        names = sorted(set(''.join(links)) | set(groups) | set(''.join(groups.values())))
+        users = [User.objects.create(username=f"groups_{name}") for name in names]
+        GameRequest.objects.bulk_create([
+            GameRequest(user=user, request_name=name, system='5e', can_dm=name in dms, travel_range=10,
+                        gis_point=Point(-122.33, 47.61)) for user, name in zip(users, names)
+        ])
+        self.requests = {r.request_name: r for r in GameRequest.objects.filter(user__in=users)}
+        through = GameRequest.available_dms.through
+        through.objects.bulk_create([
+            through(from_gamerequest_id=self.requests[player].pk, to_gamerequest_id=self.requests[dm].pk)
+            for player, dm in links
+        ])
+        for host, players in groups.items():
+            group = GameGroup.objects.create(host=self.requests[host])
+            GameRequest.objects.filter(request_name__in=players, user__in=users).update(group=group)
+
+    def tables(self):
+        tables = {}
+        for player, host in GameRequest.objects.filter(group__isnull=False).values_list(
+                'request_name', 'group__host__request_name'):
+            tables.setdefault(host, set()).add(player)
+        return tables
+
+    def test_tables_form_and_dissolve(self):
+        # Three linked players fill H's table; once R's link is gone it is one short.
+        self.build('H', ['PH', 'QH', 'RH'], {})
+        update_groups([self.requests['P'].pk], notify=False)
+        self.assertEqual(self.tables(), {'H': {'P', 'Q', 'R'}})
+        GameRequest.available_dms.through.objects.filter(from_gamerequest=self.requests['R']).delete()
+        update_groups([self.requests['R'].pk], notify=False)
+        self.assertEqual(self.tables(), {})
+        self.assertFalse(GameGroup.objects.exists())
+
+    def test_truncated_walk_keeps_groups_it_did_not_load(self):
+        # Walking one step from S reaches H and all of H's players, but not the links between them.
+        self.build('SH', ['PS', 'QS', 'RS', 'PH', 'QH', 'RH', 'SH'], {'H': 'PQR'})
+        update_groups([self.requests['S'].pk], notify=False, depth=1)
+        self.assertEqual(self.tables(), {'H': {'P', 'Q', 'R'}})
+
+    def test_player_without_link_leaves_its_table(self):
+        # P's link to H is gone; T can take its seat.
+        self.build('H', ['QH', 'RH', 'TH'], {'H': 'PQR'})
+        update_groups([self.requests['P'].pk], notify=False, depth=2)
+        self.assertEqual(self.tables(), {'H': {'Q', 'R', 'T'}})
+
+    @override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+    def test_deleting_a_host_reseats_its_players(self):
+        # D can take H's whole table; E's own table is untouched.
+        self.build('HDE', ['PH', 'QH', 'RH', 'PD', 'QD', 'RD', 'XE', 'YE', 'ZE'], {'H': 'PQR', 'E': 'XYZ'})
+        self.requests['H'].delete()
+        self.assertEqual(self.tables(), {'D': {'P', 'Q', 'R'}, 'E': {'X', 'Y', 'Z'}})
+
+    @override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+    def test_deleting_a_host_frees_players_it_cannot_reseat(self):
+        # D only reaches two of H's players, not enough for a table.
+        self.build('HD', ['PH', 'QH', 'RH', 'PD', 'QD'], {'H': 'PQR'})
+        self.requests['H'].delete()
+        self.assertEqual(self.tables(), {})
+        self.assertFalse(GameGroup.objects.exists())
+
+
+class SyntheticPopulationTests(TestCase):
+    """
+    core.synthetic.create_population.
+    """
+    def test_create_population(self):
+        requests = create_population(50, dm_ratio=0.5, systems=['5e', '4e'], travel_ranges=(5, 10), cities=2,
+                                     spread=5.0, seed=1, prefix='synth')
+        self.assertEqual(len(requests), 50)
+        self.assertEqual(GameRequest.objects.filter(user__username__startswith='synth_').count(), 50)
+        self.assertLessEqual({request.system for request in requests}, {'5e', '4e'})
+        self.assertTrue(all(5 <= request.travel_range <= 10 for request in requests))
+        self.assertLessEqual(len({request.zip for request in requests}), 2)
+        self.assertFalse(User.objects.get(username='synth_0').has_usable_password())
+        # Links are left to a rematch.
+        self.assertFalse(GameRequest.available_dms.through.objects.exists())
+
+    def test_same_seed_same_population(self):
+        def population(prefix):
+            return sorted(
+                (int(request.user.username.split('_')[-1]), request.system, request.can_dm, request.travel_range,
+                 request.zip, request.gis_point.coords)
+                for request in create_population(20, seed=3, prefix=prefix)
+            )
+        self.assertEqual(population('a'), population('b'))
+
+
+@skipUnless(numpy is not None, 'The rematch command needs NumPy.')
+@override_settings(MATCHING_ENGINE='core.matching.InMemoryMatchingEngine')
+class RematchTests(TestCase):
+    """
+    The partitioned link rebuild (core.rematch) against the matching engine.
+    """
+    def setUp(self):
+        get_matching_engine.cache_clear()
+        self.addCleanup(get_matching_engine.cache_clear)
+        self.population = create_population(80, dm_ratio=0.3, systems=['5e'], travel_ranges=(5, 30),
+                                            cities=1, spread=10.0, seed=8, prefix='rematch')
+
+    def rebuild(self):
+        changed = set()
+        for system, tile_x, tile_y, halo in find_partitions(5.0):
+            changed.update(rematch_partition(system, tile_x, tile_y, 5.0, halo, False)['changed'])
+        return changed
+
+    def links(self):
+        through = GameRequest.available_dms.through
+        return set(through.objects.values_list('from_gamerequest_id', 'to_gamerequest_id'))
+
+    def test_rebuild_matches_engine(self):
+        engine = get_matching_engine()
+        engine.reset()
+        expected = engine.match_pairs(self.population)
+        changed = self.rebuild()
+        self.assertEqual(self.links(), expected)
+        self.assertEqual(changed, {request for pair in expected for request in pair})
+        self.assertEqual(self.rebuild(), set())
+
+    def test_rebuild_removes_stale_links(self):
+        self.rebuild()
+        links = self.links()
+        dm = next(r for r in self.population if r.can_dm)
+        stranger = next(r for r in self.population if (r.pk, dm.pk) not in links)
+        through = GameRequest.available_dms.through
+        through.objects.create(from_gamerequest=stranger, to_gamerequest=dm)
+        self.rebuild()
+        self.assertEqual(self.links(), links)
+
+    def test_regroup_drops_players_without_links(self):
+        self.rebuild()
+        links = self.links()
+        dm = next(r for r in self.population if r.can_dm)
+        strangers = [r.pk for r in self.population if r.pk != dm.pk and (r.pk, dm.pk) not in links][:GROUP_SIZE - 1]
+        group = GameGroup.objects.create(host=dm)
+        GameRequest.objects.filter(pk__in=strangers).update(group=group)
+
+        regroup([r.pk for r in self.population], notify=False)
+        for player, host in GameRequest.objects.filter(group__isnull=False).values_list('pk', 'group__host_id'):
+            self.assertIn((player, host), links)
+
+
+@skipUnless(numpy is not None, 'The in-memory matching engine needs NumPy.')
+@override_settings(USE_GEOPY_API=False, USE_FAKE_COORDINATES=False, USE_ZIP_CENTROIDS=False,
+                   MATCHING_ENGINE='core.matching.InMemoryMatchingEngine')
+class ImportRequestsTests(TestCase):
+    """
+    The import_requests command on a small JSONL file.
+    """
+    def setUp(self):
+        get_matching_engine.cache_clear()
+        self.addCleanup(get_matching_engine.cache_clear)
+
+    def run_import(self, rows):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'requests.jsonl')
+        with open(path, 'w') as f:
+            f.writelines(json.dumps(row) + '\n' for row in rows)
+        out = io.StringIO()
+        call_command('import_requests', path, stdout=out)
+        return out.getvalue()
+
+    def row(self, username, **fields):
+        row = {'username': username, 'email': f"{username}@example.com", 'request_name': username,
+               'system': '5e', 'can_dm': False, 'travel_range': 10, 'address': '1 Main St',
+               'city': 'Seattle', 'state': 'WA', 'zip': 98101, 'latitude': 47.61, 'longitude': -122.33}
+        row.update(fields)
+        return row
+
+    def test_requests_are_imported_and_linked(self):
+        self.run_import([self.row('dm', can_dm=True), self.row('player'),
+                         self.row('far', latitude=40.73, longitude=-73.99)])
+        dm = GameRequest.objects.get(request_name='dm')
+        self.assertEqual(list(GameRequest.objects.get(request_name='player').available_dms.all()), [dm])
+        self.assertEqual(list(GameRequest.objects.get(request_name='far').available_dms.all()), [])
+        self.assertFalse(User.objects.get(username='player').has_usable_password())
+
+    def test_existing_requests_are_skipped(self):
+        self.run_import([self.row('dm', can_dm=True)])
+        self.run_import([self.row('dm', can_dm=True, request_name='again'), self.row('player')])
+        self.assertEqual(sorted(GameRequest.objects.values_list('request_name', flat=True)), ['dm', 'player'])
+
+    def test_bad_rows_are_skipped(self):
+        self.run_import([
+            self.row('good'),
+            self.row('blank', latitude=''),
+            self.row('garbage', latitude='north', longitude='west'),
+            self.row('outside', latitude=123.0),
+        ])
+        self.assertEqual(list(GameRequest.objects.values_list('request_name', 'zip')), [('good', '98101')])
+
+    def test_imported_requests_form_groups(self):
+        self.run_import([self.row('dm', can_dm=True)] + [self.row(f"player{i}") for i in range(GROUP_SIZE - 1)])
+        group = GameGroup.objects.get()
+        self.assertEqual(group.host.request_name, 'dm')
+        self.assertEqual(group.players.count(), GROUP_SIZE - 1)
+
+    def test_rows_another_writer_inserted_first_are_not_counted(self):
+        raced = User.objects.create(username='raced')
+        bulk_create = GameRequest.objects.bulk_create
+
+        def racing_bulk_create(requests, **kwargs):
+            # Another writer inserts raced's request between the existing check and the insert.
+            bulk_create([GameRequest(user=raced, request_name='theirs', system='5e', travel_range=10,
+                                     gis_point=Point(-122.33, 47.61))])
+            return bulk_create(requests, **kwargs)
+
+        with mock.patch.object(GameRequest.objects, 'bulk_create', side_effect=racing_bulk_create):
+            output = self.run_import([self.row('dm', can_dm=True), self.row('raced')])
+        self.assertIn('1 imported, 1 already present', output)
+        self.assertEqual(GameRequest.objects.get(user=raced).request_name, 'theirs')
+        tiles = DemandTile.objects.filter(zoom=settings.DEMAND_TILE_ZOOMS[0])
+        self.assertEqual(sum(tiles.values_list('dms', flat=True)), 1)
+        self.assertEqual(sum(tiles.values_list('players', flat=True)), 0)
+
+
+class GeocodingTests(SimpleTestCase):
+    """
+    Rate limiter, ZIP centroid table and batch lookups of core.geocoding, without the network.
+    """
+    def test_token_bucket_allows_burst_then_waits(self):
+        bucket = TokenBucket(rate=20, capacity=3)
+        start = time.monotonic()
+        for _ in range(3):
+            self.assertTrue(bucket.acquire())
+        self.assertLess(time.monotonic() - start, 0.04)
+        self.assertFalse(bucket.acquire(timeout=0.01))
+        self.assertTrue(bucket.acquire(timeout=1))
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+
+    def test_zip_centroids(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write('zip,city,state,latitude,longitude\n98101,Seattle,WA,47.0,-122.0\n98109,Seattle,WA,48.0,-123.0\n')
+        self.addCleanup(os.unlink, f.name)
+        centroids = ZipCentroids(f.name)
+        self.assertEqual(centroids.lookup('98101-1234').coords, (-122.0, 47.0))
+        # Unknown ZIP in a known 3 digit area: the area's average.
+        self.assertEqual(centroids.lookup('98199').coords, (-122.5, 47.5))
+        self.assertIsNone(centroids.lookup('10001'))
+        self.assertIsNone(centroids.lookup(''))
+
+    def test_batch_looks_up_each_address_once(self):
+        lookups = []
+
+        class Location:
+            longitude, latitude = -122.33, 47.61
+
+        class Client:
+            def geocode(self, address):
+                lookups.append(address)
+                return None if address == 'nowhere' else Location()
+
+        geocoder = NominatimGeocoder(rate=1000, burst=10, pool_size=1, timeout=1)
+        geocoder.pool = ClientPool(Client, 1)
+        results = geocoder.geocode_batch(['1 Main St', 'nowhere', '1 Main St'])
+        self.assertEqual(lookups, ['1 Main St', 'nowhere'])
+        self.assertEqual(results['1 Main St'].coords, (-122.33, 47.61))
+        self.assertIsNone(results['nowhere'])
+
+
+@override_settings(USE_GEOPY_API=False, USE_FAKE_COORDINATES=True, USE_ZIP_CENTROIDS=True, USE_JOB_QUEUE=False,
+                   EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class GameRequestSaveTests(TestCase):
+    """
+    Coordinates set by the caller survive a save.
+    """
+    def test_given_point_is_kept(self):
+        user = User.objects.create(username='pointed')
+        game_request = GameRequest(user=user, request_name='here', system='5e', travel_range=10,
+                                   address='1 Main St', city='Seattle', state='WA', zip='98101',
+                                   gis_point=Point(-100.0, 40.0))
+        game_request.save()
+        game_request.refresh_from_db()
+        self.assertEqual(game_request.gis_point.coords, (-100.0, 40.0))
+
+    def test_blank_point_gets_coordinates(self):
+        user = User.objects.create(username='unpointed')
+        game_request = GameRequest(user=user, request_name='there', system='5e', travel_range=10,
+                                   address='1 Main St', city='Seattle', state='WA', zip='98101')
+        game_request.save()
+        game_request.refresh_from_db()
+        self.assertNotEqual(game_request.gis_point.coords, ())
+
+
+class InstrumentationTests(TestCase):
+    """
+    InstrumentationMiddleware, timing spans and the Prometheus text rendering.
+    """
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def test_middleware_records_latency_queries_and_spans(self):
+        def view(request):
+            with span('lookup'), connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            return HttpResponse()
+        InstrumentationMiddleware(view)(RequestFactory().get('/'))
+        self.assertEqual(metrics.histograms[('gamefinder_request_duration_seconds', 'unresolved')].count, 1)
+        self.assertEqual(metrics.totals[('gamefinder_request_queries_total', 'unresolved')], 1)
+        self.assertEqual(metrics.histograms[('gamefinder_span_duration_seconds', 'lookup')].count, 1)
+
+    def test_prometheus_buckets_are_cumulative(self):
+        metrics.observe('gamefinder_span_duration_seconds', 'lookup', 0.02)
+        metrics.observe('gamefinder_span_duration_seconds', 'lookup', 3.0)
+        text = render_prometheus()
+        self.assertIn('gamefinder_span_duration_seconds_bucket{span="lookup",le="0.025"} 1\n', text)
+        self.assertIn('gamefinder_span_duration_seconds_bucket{span="lookup",le="5.0"} 2\n', text)
+        self.assertIn('gamefinder_span_duration_seconds_bucket{span="lookup",le="+Inf"} 2\n', text)
+        self.assertIn('gamefinder_span_duration_seconds_count{span="lookup"} 2\n', text)
+
+
+class QueryCounterTests(TestCase):
+    """
+    InstrumentationMiddleware counts the queries of every configured database.
+    """
+    databases = set(settings.DATABASES)
+
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def test_queries_on_every_alias_are_counted(self):
+        def view(request):
+            for alias in settings.DATABASES:
+                User.objects.using(alias).count()
+            return HttpResponse()
+        InstrumentationMiddleware(view)(RequestFactory().get('/'))
+        self.assertEqual(metrics.totals[('gamefinder_request_queries_total', 'unresolved')], len(settings.DATABASES))
+        self.assertGreater(metrics.totals[('gamefinder_request_db_seconds_total', 'unresolved')], 0)
+
+
+class MetricsAccessTests(TestCase):
+    """
+    Who can read /metrics.
+    """
+    def setUp(self):
+        self.url = reverse('core:metrics')
+
+    def test_anonymous_clients_are_refused(self):
+        # Behind a reverse proxy every client comes from 127.0.0.1.
+        self.assertEqual(self.client.get(self.url, REMOTE_ADDR='127.0.0.1').status_code, 403)
+        self.client.force_login(User.objects.create(username='not_staff'))
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    def test_staff(self):
+        self.client.force_login(User.objects.create(username='metrics_staff', is_staff=True))
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE gamefinder_request_duration_seconds histogram', response.content)
+
+    @override_settings(METRICS_TOKEN='scrape-secret')
+    def test_bearer_token(self):
+        self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION='Bearer scrape-secret').status_code, 200)
+        self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION='Basic scrape-secret').status_code, 403)
+
+    @override_settings(METRICS_ALLOWED_IPS=['10.0.0.5'])
+    def test_allowed_address(self):
+        self.assertEqual(self.client.get(self.url, REMOTE_ADDR='10.0.0.5').status_code, 200)
+
+
+class AsyncMiddlewareTests(TestCase):
+    """
+    InstrumentationMiddleware and ReplicaPinMiddleware in an async (ASGI) middleware chain.
+    """
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    async def test_instrumentation_counts_queries_of_async_views(self):
+        async def view(request):
+            await sync_to_async(User.objects.count)()
+            await sync_to_async(User.objects.count, thread_sensitive=False)()
+            return HttpResponse()
+        middleware = InstrumentationMiddleware(view)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        response = await middleware(self.factory.get('/'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(metrics.histograms[('gamefinder_request_duration_seconds', 'unresolved')].count, 1)
+        self.assertEqual(metrics.totals[('gamefinder_request_queries_total', 'unresolved')], 2)
+
+    @skipUnless(REPLICA in settings.DATABASES, 'No replica database configured.')
+    async def test_pin_after_a_write_in_a_thread(self):
+        async def view(request):
+            await sync_to_async(ReplicaRouter().db_for_write, thread_sensitive=False)(GameRequest)
+            return HttpResponse()
+        middleware = ReplicaPinMiddleware(view)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        response = await middleware(self.factory.get('/'))
+        self.assertIn(PIN_COOKIE, response.cookies)
+
+    async def test_no_pin_without_writes(self):
+        async def view(request):
+            return HttpResponse()
+        response = await ReplicaPinMiddleware(view)(self.factory.get('/'))
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+
+@override_settings(USE_GEOPY_API=False, USE_FAKE_COORDINATES=True, USE_ZIP_CENTROIDS=True, USE_JOB_QUEUE=False,
+                   EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class AsyncViewTests(TransactionTestCase):
+    """
+    The ASGI views. The background job runs on a thread of its own with its own connection,
+    so these commit for real.
+    """
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+        self.user = User.objects.create(username='async', email='async@example.com')
+
+    def request(self, method, path, data=None):
+        request = getattr(self.factory, method)(path, data or {})
+        request.user = self.user
+        return request
+
+    async def test_submit_returns_before_matching(self):
+        data = {'request_name': 'async', 'system': '5e', 'travel_range': 10, 'address': '1 Main St',
+                'city': 'Seattle', 'state': 'WA', 'zip': '98101'}
+        response = await views.submit_async(self.request('post', '/submit/0', data))
+        self.assertEqual(response.status_code, 302)
+        game_request = await sync_to_async(GameRequest.objects.get)(user=self.user)
+        # The job is left for the background task.
+        await asyncio.gather(*views.background_tasks)
+        self.assertFalse(await sync_to_async(MatchJob.objects.filter(game_request=game_request).exists)())
+        await sync_to_async(game_request.refresh_from_db)()
+        self.assertNotEqual(game_request.gis_point.coords, ())
+
+    async def test_submit_needs_post(self):
+        response = await views.submit_async(self.request('get', '/submit/0'))
+        self.assertEqual(response.status_code, 405)
+
+    async def test_details_and_delete(self):
+        game_request = await sync_to_async(GameRequest.objects.create)(
+            user=self.user, request_name='mine', system='5e', travel_range=10, address='1 Main St',
+            city='Seattle', state='WA', zip='98101')
+        response = await views.details_async(self.request('get', '/details/'), game_request.pk)
+        self.assertContains(response, 'mine')
+        response = await views.delete_async(self.request('get', '/delete/'), game_request.pk)
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(await sync_to_async(GameRequest.objects.filter(pk=game_request.pk).exists)())
+
+
+class AdminTests(TestCase):
+    """
+    The GameRequest admin: estimated changelist counts and the change form.
+    """
+    def setUp(self):
+        self.user = User.objects.create(username='admin_owner')
+        GameRequest.objects.bulk_create([
+            GameRequest(user=self.user, request_name=f"admin{i}", system='5e', can_dm=i == 0, travel_range=10,
+                        address='1 Main St', city='Seattle', state='WA', zip='98101',
+                        gis_point=Point(-122.33, 47.61)) for i in range(3)
+        ])
+
+    def test_filtered_and_small_lists_are_counted_exactly(self):
+        self.assertEqual(EstimatedCountPaginator(GameRequest.objects.filter(can_dm=True), 10).count, 1)
+        self.assertEqual(EstimatedCountPaginator(GameRequest.objects.all(), 10).count, 3)
+        self.assertEqual(EstimatedCountPaginator(list(range(5)), 10).count, 5)
+
+    @skipUnless(connection.vendor == 'postgresql', 'The row estimate is only read on PostgreSQL.')
+    @override_settings(ADMIN_COUNT_ESTIMATE_THRESHOLD=-2)
+    def test_unfiltered_list_uses_estimate(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {GameRequest._meta.db_table}")
+        with CaptureQueriesContext(connection) as context:
+            count = EstimatedCountPaginator(GameRequest.objects.all(), 10).count
+        self.assertEqual(count, 3)
+        self.assertNotIn('COUNT(', context.captured_queries[-1]['sql'].upper())
+        # A filter needs the exact count.
+        self.assertEqual(EstimatedCountPaginator(GameRequest.objects.filter(can_dm=True), 10).count, 1)
+
+    def test_change_form_saves_edits(self):
+        staff = User.objects.create(username='admin_staff', is_staff=True, is_superuser=True)
+        model_admin = GameRequestAdmin(GameRequest, AdminSite())
+        request = RequestFactory().get('/')
+        request.user = staff
+        form = model_admin.get_form(request, GameRequest.objects.first())
+        # Fields save() wouldn't write aren't editable.
+        self.assertNotIn('user', form.base_fields)
+        self.assertNotIn('group', form.base_fields)
+
+        game_request = GameRequest.objects.get(request_name='admin1')
+        self.client.force_login(staff)
+        data = {'request_name': 'renamed', 'system': '5e', 'travel_range': 20, 'address': '1 Main St',
+                'city': 'Seattle', 'state': 'WA', 'zip': '98101', 'gis_point': game_request.gis_point.wkt}
+        url = reverse('admin:core_gamerequest_change', args=[game_request.pk])
+        with override_settings(USE_GEOPY_API=False, USE_FAKE_COORDINATES=False, USE_JOB_QUEUE=False):
+            response = self.client.post(url, data)
+        self.assertEqual(response.status_code, 302)
+        game_request.refresh_from_db()
+        self.assertEqual((game_request.request_name, game_request.travel_range), ('renamed', 20))
+
+
+@skipUnless(numpy is not None, 'The match snapshot needs NumPy.')
+class MatchSnapshotTests(TestCase):
+    """
+    Generations, the change log and rebuilds of core.snapshot.MatchSnapshot.
+    """
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = directory.name
+        user = User.objects.create(username='snapshot')
+        GameRequest.objects.bulk_create([
+            GameRequest(user=user, request_name='near', system='5e', can_dm=True, travel_range=10,
+                        gis_point=Point(-122.33, 47.61)),
+            GameRequest(user=user, request_name='far', system='5e', travel_range=10, gis_point=Point(-73.99, 40.73)),
+        ])
+        self.near, self.far = (GameRequest.objects.get(request_name=name).pk for name in ('near', 'far'))
+
+    def ids(self, snapshot, lon=-122.33, lat=47.61):
+        return set(snapshot.nearby('5e', lon, lat, 20)['id'].tolist())
+
+    def generations(self):
+        return sorted(name for name in os.listdir(self.path) if name not in ('CURRENT', 'rebuild.lock'))
+
+    def test_lookup_without_a_generation_raises(self):
+        snapshot = MatchSnapshot(self.path)
+        with self.assertRaises(SnapshotMissing):
+            self.ids(snapshot)
+        self.assertEqual(self.generations(), [])
+        snapshot.rebuild()
+        self.assertEqual(self.ids(snapshot), {self.near})
+        self.assertEqual(len(self.generations()), 1)
+        self.assertEqual(snapshot.nearby('4e', -122.33, 47.61, 20)['id'].tolist(), [])
+
+    def test_engine_falls_back_to_postgis_without_a_generation(self):
+        with override_settings(MATCH_SNAPSHOT_DIR=self.path):
+            engine = SnapshotMatchingEngine()
+        request = GameRequest(system='5e', travel_range=10, gis_point=Point(-122.3, 47.6))
+        with mock.patch.object(engine.fallback, 'candidate_dms', return_value=[self.near]) as fallback:
+            self.assertEqual(engine.candidate_dms(request), [self.near])
+        fallback.assert_called_once_with(request)
+        self.assertEqual(self.generations(), [])
+
+    def test_log_changes_reach_every_process(self):
+        writer, reader = MatchSnapshot(self.path), MatchSnapshot(self.path)
+        writer.rebuild()
+        self.assertEqual(self.ids(reader), {self.near})
+        writer.upsert(self.far, '5e', -122.3, 47.6, False, 10)
+        writer.delete(self.near)
+        self.assertEqual(self.ids(reader), {self.far})
+        self.assertEqual(self.ids(reader, -73.99, 40.73), set())
+        flags = reader.nearby('5e', -122.33, 47.61, 20)['can_dm'].tolist()
+        self.assertEqual(flags, [False])
+
+    def test_rebuild_replaces_generation_and_keeps_recent_changes(self):
+        snapshot, reader = MatchSnapshot(self.path), MatchSnapshot(self.path)
+        snapshot.rebuild()
+        self.assertEqual(self.ids(reader), {self.near})
+        old = self.generations()
+        # Logged but not in the database yet, like a save whose transaction is still open.
+        snapshot.upsert(10 ** 9, '5e', -122.34, 47.62, True, 10)
+        self.assertEqual(snapshot.rebuild(), 2)
+        self.assertNotEqual(self.generations(), old)
+        self.assertEqual(len(self.generations()), 1)
+        self.assertEqual(self.ids(reader), {self.near, 10 ** 9})
+
+    @override_settings(MATCH_SNAPSHOT_LOG_OVERLAP=-60)
+    def test_rebuild_drops_old_log_records(self):
+        snapshot = MatchSnapshot(self.path)
+        snapshot.rebuild()
+        self.assertEqual(self.ids(snapshot), {self.near})
+        snapshot.upsert(10 ** 9, '5e', -122.34, 47.62, True, 10)
+        snapshot.rebuild()
+        self.assertEqual(os.path.getsize(os.path.join(self.path, self.generations()[0], 'log')), 0)
+        self.assertEqual(self.ids(snapshot), {self.near})
+
+
+class MatchJobTests(TestCase):
+    """
+    The job queue: claiming and leasing, retries, and saves made while a job runs.
+    """
+    def setUp(self):
+        user = User.objects.create(username='jobs')
+        GameRequest.objects.bulk_create([
+            GameRequest(user=user, request_name=name, system='5e', travel_range=10, gis_point=Point(-122.33, 47.61))
+            for name in ('first', 'second')
+        ])
+        self.first, self.second = (GameRequest.objects.get(request_name=name) for name in ('first', 'second'))
+
+    def job(self, request):
+        return MatchJob.objects.get(game_request=request)
+
+    def test_claim_leases_due_jobs_only(self):
+        MatchJob.enqueue(self.first)
+        MatchJob.enqueue(self.second)
+        MatchJob.objects.filter(game_request=self.second).update(run_after=timezone.now() + timedelta(minutes=1))
+        before = timezone.now()
+        jobs = claim_jobs(10)
+        self.assertEqual([job.game_request_id for job in jobs], [self.first.pk])
+        self.assertEqual(jobs[0].attempts, 1)
+        self.assertGreaterEqual(self.job(self.first).run_after, before + settings.JOB_LEASE)
+        # Leased jobs aren't handed out again.
+        self.assertEqual(claim_jobs(10), [])
+
+    def test_finished_job_is_deleted(self):
+        MatchJob.enqueue(self.first)
+        job, = claim_jobs(10)
+        with mock.patch('core.jobs.run_job') as run_job:
+            self.assertTrue(process_job(job))
+        run_job.assert_called_once_with(job)
+        self.assertFalse(MatchJob.objects.exists())
+
+    def test_save_while_running_keeps_lease_and_reruns(self):
+        MatchJob.enqueue(self.first)
+        job, = claim_jobs(10)
+        leased = self.job(self.first).run_after
+
+        def save_meanwhile(job):
+            MatchJob.enqueue(self.first, geocode=True)
+            queued = self.job(self.first)
+            self.assertEqual((queued.version, queued.run_after, queued.geocode), (job.version + 1, leased, True))
+            self.assertEqual(claim_jobs(10), [])
+
+        with mock.patch('core.jobs.run_job', side_effect=save_meanwhile):
+            self.assertTrue(process_job(job))
+        # Still queued, and due again now that the lease is over.
+        rerun, = claim_jobs(10)
+        self.assertEqual((rerun.version, rerun.geocode, rerun.attempts), (job.version + 1, True, 1))
+
+    def test_failed_job_is_retried_then_dropped(self):
+        MatchJob.enqueue(self.first)
+        job, = claim_jobs(10)
+        before = timezone.now()
+        with mock.patch('core.jobs.run_job', side_effect=RuntimeError('lookup failed')), \
+                self.assertLogs('core.jobs', 'WARNING'):
+            self.assertFalse(process_job(job))
+        failed = self.job(self.first)
+        self.assertGreaterEqual(failed.run_after, before + settings.JOB_RETRY_DELAY)
+        self.assertIn('lookup failed', failed.last_error)
+
+        MatchJob.objects.update(run_after=timezone.now())
+        job, = claim_jobs(10)
+        self.assertEqual(job.attempts, 2)
+        with override_settings(JOB_MAX_ATTEMPTS=2), \
+                mock.patch('core.jobs.run_job', side_effect=RuntimeError('lookup failed')), \
+                self.assertLogs('core.jobs', 'ERROR'):
+            self.assertFalse(process_job(job))
+        self.assertFalse(MatchJob.objects.exists())
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+                   NOTIFICATION_DIGEST_DELAY=timedelta(0))
+class NotificationOutboxTests(TestCase):
+    """
+    The group email outbox (core.notifications) on the locmem mail backend.
+    """
+    def setUp(self):
+        users = {name: User.objects.create(username=name, email=f"{name}@example.com")
+                 for name in ('host', 'a', 'b', 'c', 'd')}
+        # Both tables belong to the same DM.
+        owners = {'host': 'host', 'other_table': 'host', 'a': 'a', 'b': 'b', 'c': 'c', 'd': 'd'}
+        GameRequest.objects.bulk_create([
+            GameRequest(user=users[owner], request_name=name, system='5e', travel_range=10,
+                        gis_point=Point(-122.33, 47.61)) for name, owner in owners.items()
+        ])
+        self.ids = dict(GameRequest.objects.values_list('request_name', 'pk'))
+
+    def table(self, host, players):
+        return {self.ids[host]: [self.ids[player] for player in players]}
+
+    def test_changes_before_sending_make_one_digest(self):
+        queue_notifications(self.table('host', 'abc'))
+        queue_notifications(self.table('host', 'abd'))
+        queue_notifications(self.table('other_table', 'bcd'))
+        self.assertEqual(send_due_notifications(), 2)
+        self.assertEqual(len(mail.outbox), 1)
+        message = mail.outbox[0]
+        self.assertEqual(message.to, ['host@example.com'])
+        self.assertEqual(message.subject, 'Players found for 2 of your games!')
+        self.assertIn('d@example.com', message.body)
+        self.assertEqual(message.body.count('c@example.com'), 1)
+
+        # Nothing new to announce.
+        self.assertEqual(queue_notifications(self.table('host', 'abd')), 0)
+        self.assertEqual(send_due_notifications(), 0)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_dissolved_group_is_not_sent(self):
+        queue_notifications(self.table('host', 'abc'))
+        queue_notifications({self.ids['host']: []})
+        self.assertEqual(send_due_notifications(), 0)
+        self.assertEqual(mail.outbox, [])
+
+    def test_failed_send_is_retried(self):
+        queue_notifications(self.table('host', 'abc'))
+        send = 'django.core.mail.backends.locmem.EmailBackend.send_messages'
+        with mock.patch(send, side_effect=ConnectionError('refused')), self.assertLogs('core.notifications', 'WARNING'):
+            self.assertEqual(send_due_notifications(), 1)
+        row = GroupNotification.objects.get()
+        self.assertTrue(row.pending)
+        self.assertIn('refused', row.last_error)
+        self.assertGreater(row.run_after, timezone.now())
+        self.assertEqual(send_due_notifications(), 0)
+
+        GroupNotification.objects.update(run_after=timezone.now())
+        self.assertEqual(send_due_notifications(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, 'Players found for host!')
+        self.assertFalse(GroupNotification.objects.get().pending)
+
+
+@override_settings(USE_GEOPY_API=False, USE_FAKE_COORDINATES=False, USE_ZIP_CENTROIDS=False, USE_JOB_QUEUE=False,
+                   EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class DirtyFieldsTests(TestCase):
+    """
+    The field snapshot of core.tracking.DirtyFieldsMixin and the update_fields GameRequest.save()
+    builds from it.
+    """
+    def setUp(self):
+        self.user = User.objects.create(username='dirty')
+        self.request = GameRequest(user=self.user, request_name='tracked', system='5e', travel_range=10,
+                                   address='1 Main St', city='Seattle', state='WA', zip='98101',
+                                   gis_point=Point(-122.33, 47.61))
+        self.request.save()
+        self.saves = []
+        post_save.connect(self.record_save, sender=GameRequest, dispatch_uid='dirty_fields_tests')
+        self.addCleanup(post_save.disconnect, sender=GameRequest, dispatch_uid='dirty_fields_tests')
+
+    def record_save(self, sender, instance, update_fields, **kwargs):
+        self.saves.append(sorted(update_fields) if update_fields is not None else None)
+
+    def test_snapshot_after_save(self):
+        self.assertEqual(self.request.get_dirty_fields(), [])
+        self.request.request_name = 'renamed'
+        self.request.travel_range = 20
+        self.assertEqual(self.request.get_dirty_fields(), ['request_name', 'travel_range'])
+        self.request.save()
+        self.assertEqual(self.saves, [['request_name', 'travel_range']])
+        self.assertEqual(self.request.get_dirty_fields(), [])
+
+    def test_save_without_changes_writes_nothing(self):
+        request = GameRequest.objects.get(pk=self.request.pk)
+        with CaptureQueriesContext(connection) as context:
+            request.save()
+        self.assertEqual(context.captured_queries, [])
+        self.assertEqual(self.saves, [])
+
+    def test_points_changed_in_place_are_dirty(self):
+        request = GameRequest.objects.get(pk=self.request.pk)
+        request.gis_point.x = -122.0
+        self.assertEqual(request.get_dirty_fields(), ['gis_point'])
+
+    def test_snapshot_after_refresh(self):
+        request = GameRequest.objects.get(pk=self.request.pk)
+        request.request_name = 'unsaved'
+        request.city = 'Tacoma'
+        request.refresh_from_db(fields=['request_name'])
+        # Only the reloaded field is clean again.
+        self.assertEqual(request.get_dirty_fields(), ['city'])
+        request.city = 'Tacoma'
+        request.refresh_from_db()
+        self.assertEqual((request.city, request.get_dirty_fields()), ('Seattle', []))
+
+    def test_deferred_fields_are_dirty_once_assigned(self):
+        request = GameRequest.objects.only('pk', 'request_name').get(pk=self.request.pk)
+        self.assertEqual(request.get_dirty_fields(), [])
+        request.travel_range = 15
+        self.assertEqual(request.get_dirty_fields(), ['travel_range'])
+        request.save()
+        self.assertEqual(self.saves, [['travel_range']])
+
+    def test_instance_without_snapshot_is_compared_with_the_row(self):
+        request = GameRequest(pk=self.request.pk, user=self.user, request_name='by hand', system='5e',
+                              travel_range=10, address='1 Main St', city='Seattle', state='WA', zip='98101',
+                              gis_point=Point(-122.33, 47.61))
+        self.assertIsNone(request.get_dirty_fields())
+        request.save()
+        self.assertEqual(self.saves, [['request_name']])
+        self.assertEqual(GameRequest.objects.get(pk=self.request.pk).request_name, 'by hand')
+
+
+class GeocodeCacheTests(TestCase):
+    """
+    Address normalization and the shared geocode cache in front of the map API.
+    """
+    def test_normalize_address(self):
+        key = normalize_address('123 Main Street', 'Seattle', 'Washington', '98101-1234')
+        self.assertEqual(key, '123 main st|seattle|wa|98101')
+        self.assertEqual(normalize_address('123  main st.', 'SEATTLE', 'wa', '98101'), key)
+        self.assertEqual(normalize_address('1 Oak Ave Suite 5', 'Seattle', 'WA', '98101'),
+                         normalize_address('1 Oak Avenue Ste 5', 'Seattle', 'WA', '98101'))
+        self.assertEqual(normalize_address('1 Oak Ave Apartment 5', 'Seattle', 'WA', '98101'),
+                         normalize_address('1 Oak Ave Apt 5', 'Seattle', 'WA', '98101'))
+        self.assertNotEqual(normalize_address('1 Oak Ave Unit 5', 'Seattle', 'WA', '98101'),
+                            normalize_address('1 Oak Ave Suite 5', 'Seattle', 'WA', '98101'))
+
+    def test_lookups_are_cached(self):
+        found = ('123 Main Street', 'Seattle', 'WA', '98101')
+        same = ('123 main st.', 'seattle', 'Washington', '98101')
+        unknown = ('1 Nowhere Rd', 'Seattle', 'WA', '98101')
+        geocoder = mock.Mock()
+        geocoder.geocode_batch.side_effect = lambda strings: {
+            string: Point(-122.33, 47.61) if 'Main' in string else None for string in strings}
+        with mock.patch('core.functions.get_geocoder', return_value=geocoder):
+            results = coordinates_for_addresses([found, same, unknown])
+            # Both spellings share one lookup.
+            self.assertEqual(len(geocoder.geocode_batch.call_args[0][0]), 2)
+            self.assertEqual(results[found].coords, (-122.33, 47.61))
+            self.assertEqual(results[same].coords, (-122.33, 47.61))
+            self.assertIsNone(results[unknown])
+            self.assertEqual(GeocodeCache.objects.count(), 2)
+            self.assertIsNone(GeocodeCache.objects.get(address_key=normalize_address(*unknown)).gis_point)
+
+            geocoder.reset_mock()
+            results = coordinates_for_addresses([same, unknown])
+            geocoder.geocode_batch.assert_not_called()
+            self.assertEqual(results[same].coords, (-122.33, 47.61))
+            self.assertIsNone(results[unknown])
+            with self.assertNumQueries(1):
+                coordinates_for_addresses([found])
+
+            # Expired entries are looked up again.
+            GeocodeCache.objects.update(expires=timezone.now())
+            coordinates_for_addresses([found])
+            self.assertEqual(geocoder.geocode_batch.call_count, 1)
+            self.assertEqual(GeocodeCache.objects.count(), 2)
+
+
+class ExportTests(TestCase):
+    """
+    CSV and JSONL exports of a small population, through export_chunks and the staff view.
+    """
+    def setUp(self):
+        user = User.objects.create(username='exporter')
+        GameRequest.objects.bulk_create([
+            GameRequest(user=user, request_name='dm, "quoted"', system='5e', can_dm=True, travel_range=10,
+                        city='Seattle', state='WA', zip='98101', gis_point=Point(-122.33, 47.61)),
+            GameRequest(user=user, request_name='player', system='5e', travel_range=10, city='Seattle',
+                        state='WA', zip='98101', gis_point=Point(-122.3, 47.6)),
+            GameRequest(user=user, request_name='unlocated', system='PF', travel_range=5, city='', state='',
+                        zip=''),
+        ])
+        self.dm, self.player, self.unlocated = GameRequest.objects.order_by('pk')
+        GameRequest.available_dms.through.objects.create(from_gamerequest=self.player, to_gamerequest=self.dm)
+        group = GameGroup.objects.create(host=self.dm)
+        GameRequest.objects.filter(pk=self.player.pk).update(group=group)
+        self.group = group
+
+    def read(self, table, file_format, chunk_size=2):
+        data = b''.join(export_chunks(table, file_format, chunk_size)).decode()
+        if file_format == 'csv':
+            return list(csv.reader(io.StringIO(data)))
+        return [json.loads(line) for line in data.splitlines()]
+
+    def test_csv_round_trip(self):
+        header, *rows = self.read('requests', 'csv')
+        self.assertEqual(header, [name for name, kind in TABLES['requests'][0]])
+        self.assertEqual(len(rows), 3)
+        dm = dict(zip(header, rows[0]))
+        self.assertEqual((dm['id'], dm['request_name'], dm['can_dm']), (str(self.dm.pk), 'dm, "quoted"', 'True'))
+        self.assertEqual((float(dm['longitude']), float(dm['latitude'])), (-122.33, 47.61))
+        unlocated = dict(zip(header, rows[2]))
+        self.assertEqual((unlocated['longitude'], unlocated['latitude'], unlocated['group_id']), ('', '', ''))
+        self.assertEqual(self.read('edges', 'csv'), [['player_id', 'dm_id'], [str(self.player.pk), str(self.dm.pk)]])
+
+    def test_jsonl_round_trip(self):
+        rows = self.read('requests', 'jsonl')
+        self.assertEqual([list(row) for row in rows], [[name for name, kind in TABLES['requests'][0]]] * 3)
+        self.assertEqual(rows[1]['group_id'], self.group.pk)
+        self.assertIsNone(rows[2]['longitude'])
+        self.assertEqual(self.read('groups', 'jsonl'),
+                         [{'group_id': self.group.pk, 'host_id': self.dm.pk, 'player_id': self.player.pk}])
+
+    def test_empty_table_has_header_only(self):
+        GameRequest.available_dms.through.objects.all().delete()
+        self.assertEqual(self.read('edges', 'csv'), [['player_id', 'dm_id']])
+        self.assertEqual(self.read('edges', 'jsonl'), [])
+
+    def test_view_is_staff_only(self):
+        url = reverse('core:export', args=['requests'])
+        self.client.force_login(User.objects.create(username='not_staff'))
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.force_login(User.objects.create(username='staff', is_staff=True))
+        response = self.client.get(url, {'format': 'jsonl'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertIn('gamefinder-requests.jsonl', response['Content-Disposition'])
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], [self.dm.pk, self.player.pk, self.unlocated.pk])
+        self.assertEqual(self.client.get(reverse('core:export', args=['secrets'])).status_code, 404)
+        self.assertEqual(self.client.get(url, {'format': 'xml'}).status_code, 404)
+
+
+@override_settings(USE_GEOPY_API=False, USE_FAKE_COORDINATES=False, USE_ZIP_CENTROIDS=False, USE_JOB_QUEUE=False,
+                   EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class DemandTests(TestCase):
+    """
+    DemandTile counts kept by the save and delete paths, the rebuild command and the lookup endpoint.
+    """
+    def setUp(self):
+        self.user = User.objects.create(username='demand')
+
+    def create(self, name, lon, lat, can_dm=False, system='5e'):
+        request = GameRequest(user=self.user, request_name=name, system=system, can_dm=can_dm, travel_range=10,
+                              address='1 Main St', city='Seattle', state='WA', zip='98101', gis_point=Point(lon, lat))
+        request.save()
+        return request
+
+    def counts(self):
+        return {
+            (tile.system, tile.zoom, tile.tile_x, tile.tile_y): (tile.players, tile.dms)
+            for tile in DemandTile.objects.all() if (tile.players, tile.dms) != (0, 0)
+        }
+
+    def expected(self):
+        counts = {}
+        for request in GameRequest.objects.all():
+            for zoom in settings.DEMAND_TILE_ZOOMS:
+                key = (request.system, zoom) + map_tile(request.gis_point.x, request.gis_point.y, zoom)
+                players, dms = counts.get(key, (0, 0))
+                counts[key] = (players, dms + 1) if request.can_dm else (players + 1, dms)
+        return counts
+
+    def tile(self, lon, lat, system='5e', zoom=10):
+        return self.counts().get((system, zoom) + map_tile(lon, lat, zoom), (0, 0))
+
+    def test_counts_follow_saves_and_deletes(self):
+        player = self.create('player', -122.33, 47.61)
+        self.create('dm', -122.33, 47.61, can_dm=True)
+        self.assertEqual(self.tile(-122.33, 47.61), (1, 1))
+
+        player.gis_point = Point(-73.99, 40.73)
+        player.save()
+        self.assertEqual(self.tile(-122.33, 47.61), (0, 1))
+        self.assertEqual(self.tile(-73.99, 40.73), (1, 0))
+
+        player.can_dm = True
+        player.save()
+        self.assertEqual(self.tile(-73.99, 40.73), (0, 1))
+        player.system = 'PF'
+        player.save()
+        self.assertEqual(self.tile(-73.99, 40.73), (0, 0))
+        self.assertEqual(self.tile(-73.99, 40.73, system='PF'), (0, 1))
+        self.assertEqual(self.counts(), self.expected())
+
+        player.delete()
+        GameRequest.objects.get(request_name='dm').delete()
+        self.assertEqual(self.counts(), {})
+
+    @skipUnless(connection.vendor == 'postgresql', 'The rebuild locks the table, which needs PostgreSQL.')
+    def test_rebuild_matches_incremental_counts(self):
+        for i in range(12):
+            self.create(f"r{i}", -122.33 + i * 0.5, 47.61 - i * 0.3, can_dm=i % 3 == 0, system=('5e', 'PF')[i % 2])
+        incremental = self.counts()
+        self.assertEqual(incremental, self.expected())
+        DemandTile.objects.all().delete()
+        call_command('rebuild_demand_tiles', stdout=io.StringIO())
+        self.assertEqual(self.counts(), incremental)
+
+    def test_endpoint(self):
+        self.create('player', -122.33, 47.61)
+        self.create('dm', -122.33, 47.61, can_dm=True)
+        url = reverse('core:demand')
+        response = self.client.get(url, {'system': '5e', 'lat': 47.61, 'lon': -122.33, 'zoom': 10})
+        self.assertEqual(response.status_code, 200)
+        x, y = map_tile(-122.33, 47.61, 10)
+        self.assertEqual(response.json(), {'system': '5e', 'zoom': 10, 'tile_x': x, 'tile_y': y,
+                                           'players': 1, 'dms': 1})
+        empty = self.client.get(url, {'system': '5e', 'lat': 0, 'lon': 0}).json()
+        self.assertEqual((empty['zoom'], empty['players'], empty['dms']), (settings.DEMAND_DEFAULT_ZOOM, 0, 0))
+        for params in ({'system': '5e', 'lat': 47.61}, {'system': '5e', 'lat': 'north', 'lon': 0},
+                       {'system': 'chess', 'lat': 0, 'lon': 0}, {'system': '5e', 'lat': 0, 'lon': 0, 'zoom': 3},
+                       {'system': '5e', 'lat': 'nan', 'lon': 0}, {'system': '5e', 'lat': 0, 'lon': 'inf'},
+                       {'system': '5e', 'lat': 0, 'lon': '-Infinity'}):
+            self.assertEqual(self.client.get(url, params).status_code, 400, params)
+
+
+@override_settings(USE_GEOPY_API=False, USE_FAKE_COORDINATES=False, USE_ZIP_CENTROIDS=False, USE_JOB_QUEUE=False,
+                   EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class MatchRequestTests(TestCase):
+    """
+    match_request for a request whose coordinates were lost.
+    """
+    def create(self, name, can_dm=False):
+        request = GameRequest(user=User.objects.create(username=name), request_name=name, system='5e',
+                              can_dm=can_dm, travel_range=10, address='1 Main St', city='Seattle', state='WA',
+                              zip='98101', gis_point=Point(-122.33, 47.61))
+        request.save()
+        return request
+
+    def test_request_without_coordinates_loses_links_and_seat(self):
+        host = self.create('host', can_dm=True)
+        players = [self.create(name) for name in ('p', 'q', 'r')]
+        self.assertEqual(set(GameRequest.objects.filter(group__host=host).values_list('pk', flat=True)),
+                         {player.pk for player in players})
+
+        # An address edit that couldn't be geocoded leaves the point empty.
+        lost = GameRequest.objects.get(pk=players[0].pk)
+        lost.gis_point = Point([])
+        lost.save()
+        lost.refresh_from_db()
+        self.assertEqual(list(lost.available_dms.all()), [])
+        self.assertIsNone(lost.group_id)
+        self.assertFalse(GameGroup.objects.filter(host=host).exists())
+
+
+class ApiRequestsTests(TestCase):
+    """
+    ETags and pages of the JSON match API.
+    """
+    databases = set(settings.DATABASES)
+
+    def setUp(self):
+        self.user = User.objects.create(username='poller')
+        dm_user = User.objects.create(username='api_dm')
+        GameRequest.objects.bulk_create([
+            GameRequest(user=self.user, request_name='mine', system='5e', travel_range=10,
+                        gis_point=Point(-122.33, 47.61)),
+            GameRequest(user=dm_user, request_name='dm', system='5e', can_dm=True, travel_range=10,
+                        gis_point=Point(-122.33, 47.61)),
+        ])
+        self.mine = GameRequest.objects.get(request_name='mine')
+        self.dm = GameRequest.objects.get(request_name='dm')
+        self.url = reverse('core:api requests')
+        self.client.force_login(self.user)
+
+    def etag(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return response['ETag']
+
+    def test_unchanged_page_is_not_modified(self):
+        etag = self.etag()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_etag_changes_with_links_and_groups(self):
+        etag = self.etag()
+        GameRequest.available_dms.through.objects.create(from_gamerequest=self.mine, to_gamerequest=self.dm)
+        linked = self.etag()
+        self.assertNotEqual(linked, etag)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        group = GameGroup.objects.create(host=self.dm)
+        GameRequest.objects.filter(pk=self.mine.pk).update(group=group)
+        self.assertNotIn(self.etag(), (etag, linked))
+        self.assertEqual(self.client.get(self.url).json()['results'][0]['group']['host']['id'], self.dm.pk)
+
+    def test_pages_follow_next(self):
+        GameRequest.objects.bulk_create([
+            GameRequest(user=self.user, request_name=f"more{i}", system='5e', travel_range=10,
+                        gis_point=Point(-122.33, 47.61)) for i in range(2)
+        ])
+        names, url = [], f"{self.url}?limit=2"
+        while url:
+            page = self.client.get(url).json()
+            names += [result['request_name'] for result in page['results']]
+            url = page['next']
+        self.assertEqual(names, ['mine', 'more0', 'more1'])
+
+    @skipUnless(REPLICA in settings.DATABASES, 'No replica database configured.')
+    def test_reads_primary(self):
+        with CaptureQueriesContext(connections[REPLICA]) as replica:
+            self.etag()
+        self.assertEqual(replica.captured_queries, [])
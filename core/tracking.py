@@ -0,0 +1,76 @@
+import copy
+import datetime
+import decimal
+
+# Values of these types can't be changed in place, so the snapshot can share them.
+IMMUTABLE_TYPES = (str, int, float, bool, bytes, decimal.Decimal, datetime.date, datetime.time,
+                   datetime.timedelta, type(None))
+
+
+class DirtyFieldsMixin:
+    """
+    Model mixin that remembers field values as they were loaded from (or last saved to) the
+    database, so changed fields can be found without reading the row again.
+    Use as the first base class: class MyModel(DirtyFieldsMixin, models.Model).
+    tracked_fields: field names to track; None tracks every concrete field except the primary key.
+    get_dirty_fields(): names of tracked fields that differ from the snapshot, or None if
+        there is no snapshot (new instance, or one built by hand with a pk).
+    Fields deferred with only()/defer() are not in the snapshot and count as dirty only if
+    they have been assigned since loading.
+    """
+    tracked_fields = None
+
+    @classmethod
+    def _tracked_field_names(cls):
+        if cls.tracked_fields is not None:
+            return cls.tracked_fields
+        return [field.attname for field in cls._meta.concrete_fields if not field.primary_key]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._take_snapshot()
+        return instance
+
+    def _take_snapshot(self):
+        deferred = self.get_deferred_fields()
+        self._field_snapshot = {
+            name: self._snapshot_value(getattr(self, name))
+            for name in self._tracked_field_names() if name not in deferred
+        }
+
+    @staticmethod
+    def _snapshot_value(value):
+        if isinstance(value, IMMUTABLE_TYPES):
+            return value
+        return copy.deepcopy(value)
+
+    def get_dirty_fields(self):
+        snapshot = getattr(self, '_field_snapshot', None)
+        if snapshot is None:
+            return None
+        dirty = []
+        for name in self._tracked_field_names():
+            if name in snapshot:
+                if getattr(self, name) != snapshot[name]:
+                    dirty.append(name)
+            elif name in self.__dict__:
+                dirty.append(name)
+        return dirty
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._take_snapshot()
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        snapshot = getattr(self, '_field_snapshot', None)
+        if fields is None or snapshot is None:
+            self._take_snapshot()
+        else:
+            # Only the reloaded fields are clean again; other unsaved changes stay dirty.
+            tracked = self._tracked_field_names()
+            for name in fields:
+                attname = self._meta.get_field(name).attname
+                if attname in tracked:
+                    snapshot[attname] = self._snapshot_value(getattr(self, attname))
@@ -1,16 +1,31 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
 app_name = 'core'
 
+# Under ASGI the async views keep geocoding and matching out of the submit request.
+if settings.ASYNC_VIEWS:
+    details, submit, delete = views.details_async, views.submit_async, views.delete_async
+else:
+    details, submit, delete = views.details, views.submit, views.delete
+
 urlpatterns = [
     # Home page with index of user's game requests.
     path('', views.index, name='index'),
     # View details of a single event and modify/delete.
-    path('details/<int:GameRequestID>/', views.details, name='details'),
-    path('details/', views.details, name='new request'),
+    path('details/<int:GameRequestID>/', details, name='details'),
+    path('details/', details, name='new request'),
     # Form submission target.
-    path('submit/<int:GameRequestID>', views.submit, name='submit'),
+    path('submit/<int:GameRequestID>', submit, name='submit'),
     # Delete the request a form is attached to.
-    path('delete/<int:GameRequestID>', views.delete, name='delete'),
+    path('delete/<int:GameRequestID>', delete, name='delete'),
+    # JSON list of the user's requests with candidate DMs and groups.
+    path('api/requests', views.api_requests, name='api requests'),
+    # Player/DM counts per system around a point.
+    path('api/demand', views.demand, name='demand'),
+    # Staff download of requests, DM candidate edges or groups.
+    path('export/<str:table>', views.export, name='export'),
+    # Prometheus metrics for this worker process.
+    path('metrics', views.metrics, name='metrics'),
 ]
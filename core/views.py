@@ -1,20 +1,47 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import math
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.views import redirect_to_login
+from django.db import close_old_connections
+from django.db.models import Prefetch
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponseRedirect
-from .models import GameRequest
+from django.http import (
+    Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotAllowed, HttpResponseRedirect,
+    JsonResponse, StreamingHttpResponse
+)
+from django.utils.cache import get_conditional_response, patch_cache_control
+from .db import replica_reads
+from .export import FORMATS, TABLES, export_chunks
+from .functions import coordinates_from_api_async, map_tile
+from .jobs import process_request_job
+from .models import ADDRESS_FIELDS, SYSTEMCHOICES, DemandTile, GameRequest, defer_matching, user_request_list
 from .forms import GameRequestForm
 from django.urls import reverse
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.http import require_POST
+from .instrumentation import render_prometheus
+
+logger = logging.getLogger(__name__)
 
+# Matching tasks started by submit_async, kept referenced until they finish.
+background_tasks = set()
 
+
+@replica_reads
 def index(request):
     """
     Index page.
     Provides a list of a user's active game requests (if logged in) or
-    a link to the login page (if not).
+    a link to the login page (if not). The list is cached per user.
     """
     if request.user.is_authenticated:
-        GameRequestList = GameRequest.objects.filter(user_id=request.user)[:100]
+        GameRequestList = user_request_list(request.user.pk)
         context = {'GameRequestList': GameRequestList}
         return render(request, 'home.html', context)
     else:
@@ -22,6 +49,7 @@ def index(request):
 
 
 @login_required
+@replica_reads
 def details(request, GameRequestID=0):
     """
     Individual request details page.
@@ -72,3 +100,254 @@ def delete(request, GameRequestID=None):
     r = get_object_or_404(GameRequest, pk=GameRequestID, user_id=request.user)
     r.delete()
     return HttpResponseRedirect(reverse('core:index'), request)
+
+
+# Async versions of details/submit/delete, used with settings.ASYNC_VIEWS under ASGI.
+# Django 3.2's auth decorators don't support coroutines, so the login check is done by hand.
+
+def load_user(request):
+    """
+    Evaluates the lazy request.user (a session and a user query). Returns None for anonymous users.
+    """
+    return request.user if request.user.is_authenticated else None
+
+
+async def details_async(request, GameRequestID=0):
+    """
+    Async version of details.
+    """
+    if await sync_to_async(load_user)(request) is None:
+        return redirect_to_login(request.get_full_path())
+    return await sync_to_async(details.__wrapped__)(request, GameRequestID)
+
+
+def save_request_form(request, user, GameRequestID):
+    """
+    Saves the submitted form like submit, but with matching deferred to a MatchJob (see
+    models.defer_matching) so the save returns as soon as the row is written.
+    Returns (request, address changed), or None if GameRequestID is not one of the user's requests.
+    """
+    instance = None
+    if GameRequestID:
+        instance = GameRequest.objects.filter(pk=GameRequestID, user=user).first()
+        if instance is None:
+            return None
+    f = GameRequestForm(request.POST, instance=instance)
+    if instance is None:
+        f.instance.user = user
+    token = defer_matching.set(True)
+    try:
+        game_request = f.save()
+    finally:
+        defer_matching.reset(token)
+    return game_request, instance is None or any(field in f.changed_data for field in ADDRESS_FIELDS)
+
+
+def run_request_job(game_request_id):
+    try:
+        process_request_job(game_request_id)
+    finally:
+        # Background work isn't wrapped in a request, so clean up the connection here.
+        close_old_connections()
+
+
+async def locate_and_match(game_request, geocode):
+    """
+    Runs a submitted request's job once the response has been sent. A changed address is looked
+    up first through the async geocoder, which fills the shared geocode cache, so the job itself
+    doesn't block on the map API. If this process stops first, a run_jobs worker runs the job.
+    """
+    try:
+        if geocode and settings.USE_GEOPY_API:
+            await coordinates_from_api_async(game_request.address, game_request.city,
+                                             game_request.state, game_request.zip)
+        # Off the shared thread that runs the sync views, so a slow job doesn't hold them up.
+        await sync_to_async(run_request_job, thread_sensitive=False)(game_request.pk)
+    except Exception:
+        logger.exception("Background matching failed for request %s", game_request.pk)
+
+
+async def submit_async(request, GameRequestID=0):
+    """
+    Async version of submit. Responds as soon as the request is saved; geocoding and matching
+    continue in the background (see locate_and_match).
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    user = await sync_to_async(load_user)(request)
+    if user is None:
+        return redirect_to_login(request.get_full_path())
+    saved = await sync_to_async(save_request_form)(request, user, GameRequestID)
+    if saved is None:
+        raise Http404
+    task = asyncio.ensure_future(locate_and_match(*saved))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return HttpResponseRedirect(reverse('core:index'))
+
+
+async def delete_async(request, GameRequestID=None):
+    """
+    Async version of delete.
+    """
+    if await sync_to_async(load_user)(request) is None:
+        return redirect_to_login(request.get_full_path())
+    return await sync_to_async(delete.__wrapped__)(request, GameRequestID)
+
+
+@replica_reads
+def demand(request):
+    """
+    Player and DM counts for a system in the map tile around a point:
+    ?system=5e&lat=<latitude>&lon=<longitude>&zoom=<one of DEMAND_TILE_ZOOMS>.
+    A single indexed read of the DemandTile aggregates. Open to anonymous users since the
+    counts don't identify anyone.
+    """
+    system = request.GET.get('system')
+    try:
+        lat = float(request.GET['lat'])
+        lon = float(request.GET['lon'])
+        zoom = int(request.GET.get('zoom', settings.DEMAND_DEFAULT_ZOOM))
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest('lat and lon are required numbers, zoom an integer.')
+    if not (math.isfinite(lat) and math.isfinite(lon)):
+        # float() accepts nan and inf, which have no map tile.
+        return HttpResponseBadRequest('lat and lon must be finite.')
+    if system not in dict(SYSTEMCHOICES) or zoom not in settings.DEMAND_TILE_ZOOMS:
+        return HttpResponseBadRequest('Unknown system or unsupported zoom level.')
+    tile_x, tile_y = map_tile(lon, lat, zoom)
+    counts = DemandTile.objects.filter(
+        system=system, zoom=zoom, tile_x=tile_x, tile_y=tile_y).values('players', 'dms').first()
+    response = JsonResponse({
+        'system': system,
+        'zoom': zoom,
+        'tile_x': tile_x,
+        'tile_y': tile_y,
+        'players': counts['players'] if counts else 0,
+        'dms': counts['dms'] if counts else 0,
+    })
+    patch_cache_control(response, public=True, max_age=60)
+    return response
+
+
+def metrics_token_valid(request):
+    if not settings.METRICS_TOKEN:
+        return False
+    scheme, _, token = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(token.encode(), settings.METRICS_TOKEN.encode())
+
+
+def metrics(request):
+    """
+    Prometheus scrape target with request latency, query counts and timing spans for this
+    worker process. Only available to staff users, clients sending the METRICS_TOKEN bearer
+    token and the addresses in METRICS_ALLOWED_IPS (empty by default).
+    """
+    if not (request.user.is_staff or metrics_token_valid(request)
+            or request.META.get('REMOTE_ADDR') in settings.METRICS_ALLOWED_IPS):
+        return HttpResponseForbidden()
+    return HttpResponse(render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def export(request, table):
+    """
+    Streams one table of the match data (see core.export) as a file download, for staff only.
+    ?format= csv (default), jsonl or parquet. The rows are read and sent in chunks, so the
+    response starts at once and memory use stays flat however big the table is.
+    The database is read while the response is sent, so serve this from a WSGI worker.
+    """
+    if not request.user.is_staff:
+        return HttpResponseForbidden()
+    file_format = request.GET.get('format', 'csv')
+    if table not in TABLES or file_format not in FORMATS:
+        raise Http404
+    try:
+        chunks = export_chunks(table, file_format)
+    except ImportError as e:
+        return HttpResponseBadRequest(str(e))
+    response = StreamingHttpResponse(chunks, content_type=FORMATS[file_format])
+    response['Content-Disposition'] = f'attachment; filename="gamefinder-{table}.{file_format}"'
+    return response
+
+
+def request_summary(game_request, email=False):
+    summary = {'id': game_request.pk, 'request_name': game_request.request_name,
+               'username': game_request.user.username}
+    if email:
+        summary['email'] = game_request.user.email
+    return summary
+
+
+def match_data(game_request):
+    """
+    API representation of one of the user's requests: its candidate DMs and, if it is in a
+    group, the group's host and players. Group members' emails are included, as in the group
+    email; candidate DMs only show their username.
+    """
+    group = None
+    if getattr(game_request, 'hosted_group', None) is not None:
+        table, host = game_request.hosted_group, game_request
+    else:
+        table = game_request.group
+        host = table.host if table is not None else None
+    if table is not None:
+        group = {
+            'host': request_summary(host, email=True),
+            'players': [request_summary(player, email=True) for player in table.players.all()],
+        }
+    return {
+        'id': game_request.pk,
+        'request_name': game_request.request_name,
+        'system': game_request.system,
+        'can_dm': game_request.can_dm,
+        'travel_range': game_request.travel_range,
+        'candidate_dms': [request_summary(dm) for dm in game_request.available_dms.all()
+                          if dm.pk != game_request.pk],
+        'group': group,
+    }
+
+
+@login_required
+def api_requests(request):
+    """
+    JSON list of the user's requests with their candidate DMs and current group.
+    Keyset paginated by id: ?after=<last id of the previous page>&limit=<page size>.
+    The page is loaded in a fixed number of queries however many links and players it has.
+    The response has an ETag over its content, so clients polling for group changes get a
+    304 Not Modified while nothing has changed. It is read from the primary, since a lagging
+    replica would answer a poll with a stale 304.
+    """
+    try:
+        after = int(request.GET.get('after', 0))
+        limit = min(int(request.GET.get('limit', settings.API_PAGE_SIZE)), settings.API_MAX_PAGE_SIZE)
+    except ValueError:
+        return HttpResponseBadRequest('after and limit must be integers.')
+    if limit < 1:
+        return HttpResponseBadRequest('limit must be positive.')
+
+    members = GameRequest.objects.select_related('user').order_by('pk')
+    page = list(
+        GameRequest.objects.filter(user_id=request.user.pk, pk__gt=after).order_by('pk')
+        .select_related('group__host__user', 'hosted_group')
+        .prefetch_related(
+            Prefetch('available_dms', queryset=members),
+            Prefetch('group__players', queryset=members),
+            Prefetch('hosted_group__players', queryset=members),
+        )[:limit + 1]
+    )
+    data = {
+        'results': [match_data(game_request) for game_request in page[:limit]],
+        'next': None,
+    }
+    if len(page) > limit:
+        data['next'] = f"{reverse('core:api requests')}?after={page[limit - 1].pk}&limit={limit}"
+
+    content = json.dumps(data, sort_keys=True)
+    etag = '"%s"' % hashlib.sha1(content.encode()).hexdigest()
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(content, content_type='application/json')
+    response['ETag'] = etag
+    # Clients may keep the page but must revalidate it on every poll.
+    patch_cache_control(response, private=True, no_cache=True)
+    return response